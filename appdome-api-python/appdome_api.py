@@ -1,27 +1,45 @@
 import argparse
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, ExitStack
 from enum import Enum
+from functools import partial
+from time import time
 from os import getenv
-from os.path import splitext
+from os.path import splitext, join, basename, getsize
 
 from build_to_test import BuildToTestVendors, build_to_test, init_automation_vendor
+from artifact_cache import add_artifact_cache_args, init_artifact_cache, fetch_artifact
+from artifact_tee import add_tee_args, init_tee, check_tee
+from artifact_stream import ArtifactManifest
 from auto_dev_sign import auto_dev_sign_android, auto_dev_sign_ios
 from build import build
+from build_history import add_build_history_args, init_build_history
 from certified_secure import download_certified_secure
-from certified_secure_json import download_certified_secure_json, format_json_file
-from context import context, add_context_args
+from certified_secure_json import download_certified_secure_json
+from completion_receiver import add_completion_args, init_completion_receiver
+from context import context, add_context_args, add_context_variants_args, init_context_variants
+from deadline import start_deadline, deadline_phase
 from direct_upload import direct_upload
+from models import parse_task, parse_upload, response_json
+from log_follower import add_workflow_logs_args, init_workflow_log_follower
 from download import download, download_action
+from post_processors import JSON_FORMATS, ZipProcessor, json_processors
+from profiler import add_profile_args, init_profiler
 from private_sign import private_sign_android, private_sign_ios
 from sign import sign_android, sign_ios
-from status import wait_for_status_complete
+from status import wait_for_status_complete, StatusPoller
+from stream_upload import add_stream_upload_args, stream_upload_with_digest, DEFAULT_IDLE_SEC, STDIN_SOURCE
 from upload import upload
 from utils import (validate_response, log_and_exit, add_common_args, init_common_args, validate_output_path,
-                   init_overrides, init_build_files, init_certs_pinning, add_signing_credentials_args, TASK_ID_KEY,
+                   init_overrides, init_build_files, init_certs_pinning, add_signing_credentials_args,
                    BUILD_FILE_SPECS,
                    android_keystore, android_keystore_pass, android_keystore_alias, android_key_pass, ios_p12, ios_p12_password,
-                   ios_provisioning_profiles, validate_trusted_fingerprint_list_args)
+                   ios_provisioning_profiles, validate_trusted_fingerprint_list_args, suffixed_output_path,
+                   resolve_signing_fingerprint_list, add_metric, read_named_configs)
 from status import _get_obfuscation_map_status
+from upload_ledger import init_upload_ledger
 from upload_mapping_file import upload_mapping_file
 
 
@@ -31,7 +49,14 @@ class Platform(Enum):
     IOS = 2
 
 
-def parse_arguments():
+SIGN_METHODS = ('sign_on_appdome', 'private_signing', 'auto_dev_private_signing')
+SIGN_CONFIG_KEYS = ('name', 'method', 'keystore', 'keystore_pass', 'keystore_alias', 'key_pass', 'signing_fingerprint',
+                    'signing_fingerprint_upgrade', 'google_play_signing', 'signing_fingerprint_list',
+                    'provisioning_profiles', 'entitlements', 'sign_overrides', 'output', 'sign_second_output')
+OUTPUT_KEYS = ('output', 'deobfuscation_script_output', 'sign_second_output', 'certificate_output', 'certificate_json')
+
+
+def parse_arguments(argv=None):
     parser = argparse.ArgumentParser(description='Runs Appdome API commands')
     upload_group = parser.add_mutually_exclusive_group(required=True)
     upload_group.add_argument('-a', '--app', metavar='application_file', help='Upload app file input path')
@@ -40,6 +65,7 @@ def parse_arguments():
     add_common_args(parser)
 
     parser.add_argument('--direct_upload', action='store_true', help="Upload app directly to Appdome, and not through aws pre-signed url")
+    add_stream_upload_args(parser)
     parser.add_argument('-fs', '--fusion_set_id', metavar='fusion_set_id_value',
                         help='Appdome Fusion Set id. '
                              'Default for Android is environment variable APPDOME_ANDROID_FS_ID. '
@@ -52,6 +78,8 @@ def parse_arguments():
                         help='App ID in Firebase project (required for Crashlytics)')
     parser.add_argument('-dd_api_key', '--datadog_api_key', metavar='datadog_api_key',
                         help='Data Dog API_KEY (required for DataDog Deobfuscation)')
+    parser.add_argument('--force_mapping_upload', action='store_true',
+                        help='Upload the mapping file even when the upload ledger has it as already uploaded')
     parser.add_argument('-baseline_profile', '--baseline_profile', metavar='baseline_profile',
                         help='baseline profile file to use')
     parser.add_argument('-startup_profile', '--startup_profile', metavar='startup_profile',
@@ -62,12 +90,19 @@ def parse_arguments():
                         help='Path to zip file containing dynamic certificates for certificate pinning')
 
     add_context_args(parser)
+    add_context_variants_args(parser)
+    parser.add_argument('--fan_out_workers', type=int, default=4, metavar='fan_out_workers',
+                        help='Maximum number of context variants, signing configurations or Build to Test vendors '
+                             'processed concurrently. Default is 4')
 
     sign_group = parser.add_mutually_exclusive_group(required=True)
     sign_group.add_argument('-s', '--sign_on_appdome', action='store_true', help='Sign on Appdome')
     sign_group.add_argument('-ps', '--private_signing', action='store_true', help='Sign application manually')
     sign_group.add_argument('-adps', '--auto_dev_private_signing', action='store_true',
                             help='Use a pre-generated signing script for automated local signing')
+    sign_group.add_argument('--sign_configs', metavar='sign_configs_json_file',
+                            help='Path to json file with a list of signing configurations. '
+                                 'The build is signed with all of them concurrently, each to its own output')
 
     add_signing_credentials_args(parser)
     # Output parameters
@@ -81,11 +116,90 @@ def parse_arguments():
                         help='Output file for Certified Secure pdf')
     parser.add_argument('-cj', '--certificate_json', metavar='certificate_json_output_file',
                         help='Output file for Certified Secure json')
+    parser.add_argument('--certificate_json_format', choices=JSON_FORMATS, default='pretty',
+                        help='Format of the Certified Secure json. Default: pretty')
+    parser.add_argument('--verify_outputs', action='store_true',
+                        help='Verify the zip structure and the crc of every member of the outputs while downloading')
+    parser.add_argument('--extract_members', nargs='+', metavar='member_pattern',
+                        help='Extract output members matching these patterns (e.g. AndroidManifest.xml "META-INF/*") '
+                             'while downloading')
+    parser.add_argument('--extract_dir', metavar='extract_directory',
+                        help='Directory for the extracted members, under a sub directory named after the output')
     parser.add_argument('-bt', '--build_to_test_vendor', metavar='build_to_test_vendor',
                         help='Enter vendor name on which Build to Test will happen')
-    parser.add_argument('-wol', '--workflow_output_logs', metavar='workflow_output_logs',
-                        help='Enter path to a workflow output logs file (optional)')
-    return parser.parse_args()
+    parser.add_argument('--build_to_test_vendors', nargs='+', metavar='build_to_test_vendor',
+                        help='Build to Test for several vendors from one upload, concurrently. Outputs get the vendor '
+                             'name as a suffix')
+    parser.add_argument('--deadline', type=float, metavar='seconds',
+                        help='Time budget of the whole run, split across its phases. The run fails once a phase '
+                             'spends its share')
+    parser.add_argument('--manifest', metavar='manifest_json_file',
+                        help='Output file for a manifest with the size, sha256, task id and timing of every output')
+    add_workflow_logs_args(parser)
+    add_artifact_cache_args(parser)
+    add_tee_args(parser)
+    add_profile_args(parser)
+    add_build_history_args(parser)
+    add_completion_args(parser)
+    return parser.parse_args(argv)
+
+
+def _validate_signing_args(args, platform):
+    if args.private_signing or args.auto_dev_private_signing:
+        if platform == Platform.ANDROID and not args.signing_fingerprint and not args.signing_fingerprint_list:
+            log_and_exit(f"signing_fingerprint or signing_fingerprint_list must be specified when using any Android local signing")
+
+    if platform == Platform.IOS and not ios_provisioning_profiles(args):
+        log_and_exit(f"provisioning_profiles must be specified when using any iOS signing")
+
+    if args.sign_on_appdome:
+        if platform == Platform.IOS:
+            if not all([ios_p12(args), ios_p12_password(args)]):
+                log_and_exit(f"All ios signing credentials(keystore, keystore_pass) must be specified when using on Appdome signing")
+        if platform == Platform.ANDROID:
+            if not all([android_keystore(args), android_keystore_pass(args), android_keystore_alias(args), android_key_pass(args)]):
+                log_and_exit(f"All android signing credentials(keystore, keystore_pass, keystore_alias, key_pass) must be specified when using on Appdome signing")
+        if args.google_play_signing and not args.signing_fingerprint:
+            log_and_exit(f"Google signing fingerprint requires providing a signing fingerprint")
+
+    validate_trusted_fingerprint_list_args(args)
+
+    if args.google_play_signing:
+        if args.signing_fingerprint_upgrade and not args.signing_fingerprint:
+            log_and_exit(f"Base Google signing fingerprint is required to upgrade the fingerprint")
+
+
+def _read_sign_configs(sign_configs_file):
+    """
+    Loads signing configurations from a json file.
+
+    The file holds a list of configurations, each with a unique 'name', a 'method' (sign_on_appdome,
+    private_signing or auto_dev_private_signing), any of the signing parameters and optional 'output' and
+    'sign_second_output' paths. Signing parameters that are not set fall back to the command line values.
+
+    :param sign_configs_file: Path to the signing configurations json file
+    :return: List of configuration dicts
+    """
+    sign_configs = read_named_configs(sign_configs_file, 'Signing configuration', SIGN_CONFIG_KEYS)
+    for config in sign_configs:
+        if config.get('method') not in SIGN_METHODS:
+            log_and_exit(f"Signing configuration [{config['name']}] method must be one of: {', '.join(SIGN_METHODS)}")
+    return sign_configs
+
+
+def _sign_config_args(args, sign_config):
+    sign_args = argparse.Namespace(**vars(args))
+    for key, value in sign_config.items():
+        if key not in ('name', 'method', 'output', 'sign_second_output'):
+            setattr(sign_args, key, value)
+    for method in SIGN_METHODS:
+        setattr(sign_args, method, sign_config['method'] == method)
+    if 'signing_fingerprint_list' in sign_config and sign_args.signing_fingerprint_list:
+        if not isinstance(sign_args.signing_fingerprint_list, str):
+            sign_args.signing_fingerprint_list = json.dumps(sign_args.signing_fingerprint_list)
+        resolve_signing_fingerprint_list(sign_args)
+    sign_args.sign_config = sign_config
+    return sign_args
 
 
 def validate_args(args):
@@ -93,7 +207,9 @@ def validate_args(args):
     platform = Platform.UNKNOWN
     init_common_args(args)
     if args.app:
-        app_path_ext = splitext(args.app)[-1].lower()
+        if args.app == STDIN_SOURCE and not (args.stream_upload and args.app_name):
+            log_and_exit("Uploading the app from stdin requires --stream_upload and --app_name")
+        app_path_ext = splitext(args.app_name or args.app)[-1].lower()
         if app_path_ext == ".ipa":
             platform = Platform.IOS
         elif app_path_ext == ".apk" or app_path_ext == ".aab":
@@ -101,10 +217,13 @@ def validate_args(args):
         else:
             log_and_exit(f"App extension [{app_path_ext}] must be .ipa, .apk or .aab")
 
+    sign_configs = _read_sign_configs(args.sign_configs) if args.sign_configs else None
+
     if platform == Platform.UNKNOWN:
-        if args.provisioning_profiles and not args.signing_fingerprint and not args.keystore_alias:
+        platform_args = _sign_config_args(args, sign_configs[0]) if sign_configs else args
+        if platform_args.provisioning_profiles and not platform_args.signing_fingerprint and not platform_args.keystore_alias:
             platform = Platform.IOS
-        elif not args.provisioning_profiles and (args.signing_fingerprint or args.keystore_alias):
+        elif not platform_args.provisioning_profiles and (platform_args.signing_fingerprint or platform_args.keystore_alias):
             platform = Platform.ANDROID
         else:
             log_and_exit(f"Please specify the correct platform signing credentials")
@@ -114,49 +233,77 @@ def validate_args(args):
         if not fusion_set_id:
             log_and_exit(f"fusion_set_id must be specified or set though the correct platform environment variable")
 
-    if args.private_signing or args.auto_dev_private_signing:
-        if platform == Platform.ANDROID and not args.signing_fingerprint and not args.signing_fingerprint_list:
-            log_and_exit(f"signing_fingerprint or signing_fingerprint_list must be specified when using any Android local signing")
-
-    if platform == Platform.IOS and not ios_provisioning_profiles(args):
-        log_and_exit(f"provisioning_profiles must be specified when using any iOS signing")
-
-    if args.sign_on_appdome:
-        if platform == Platform.IOS:
-            if not all([ios_p12(args), ios_p12_password(args)]):
-                log_and_exit(f"All ios signing credentials(keystore, keystore_pass) must be specified when using on Appdome signing")
-        if platform == Platform.ANDROID:
-            if not all([android_keystore(args), android_keystore_pass(args), android_keystore_alias(args), android_key_pass(args)]):
-                log_and_exit(f"All android signing credentials(keystore, keystore_pass, keystore_alias, key_pass) must be specified when using on Appdome signing")
-        if args.google_play_signing and not args.signing_fingerprint:
-            log_and_exit(f"Google signing fingerprint requires providing a signing fingerprint")
-
-    if args.build_to_test_vendor and not any(
-            args.build_to_test_vendor == vendor.value for vendor in BuildToTestVendors):
-        log_and_exit(f"Vendor name provided for Build To Test isn't one of the acceptable vendors")
-
-    validate_trusted_fingerprint_list_args(args)
-
-    if args.google_play_signing:
-        if args.signing_fingerprint_upgrade and not args.signing_fingerprint:
-            log_and_exit(f"Base Google signing fingerprint is required to upgrade the fingerprint")
+    if sign_configs:
+        for config in sign_configs:
+            sign_args = _sign_config_args(args, config)
+            _validate_signing_args(sign_args, platform)
+            validate_output_path(sign_args.sign_config.get('output'))
+            validate_output_path(sign_args.sign_config.get('sign_second_output'))
+    else:
+        _validate_signing_args(args, platform)
+
+    for vendor_name in [args.build_to_test_vendor] + (args.build_to_test_vendors or []):
+        if vendor_name and not any(vendor_name == vendor.value for vendor in BuildToTestVendors):
+            log_and_exit(f"Vendor name provided for Build To Test isn't one of the acceptable vendors: {vendor_name}")
+    if args.build_to_test_vendors:
+        if args.build_to_test_vendor or args.context_variants:
+            log_and_exit("--build_to_test_vendors cannot be used with --build_to_test_vendor or --context_variants")
+        if len(set(args.build_to_test_vendors)) != len(args.build_to_test_vendors):
+            log_and_exit("--build_to_test_vendors has duplicate vendors")
+
+    if args.context_variants:
+        single_context_args = [key for key in ('new_bundle_id', 'new_version', 'new_build_num', 'new_display_name',
+                                               'app_icon', 'icon_overlay') if getattr(args, key, None)]
+        if single_context_args:
+            log_and_exit(f"--context_variants cannot be used with: {', '.join('--' + key for key in single_context_args)}")
+        args.context_variants = init_context_variants(args.context_variants)
+        for variant in args.context_variants:
+            validate_output_path(variant.get('output'))
+    if args.fan_out_workers < 1:
+        log_and_exit("fan_out_workers must be a positive number")
+    if args.deadline is not None and args.deadline <= 0:
+        log_and_exit("deadline must be a positive number of seconds")
 
     validate_output_path(args.output)
     validate_output_path(args.certificate_output)
     validate_output_path(args.certificate_json)
+    validate_output_path(args.manifest)
+    if args.extract_members and not args.extract_dir:
+        log_and_exit("extract_dir must be specified with extract_members")
+    args.manifest = ArtifactManifest(args.manifest) if args.manifest else None
+    args.artifact_cache = init_artifact_cache(args)
+    args.tee = init_tee(args)
+    args.profiler = init_profiler(args)
+    args.build_run = init_build_history(args, platform.name.lower(), fusion_set_id)
+    init_completion_receiver(args)
+    if sign_configs:
+        # Copied once the shared run state (manifest, cache, profiler, build history...) is set on args
+        args.sign_configs = [_sign_config_args(args, config) for config in sign_configs]
+    start_deadline(args.deadline)
     return platform, fusion_set_id
 
 
-def _upload(api_key, team_id, app_path, direct_upload_param=False):
-    upload_func = direct_upload if direct_upload_param else upload
-    upload_response = upload_func(api_key, team_id, app_path)
-    validate_response(upload_response)
-    logging.info(f"Upload done. App-id: {upload_response.json()['id']}")
-    return upload_response.json()['id']
+def _upload(api_key, team_id, app_path, direct_upload_param=False, stream=False, app_name=None,
+            stream_idle_sec=DEFAULT_IDLE_SEC, build_run=None):
+    if stream:
+        upload_response, digest = stream_upload_with_digest(api_key, team_id, app_path, app_name, direct_upload_param,
+                                                            stream_idle_sec)
+        if build_run:
+            # The app was hashed while it was sent, since a stream cannot be read before the upload
+            build_run.app_digest(digest['sha256'])
+    else:
+        upload_func = direct_upload if direct_upload_param else upload
+        upload_response = upload_func(api_key, team_id, app_path)
+        validate_response(upload_response)
+        add_metric('bytes', getsize(app_path))
+    app_id = parse_upload(upload_response).id
+    logging.info(f"Upload done. App-id: {app_id}")
+    return app_id
 
 
 def _build(api_key, team_id, app_id, fusion_set_id, build_overrides, use_diagnostic_logs, build_to_test_vendor,
-           workflow_output_logs=None, cert_pinning_zip=None, args=None):
+           workflow_output_logs=None, cert_pinning_zip=None, args=None, log_follower=None, poller=None,
+           record_kind=None):
     build_overrides_json = init_overrides(build_overrides)
     files = init_certs_pinning(cert_pinning_zip)
     build_files = {key: getattr(args, key, None) for key in BUILD_FILE_SPECS} if args else None
@@ -170,25 +317,29 @@ def _build(api_key, team_id, app_id, fusion_set_id, build_overrides, use_diagnos
         build_response = build(api_key, team_id, app_id, fusion_set_id, build_overrides_json, use_diagnostic_logs,
                                files=files)
     validate_response(build_response)
-    logging.info(f"Build request started. Response: {build_response.json()}")
-    task_id = build_response.json()[TASK_ID_KEY]
+    task_id = parse_task(build_response).task_id
+    logging.info(f"Build request started. Response: {response_json(build_response)}")
+    if record_kind:
+        # Recorded before waiting, so a queued job re-attaches to the build if its worker dies meanwhile
+        _record_task(args, record_kind, task_id)
     wait_for_status_complete(api_key, team_id, task_id, operation="build",
-                             workflow_output_logs_path=workflow_output_logs)
+                             workflow_output_logs_path=workflow_output_logs, log_follower=log_follower, poller=poller)
     logging.info(f"Build request finished.")
     return task_id
 
 
 def _context(api_key, team_id, task_id, workflow_output_logs=None, new_bundle_id=None, new_version=None,
-             new_build_num=None, new_display_name=None, app_icon=None, icon_overlay=None):
+             new_build_num=None, new_display_name=None, app_icon=None, icon_overlay=None, log_follower=None,
+             poller=None):
     context_response = context(api_key, team_id, task_id, new_bundle_id, new_version, new_build_num, new_display_name, app_icon, icon_overlay)
     validate_response(context_response)
-    logging.info(f"Context request started. Response: {context_response.json()}")
+    logging.info(f"Context request started. Response: {response_json(context_response)}")
     wait_for_status_complete(api_key, team_id, task_id, operation="context",
-                             workflow_output_logs_path=workflow_output_logs)
+                             workflow_output_logs_path=workflow_output_logs, log_follower=log_follower, poller=poller)
     logging.info(f"Context request finished.")
 
 
-def _sign(args, platform, task_id, sign_overrides, workflow_output_logs=None):
+def _start_sign(args, platform, task_id, sign_overrides):
     sign_overrides_json = init_overrides(sign_overrides)
     if platform == Platform.ANDROID:
         if args.sign_on_appdome:
@@ -215,49 +366,381 @@ def _sign(args, platform, task_id, sign_overrides, workflow_output_logs=None):
             r = auto_dev_sign_ios(args.api_key, args.team_id, task_id, ios_provisioning_profiles(args), args.entitlements,
                                   sign_overrides_json)
 
+    return r
+
+
+def _sign(args, platform, task_id, sign_overrides, workflow_output_logs=None, log_follower=None, poller=None):
+    r = _start_sign(args, platform, task_id, sign_overrides)
     validate_response(r)
-    logging.info(f"Signing request started. Response: {r.json()}")
+    logging.info(f"Signing request started. Response: {response_json(r)}")
     wait_for_status_complete(args.api_key, args.team_id, task_id, operation="sign",
-                             workflow_output_logs_path=workflow_output_logs)
+                             workflow_output_logs_path=workflow_output_logs, log_follower=log_follower, poller=poller)
     logging.info(f"Signing request finished.")
 
 
-def _download_file(api_key, team_id, task_id, output_path, download_func):
-    download_response = download_func(api_key, team_id, task_id)
-    validate_response(download_response)
-    with open(output_path, 'wb') as f:
-        f.write(download_response.content)
+def _download_file(api_key, team_id, task_id, output_path, download_func, manifest=None, kind=None, processors=None,
+                   cache=None):
+    started = time()
+    digest = fetch_artifact(cache, team_id, task_id, kind,
+                            lambda headers: download_func(api_key, team_id, task_id, stream=True,
+                                                          extra_headers=headers),
+                            output_path, processors)
+    if manifest:
+        manifest.add(output_path, task_id=task_id, kind=kind, started=started, finished=time(), **digest)
     logging.info(f"File written to {output_path}")
+    check_tee(digest, output_path)
+
+
+def _output_processors(args, kind, output_path):
+    """
+    :return: New post-processing chain for an output kind ('output', 'sign_second_output', 'deobfuscation_script',
+        'certificate' or 'certificate-json'), ending with the copy to the --tee destinations
+    """
+    processors = []
+    if kind == 'certificate-json':
+        processors = json_processors(args.certificate_json_format)
+    elif kind != 'certificate':
+        extract = args.extract_members if kind == 'output' else None
+        if args.verify_outputs or extract:
+            extract_dir = join(args.extract_dir, splitext(basename(output_path))[0]) if extract else None
+            processors = [ZipProcessor(verify_crc=args.verify_outputs, extract=extract, extract_dir=extract_dir)]
+    if args.tee:
+        processors.append(args.tee.processor(output_path))
+    return processors or None
+
+
+@contextmanager
+def _phase(args, name):
+    """
+    Runs the enclosed pipeline phase under its share of the deadline, and profiles it and records it in the build
+    history when they are enabled. The pipeline of a queued job stops before and after every phase once its lease was
+    lost.
+    """
+    if args.job:
+        args.job.check()
+    with ExitStack() as stack:
+        stack.enter_context(deadline_phase(name))
+        stack.enter_context(args.profiler.phase(name))
+        if args.build_run:
+            stack.enter_context(args.build_run.phase(name))
+        yield
+        if args.job:
+            args.job.check()
+
+
+def _record_task(args, kind, task_id):
+    if args.build_run:
+        args.build_run.task(kind, task_id)
+    if args.job:
+        args.job.record_task(kind, task_id)
+
+
+def _attached_task(args, kind):
+    """
+    :return: Task id a previous attempt of the queued job recorded for kind, to be re-attached instead of started
+        again, or None
+    """
+    return args.job.task(kind) if args.job else None
+
+
+def _reattach(args, task_id, operation, log_follower=None, poller=None):
+    logging.info(f"Re-attaching to {operation} task {task_id} of a previous attempt")
+    wait_for_status_complete(args.api_key, args.team_id, task_id, operation=operation, log_follower=log_follower,
+                             poller=poller)
+    return task_id
 
 
-def main():
-    args = parse_arguments()
-    platform, fusion_set_id = validate_args(args)
-
-    app_id = _upload(args.api_key, args.team_id, args.app, args.direct_upload) if args.app else args.app_id
-
-    task_id = _build(args.api_key, args.team_id, app_id, fusion_set_id, args.build_overrides, args.diagnostic_logs,
-                     args.build_to_test_vendor, args.workflow_output_logs, args.cert_pinning_zip, args)
+def _download_outputs(args, task_id, output=None, deobfuscation_script_output=None, sign_second_output=None,
+                      certificate_output=None, certificate_json=None):
+    manifest = args.manifest
+    cache = args.artifact_cache
+    if output:
+        with _phase(args, 'download output'):
+            _download_file(args.api_key, args.team_id, task_id, output, download, manifest, 'output',
+                           _output_processors(args, 'output', output), cache)
+    if _get_obfuscation_map_status(args.api_key, args.team_id, task_id):
+        with _phase(args, 'download deobfuscation_script'):
+            download_action(args.api_key, args.team_id, task_id, deobfuscation_script_output, 'deobfuscation_script',
+                            manifest, _output_processors(args, 'deobfuscation_script', deobfuscation_script_output),
+                            cache)
+        if deobfuscation_script_output and (args.datadog_api_key or args.firebase_app_id):
+            with _phase(args, 'mapping upload'):
+                upload_mapping_file(deobfuscation_mapping_file=deobfuscation_script_output,
+                                    fire_base_app_id=args.firebase_app_id, data_dog_api_key=args.datadog_api_key,
+                                    ledger=init_upload_ledger(), force=args.force_mapping_upload)
+    if not args.auto_dev_private_signing and sign_second_output:
+        with _phase(args, 'download sign_second_output'):
+            download_action(args.api_key, args.team_id, task_id, sign_second_output, 'sign_second_output', manifest,
+                            _output_processors(args, 'sign_second_output', sign_second_output), cache)
+    if certificate_output:
+        with _phase(args, 'download certificate'):
+            _download_file(args.api_key, args.team_id, task_id, certificate_output, download_certified_secure,
+                           manifest, 'certificate', _output_processors(args, 'certificate', certificate_output), cache)
+    if certificate_json:
+        with _phase(args, 'download certificate-json'):
+            _download_file(args.api_key, args.team_id, task_id, certificate_json, download_certified_secure_json,
+                           manifest, 'certificate-json', _output_processors(args, 'certificate-json', certificate_json),
+                           cache)
+
+
+def _output_paths(args, suffix=None):
+    return {key: suffixed_output_path(getattr(args, key), suffix) if suffix else getattr(args, key)
+            for key in OUTPUT_KEYS}
+
+
+def _fan_out(description, jobs, max_workers):
+    """
+    Runs named jobs concurrently and waits for all of them to finish.
+
+    :param description: Job description for logs, e.g. 'Context variant'
+    :param jobs: Dict of job name to a callable without arguments returning the job task id
+    :param max_workers: Maximum number of jobs running concurrently
+    :return: Dict of job name to job task id
+    """
+    task_ids = {}
+    failures = {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        futures = {executor.submit(job): name for name, job in jobs.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                task_ids[name] = future.result()
+                logging.info(f"{description} [{name}] finished. Task id: {task_ids[name]}")
+            except Exception as e:
+                failures[name] = e
+                logging.error(f"{description} [{name}] failed: {e}")
+    if failures:
+        log_and_exit(f"{len(failures)} of {len(jobs)} {description.lower()} jobs failed: {', '.join(sorted(failures))}")
+    return task_ids
+
+
+def _fan_out_task_id(response, parent_task_id, description, name):
+    """
+    :return: Task id the server started for one job of a fan-out. The jobs are waited on and downloaded by their own
+        task id, so a response without one, or with the parent task id, fails the job instead of sharing the parent
+        task with the other jobs
+    """
+    job_task_id = parse_task(response).task_id
+    if not job_task_id or job_task_id == parent_task_id:
+        log_and_exit(f"{description} [{name}] did not get its own task id from the server (task id: {job_task_id}, "
+                     f"parent task id: {parent_task_id})")
+    return job_task_id
+
+
+def _run_sign_config(sign_args, platform, task_id, outputs, workflow_output_logs=None, parent_name=None):
+    name = sign_args.sign_config['name']
+    # The same configuration signs every context variant or vendor build, which are told apart by their name
+    label = f"{parent_name}/{name}" if parent_name else name
+    r = _start_sign(sign_args, platform, task_id, sign_args.sign_overrides)
+    validate_response(r)
+    sign_task_id = _fan_out_task_id(r, task_id, 'Signing configuration', label)
+    logging.info(f"Signing configuration [{label}] started. Task id: {sign_task_id}")
+    _record_task(sign_args, f"sign [{label}]", sign_task_id)
+
+    log_follower = init_workflow_log_follower(sign_args, sign_task_id, suffixed_output_path(workflow_output_logs, name))
+    try:
+        with _phase(sign_args, f"sign [{label}]"):
+            wait_for_status_complete(sign_args.api_key, sign_args.team_id, sign_task_id, operation="sign",
+                                     log_follower=log_follower)
+    finally:
+        if log_follower:
+            log_follower.close()
+
+    sign_outputs = {key: suffixed_output_path(path, name) for key, path in outputs.items()}
+    for key in ('output', 'sign_second_output'):
+        sign_outputs[key] = sign_args.sign_config.get(key) or sign_outputs[key]
+    _download_outputs(sign_args, sign_task_id, **sign_outputs)
+    return sign_task_id
+
+
+def _sign_fan_out(sign_configs, platform, task_id, outputs, max_workers, workflow_output_logs=None, parent_name=None):
+    """
+    Signs a fused (or context) task with several signing configurations concurrently and downloads each signed
+    output to its own path.
+
+    :param sign_configs: List of signing configuration namespaces (see _sign_config_args)
+    :param outputs: Base output paths, suffixed with the configuration name unless the configuration sets its own
+    :param parent_name: Name of the context variant or Build to Test vendor of the task (optional)
+    :return: Dict of signing configuration name to signing task id
+    """
+    logging.info(f"Signing task {task_id} with {len(sign_configs)} signing configurations")
+    jobs = {sign_args.sign_config['name']: partial(_run_sign_config, sign_args, platform, task_id, outputs,
+                                                   workflow_output_logs, parent_name)
+            for sign_args in sign_configs}
+    return _fan_out('Signing configuration', jobs, max_workers)
+
+
+def _run_context_variant(args, platform, task_id, variant):
+    name = variant['name']
+    context_response = context(args.api_key, args.team_id, task_id, variant.get('new_bundle_id'),
+                               variant.get('new_version'), variant.get('new_build_num'),
+                               variant.get('new_display_name'), variant.get('app_icon'), variant.get('icon_overlay'),
+                               variant.get('context_overrides'))
+    validate_response(context_response)
+    variant_task_id = _fan_out_task_id(context_response, task_id, 'Context variant', name)
+    logging.info(f"Context variant [{name}] started. Task id: {variant_task_id}")
+    _record_task(args, f"context [{name}]", variant_task_id)
+
+    outputs = _output_paths(args, name)
+    outputs['output'] = variant.get('output') or outputs['output']
+    workflow_output_logs = suffixed_output_path(args.workflow_output_logs, name)
+    log_follower = init_workflow_log_follower(args, variant_task_id, workflow_output_logs)
+    try:
+        with _phase(args, f"context [{name}]"):
+            wait_for_status_complete(args.api_key, args.team_id, variant_task_id, operation="context",
+                                     log_follower=log_follower)
+        if not args.sign_configs:
+            with _phase(args, f"sign [{name}]"):
+                _sign(args, platform, variant_task_id, args.sign_overrides, log_follower=log_follower)
+    finally:
+        if log_follower:
+            log_follower.close()
+
+    if args.sign_configs:
+        _sign_fan_out(args.sign_configs, platform, variant_task_id, outputs, args.fan_out_workers,
+                      workflow_output_logs, name)
+    else:
+        _download_outputs(args, variant_task_id, **outputs)
+    return variant_task_id
+
+
+def _context_fan_out(args, platform, task_id, variants):
+    """
+    Creates all context variants of a fused task concurrently, then signs and downloads each of them.
+
+    :return: Dict of variant name to variant task id
+    """
+    logging.info(f"Starting {len(variants)} context variants of task {task_id}")
+    jobs = {variant['name']: partial(_run_context_variant, args, platform, task_id, variant) for variant in variants}
+    return _fan_out('Context variant', jobs, args.fan_out_workers)
+
+
+def _run_build_to_test_vendor(args, platform, app_id, fusion_set_id, vendor, poller):
+    workflow_output_logs = suffixed_output_path(args.workflow_output_logs, vendor)
+    log_follower = init_workflow_log_follower(args, output_path=workflow_output_logs)
+    try:
+        attached_task_id = _attached_task(args, f"build [{vendor}]")
+        with _phase(args, f"build [{vendor}]"):
+            if attached_task_id:
+                _record_task(args, f"build [{vendor}]", attached_task_id)
+                task_id = _reattach(args, attached_task_id, 'build', log_follower, poller)
+            else:
+                task_id = _build(args.api_key, args.team_id, app_id, fusion_set_id, args.build_overrides,
+                                 args.diagnostic_logs, vendor, cert_pinning_zip=args.cert_pinning_zip, args=args,
+                                 log_follower=log_follower, poller=poller, record_kind=f"build [{vendor}]")
+        with _phase(args, f"context [{vendor}]"):
+            _context(args.api_key, args.team_id, task_id, new_bundle_id=args.new_bundle_id,
+                     new_version=args.new_version, new_build_num=args.new_build_num,
+                     new_display_name=args.new_display_name, app_icon=args.app_icon,
+                     icon_overlay=args.icon_overlay, log_follower=log_follower, poller=poller)
+        if not args.sign_configs:
+            with _phase(args, f"sign [{vendor}]"):
+                _sign(args, platform, task_id, args.sign_overrides, log_follower=log_follower, poller=poller)
+    finally:
+        if log_follower:
+            log_follower.close()
+
+    outputs = _output_paths(args, vendor)
+    if args.sign_configs:
+        _sign_fan_out(args.sign_configs, platform, task_id, outputs, args.fan_out_workers, workflow_output_logs,
+                      vendor)
+    else:
+        _download_outputs(args, task_id, **outputs)
+    return task_id
 
-    _context(args.api_key, args.team_id, task_id, args.workflow_output_logs, args.new_bundle_id, args.new_version,
-             args.new_build_num, args.new_display_name, args.app_icon, args.icon_overlay)
 
-    _sign(args, platform, task_id, args.sign_overrides, args.workflow_output_logs)
+def _build_to_test_fan_out(args, platform, app_id, fusion_set_id):
+    """
+    Builds an uploaded app for several Build to Test vendors concurrently, then signs and downloads each vendor
+    build to outputs suffixed with the vendor name. Waiters that do not follow workflow logs share one status poller.
+
+    :return: Dict of vendor name to build task id
+    """
+    vendors = args.build_to_test_vendors
+    logging.info(f"Starting Build to Test of app {app_id} for {len(vendors)} vendors: {', '.join(vendors)}")
+    poller = StatusPoller(args.api_key, args.team_id)
+    jobs = {vendor: partial(_run_build_to_test_vendor, args, platform, app_id, fusion_set_id, vendor, poller)
+            for vendor in vendors}
+    return _fan_out('Build to Test vendor', jobs, args.fan_out_workers)
+
+
+def main(argv=None, job=None):
+    """
+    :param argv: Command line arguments, default is sys.argv
+    :param job: JobLease of the queued job running the pipeline (see job_queue.py), whose task ids are recorded in
+        the queue and re-attached by later attempts
+    """
+    args = parse_arguments(argv)
+    args.job = job
+    platform, fusion_set_id = validate_args(args)
 
-    if args.output:
-        _download_file(args.api_key, args.team_id, task_id, args.output, download)
-    if _get_obfuscation_map_status(args.api_key, args.team_id, task_id):
-        download_action(args.api_key, args.team_id, task_id, args.deobfuscation_script_output, 'deobfuscation_script')
-        if args.deobfuscation_script_output and (args.datadog_api_key or args.firebase_app_id):
-            upload_mapping_file(deobfuscation_mapping_file=args.deobfuscation_script_output,
-                                fire_base_app_id=args.firebase_app_id, data_dog_api_key=args.datadog_api_key)
-    if not args.auto_dev_private_signing:
-        download_action(args.api_key, args.team_id, task_id, args.sign_second_output, 'sign_second_output')
-    if args.certificate_output:
-        _download_file(args.api_key, args.team_id, task_id, args.certificate_output, download_certified_secure)
-    if args.certificate_json:
-        _download_file(args.api_key, args.team_id, task_id, args.certificate_json, download_certified_secure_json)
-        format_json_file(args.certificate_json)
+    profiler = args.profiler
+    build_run = args.build_run
+    status = 'failed'
+    try:
+        _run_pipeline(args, platform, fusion_set_id)
+        status = 'succeeded'
+    finally:
+        profiler.report()
+        if build_run:
+            build_run.finish(status)
+            build_run.history.close()
+
+
+def _run_pipeline(args, platform, fusion_set_id):
+    app_id = args.app_id or _attached_task(args, 'upload')
+    if not app_id:
+        with _phase(args, 'upload'):
+            app_id = _upload(args.api_key, args.team_id, args.app, args.direct_upload, args.stream_upload,
+                             args.app_name, args.stream_idle_sec, args.build_run)
+        _record_task(args, 'upload', app_id)
+
+    if args.build_to_test_vendors:
+        try:
+            _build_to_test_fan_out(args, platform, app_id, fusion_set_id)
+        finally:
+            if args.manifest:
+                args.manifest.write()
+        return
+
+    log_follower = init_workflow_log_follower(args)
+    try:
+        attached_task_id = _attached_task(args, 'build')
+        with _phase(args, 'build'):
+            if attached_task_id:
+                _record_task(args, 'build', attached_task_id)
+                task_id = _reattach(args, attached_task_id, 'build', log_follower)
+            else:
+                task_id = _build(args.api_key, args.team_id, app_id, fusion_set_id, args.build_overrides,
+                                 args.diagnostic_logs, args.build_to_test_vendor,
+                                 cert_pinning_zip=args.cert_pinning_zip, args=args, log_follower=log_follower,
+                                 record_kind='build')
+
+        if not args.context_variants:
+            with _phase(args, 'context'):
+                _context(args.api_key, args.team_id, task_id, new_bundle_id=args.new_bundle_id,
+                         new_version=args.new_version, new_build_num=args.new_build_num,
+                         new_display_name=args.new_display_name, app_icon=args.app_icon,
+                         icon_overlay=args.icon_overlay, log_follower=log_follower)
+
+            if not args.sign_configs:
+                with _phase(args, 'sign'):
+                    _sign(args, platform, task_id, args.sign_overrides, log_follower=log_follower)
+    finally:
+        if log_follower:
+            log_follower.close()
+
+    try:
+        if args.context_variants:
+            _context_fan_out(args, platform, task_id, args.context_variants)
+        elif args.sign_configs:
+            _sign_fan_out(args.sign_configs, platform, task_id, _output_paths(args), args.fan_out_workers,
+                          args.workflow_output_logs)
+        else:
+            _download_outputs(args, task_id, **_output_paths(args))
+    finally:
+        if args.manifest:
+            args.manifest.write()
 
 
 if __name__ == '__main__':
@@ -8,10 +8,13 @@ from private_sign import private_sign_ios
 from sign import sign_ios
 from status import wait_for_status_complete
 from certified_secure import download_certified_secure
-from certified_secure_json import download_certified_secure_json, format_json_file
+from certified_secure_json import download_certified_secure_json
 from download import download
+from post_processors import JsonFormatter
+from log_follower import add_workflow_logs_args, init_workflow_log_follower
 from utils import (log_and_exit, add_common_args, init_common_args, validate_output_path,
                    validate_response, ios_p12, ios_p12_password)
+from models import response_json
 
 
 class Platform(Enum):
@@ -51,8 +54,7 @@ def parse_arguments():
                         help='Output file for Certified Secure pdf')
     parser.add_argument('-cj', '--certificate_json', metavar='certificate_json_output_file',
                         help='Output file for Certified Secure json')
-    parser.add_argument('-wol', '--workflow_output_logs', metavar='workflow_output_logs',
-                        help='Enter path to a workflow output logs file (optional)')
+    add_workflow_logs_args(parser)
     return parser.parse_args()
 
 
@@ -83,7 +85,7 @@ def validate_args(args):
     return platform, fusion_set_id
 
 
-def _sign(args, platform, task_id, workflow_output_logs=None):
+def _sign(args, platform, task_id, workflow_output_logs=None, log_follower=None):
     if platform == Platform.IOS:
         if args.keystore:
             r = sign_ios(args.api_key, args.team_id, task_id, ios_p12(args), ios_p12_password(args),
@@ -91,9 +93,9 @@ def _sign(args, platform, task_id, workflow_output_logs=None):
         else:
             r = private_sign_ios(args.api_key, args.team_id, task_id, provisioning_profiles_paths=[])
         validate_response(r)
-        logging.info(f"Signing request started. Response: {r.json()}")
+        logging.info(f"Signing request started. Response: {response_json(r)}")
         wait_for_status_complete(args.api_key, args.team_id, task_id, operation="sign",
-                                 workflow_output_logs_path=workflow_output_logs)
+                                 workflow_output_logs_path=workflow_output_logs, log_follower=log_follower)
         logging.info(f"Signing request finished.")
 
 
@@ -101,16 +103,21 @@ def main():
     args = parse_arguments()
     platform, fusion_set_id = validate_args(args)
     app_id = _upload(args.api_key, args.team_id, args.app, args.direct_upload) if args.app else args.app_id
-    task_id = _build(args.api_key, args.team_id, app_id, fusion_set_id, args.build_overrides, args.diagnostic_logs,
-                     None, args.workflow_output_logs)
-    _sign(args, platform, task_id, args.workflow_output_logs)
+    log_follower = init_workflow_log_follower(args)
+    try:
+        task_id = _build(args.api_key, args.team_id, app_id, fusion_set_id, args.build_overrides, args.diagnostic_logs,
+                         None, log_follower=log_follower)
+        _sign(args, platform, task_id, log_follower=log_follower)
+    finally:
+        if log_follower:
+            log_follower.close()
     if args.output:
         _download_file(args.api_key, args.team_id, task_id, args.output, download)
     if args.certificate_output:
         _download_file(args.api_key, args.team_id, task_id, args.certificate_output, download_certified_secure)
     if args.certificate_json:
-        _download_file(args.api_key, args.team_id, task_id, args.certificate_json, download_certified_secure_json)
-        format_json_file(args.certificate_json)
+        _download_file(args.api_key, args.team_id, task_id, args.certificate_json, download_certified_secure_json,
+                       processors=[JsonFormatter()])
 
 
 if __name__ == '__main__':
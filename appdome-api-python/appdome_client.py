@@ -0,0 +1,340 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from artifact_stream import stream_to_file
+from auto_dev_sign import auto_dev_sign_android, auto_dev_sign_ios
+from build import build
+from build_to_test import build_to_test, init_automation_vendor
+from certified_secure import download_certified_secure
+from certified_secure_json import download_certified_secure_json
+from context import context
+from direct_upload import direct_upload
+from download import download
+from log_follower import WorkflowLogFollower
+from models import parse_task, parse_upload, response_json
+from post_processors import json_processors
+from private_sign import private_sign_android, private_sign_ios
+from sign import sign_android, sign_ios
+from status import wait_for_status_complete, status, _get_obfuscation_map_status
+from stream_upload import stream_upload
+from upload import upload
+from utils import (validate_response, validate_output_path, init_build_files, init_certs_pinning, TASKS_URL,
+                   AppdomeError, http2_transport)
+from validate import validate_app
+
+
+def _resolve(value):
+    """Values passed to the client methods may be futures returned by previous calls."""
+    return value.result() if isinstance(value, Future) else value
+
+
+def _failed_dependency(dependencies):
+    for dependency in dependencies:
+        if not dependency.cancelled() and dependency.exception() is not None:
+            return dependency.exception()
+    return None
+
+
+class AppdomeClient:
+    """
+    Programmatic Appdome API client.
+
+    Every pipeline step returns a concurrent.futures.Future, so steps can be chained (a step accepts the futures of
+    previous steps as its inputs) and pipelines can run in parallel on a shared executor. A step is handed to the
+    executor only once its inputs are done, so waiting steps never hold a worker. Failures are raised from
+    Future.result() as AppdomeError subclasses (AppdomeApiError, AppdomeTaskError, AppdomeTimeoutError).
+
+    Example:
+        with AppdomeClient(api_key, team_id) as client:
+            task_id = client.build(client.upload('app.apk'), fusion_set_id)
+            signed = client.sign_android(task_id, 'release.keystore', keystore_pass, key_alias, key_pass)
+            client.download(signed, 'out/app.apk').result()
+    """
+    def __init__(self, api_key, team_id=None, executor=None, max_workers=8, status_interval_sec=10,
+                 status_timeout_sec=3600, workflow_output_logs=None, http2=None, completion_receiver=None):
+        """
+        :param api_key: Appdome API key
+        :param team_id: Appdome team id (optional)
+        :param executor: Executor to run the steps on. Default is a thread pool owned by the client
+        :param max_workers: Size of the owned thread pool
+        :param status_interval_sec: Task status polling interval
+        :param status_timeout_sec: Timeout of every task phase
+        :param workflow_output_logs: Path to a workflow output logs file (optional)
+        :param http2: Send the API requests over HTTP/2 (requires httpx[http2]). Default is the APPDOME_HTTP2 variable
+        :param completion_receiver: completion_receiver.CompletionReceiver to wait for task callbacks instead of
+            polling (optional)
+        """
+        if not api_key:
+            raise AppdomeError("api_key must be specified")
+        self.api_key = api_key
+        self.team_id = team_id
+        self.status_interval_sec = status_interval_sec
+        self.status_timeout_sec = status_timeout_sec
+        self.completion_receiver = completion_receiver
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='appdome')
+        self._log_follower = WorkflowLogFollower(workflow_output_logs, echo=False) if workflow_output_logs else None
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        if http2 is not None:
+            http2_transport(http2)
+
+    def close(self):
+        # Steps waiting for their inputs are not in the executor yet, and are submitted as their inputs complete
+        while True:
+            with self._pending_lock:
+                pending = list(self._pending)
+            if not pending:
+                break
+            wait(pending)
+        if self._owns_executor:
+            self.executor.shutdown(wait=True)
+        if self._log_follower:
+            self._log_follower.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _submit(self, func, *args, **kwargs):
+        """
+        Runs a step on the executor once the futures among its arguments are done. A step whose input failed fails
+        with the same error without running.
+
+        :return: Future of the step result
+        """
+        dependencies = [value for value in (*args, *kwargs.values()) if isinstance(value, Future)]
+        result = Future()
+        with self._pending_lock:
+            self._pending.add(result)
+        result.add_done_callback(self._forget)
+
+        def run():
+            if not result.set_running_or_notify_cancel():
+                return
+            try:
+                value = func(*[_resolve(arg) for arg in args],
+                             **{key: _resolve(value) for key, value in kwargs.items()})
+            except BaseException as e:
+                result.set_exception(e)
+            else:
+                result.set_result(value)
+
+        def start():
+            error = _failed_dependency(dependencies)
+            if error is not None:
+                if result.set_running_or_notify_cancel():
+                    result.set_exception(error)
+                return
+            try:
+                self.executor.submit(run)
+            except RuntimeError as e:  # The executor was shut down
+                if result.set_running_or_notify_cancel():
+                    result.set_exception(e)
+
+        remaining = [len(dependencies)]
+        lock = threading.Lock()
+
+        def dependency_done(_):
+            with lock:
+                remaining[0] -= 1
+                ready = not remaining[0]
+            if ready:
+                start()
+
+        if not dependencies:
+            start()
+        for dependency in dependencies:
+            dependency.add_done_callback(dependency_done)
+        return result
+
+    def _forget(self, future):
+        with self._pending_lock:
+            self._pending.discard(future)
+
+    def _wait(self, task_id, operation):
+        wait_for_status_complete(self.api_key, self.team_id, task_id, interval_sec=self.status_interval_sec,
+                                 timeout_sec=self.status_timeout_sec, operation=operation,
+                                 log_follower=self._log_follower, completion_receiver=self.completion_receiver)
+
+    def _run_task_action(self, operation, task_id, response):
+        validate_response(response)
+        action_task_id = parse_task(response).task_id or task_id
+        logging.info(f"{operation.capitalize()} request started. Task id: {action_task_id}")
+        self._wait(action_task_id, operation)
+        return action_task_id
+
+    # Upload
+
+    def _upload(self, app_path, direct=False, stream=False, app_name=None):
+        if stream:
+            response = stream_upload(self.api_key, self.team_id, app_path, app_name, direct)
+        else:
+            response = (direct_upload if direct else upload)(self.api_key, self.team_id, app_path)
+        validate_response(response)
+        return parse_upload(response).id
+
+    def upload(self, app_path, direct=False, stream=False, app_name=None):
+        """
+        :param app_path: Path to the apk/aab/ipa file
+        :param direct: Upload directly to Appdome instead of through a pre-signed url
+        :param stream: Upload the app while it is being written: '-' for stdin, a named pipe, or an app file still
+            being written
+        :param app_name: App file name on Appdome when streaming, required for stdin
+        :return: Future of the app id
+        """
+        return self._submit(self._upload, app_path, direct, stream, app_name)
+
+    # Build
+
+    def _build(self, app_id, fusion_set_id, overrides=None, diagnostic_logs=False, build_to_test_vendor=None,
+               build_files=None, cert_pinning_zip=None):
+        files = init_certs_pinning(cert_pinning_zip)
+        init_build_files(build_files, files)
+        try:
+            if build_to_test_vendor:
+                response = build_to_test(self.api_key, self.team_id, app_id, fusion_set_id,
+                                         init_automation_vendor(build_to_test_vendor).name,
+                                         overrides=dict(overrides or {}), use_diagnostic_logs=diagnostic_logs,
+                                         files=files)
+            else:
+                response = build(self.api_key, self.team_id, app_id, fusion_set_id, dict(overrides or {}),
+                                 diagnostic_logs, files=files)
+        finally:
+            for _, file_spec in files:
+                file_spec[1].close()
+        validate_response(response)
+        task_id = parse_task(response).task_id
+        logging.info(f"Build request started. Task id: {task_id}")
+        self._wait(task_id, 'build')
+        return task_id
+
+    def build(self, app_id, fusion_set_id, overrides=None, diagnostic_logs=False, build_to_test_vendor=None,
+              build_files=None, cert_pinning_zip=None):
+        """
+        :param app_id: App id (or future of it)
+        :param fusion_set_id: Fusion set id
+        :param overrides: Build overrides dict
+        :param diagnostic_logs: Build with Diagnostic Logs
+        :param build_to_test_vendor: Build to Test vendor name (optional)
+        :param build_files: Dict of build file key (baseline_profile, input_mapping, startup_profile) to path
+        :param cert_pinning_zip: Path to zip file with dynamic certificates for certificate pinning
+        :return: Future of the fused task id, resolved once the build completed
+        """
+        return self._submit(self._build, app_id, fusion_set_id, overrides, diagnostic_logs, build_to_test_vendor,
+                            build_files, cert_pinning_zip)
+
+    # Context
+
+    def _context(self, task_id, new_bundle_id=None, new_version=None, new_build_num=None, new_display_name=None,
+                 app_icon=None, icon_overlay=None, context_overrides=None):
+        response = context(self.api_key, self.team_id, task_id, new_bundle_id, new_version, new_build_num,
+                           new_display_name, app_icon, icon_overlay, context_overrides)
+        return self._run_task_action('context', task_id, response)
+
+    def context(self, task_id, new_bundle_id=None, new_version=None, new_build_num=None, new_display_name=None,
+                app_icon=None, icon_overlay=None, context_overrides=None):
+        """
+        :return: Future of the context task id, resolved once the context completed
+        """
+        return self._submit(self._context, task_id, new_bundle_id, new_version, new_build_num, new_display_name,
+                            app_icon, icon_overlay, context_overrides)
+
+    # Sign
+
+    def _sign(self, sign_func, task_id, *args):
+        return self._run_task_action('sign', task_id, sign_func(self.api_key, self.team_id, task_id, *args))
+
+    def sign_android(self, task_id, keystore_path, keystore_pass, key_alias, key_pass,
+                     google_play_signing_fingerprint=None, sign_overrides=None,
+                     google_play_signing_fingerprint_upgrade=None, trusted_signing_fingerprint_list=None):
+        """
+        :return: Future of the signing task id, resolved once signing completed
+        """
+        return self._submit(self._sign, sign_android, task_id, keystore_path, keystore_pass, key_alias, key_pass,
+                            google_play_signing_fingerprint, sign_overrides, google_play_signing_fingerprint_upgrade,
+                            trusted_signing_fingerprint_list)
+
+    def private_sign_android(self, task_id, signing_fingerprint=None, is_google_play_signing=False,
+                             sign_overrides=None, signing_fingerprint_upgrade=None,
+                             trusted_signing_fingerprint_list=None):
+        return self._submit(self._sign, private_sign_android, task_id, signing_fingerprint, is_google_play_signing,
+                            sign_overrides, signing_fingerprint_upgrade, trusted_signing_fingerprint_list)
+
+    def auto_dev_sign_android(self, task_id, signing_fingerprint=None, is_google_play_signing=False,
+                              sign_overrides=None, signing_fingerprint_upgrade=None,
+                              trusted_signing_fingerprint_list=None):
+        return self._submit(self._sign, auto_dev_sign_android, task_id, signing_fingerprint, is_google_play_signing,
+                            sign_overrides, signing_fingerprint_upgrade, trusted_signing_fingerprint_list)
+
+    def sign_ios(self, task_id, keystore_p12_path, keystore_pass, provisioning_profiles_paths,
+                 entitlements_paths=None, sign_overrides=None):
+        return self._submit(self._sign, sign_ios, task_id, keystore_p12_path, keystore_pass,
+                            provisioning_profiles_paths, entitlements_paths, sign_overrides)
+
+    def private_sign_ios(self, task_id, provisioning_profiles_paths, sign_overrides=None):
+        return self._submit(self._sign, private_sign_ios, task_id, provisioning_profiles_paths, sign_overrides)
+
+    def auto_dev_sign_ios(self, task_id, provisioning_profiles_paths, entitlements_paths=None, sign_overrides=None):
+        return self._submit(self._sign, auto_dev_sign_ios, task_id, provisioning_profiles_paths, entitlements_paths,
+                            sign_overrides)
+
+    # Download
+
+    def _download(self, task_id, output_path, download_func, optional=False, processors=None):
+        validate_output_path(output_path)
+        response = download_func(self.api_key, self.team_id, task_id, stream=True)
+        if optional and response.status_code == 404:
+            response.close()
+            return None
+        validate_response(response)
+        stream_to_file(response, output_path, processors=processors)
+        logging.info(f"File written to {output_path}")
+        return output_path
+
+    def download(self, task_id, output_path, action=None, processors=None):
+        """
+        :param task_id: Task id (or future of it)
+        :param output_path: Output file path
+        :param action: None for the main output, 'sign_second_output' or 'deobfuscation_script'
+        :param processors: post_processors.StreamProcessor chain applied while downloading, e.g. [ZipProcessor()]
+        :return: Future of the output path. Resolves to None when an optional output does not exist
+        """
+        def download_func(api_key, team_id, task_id_value, stream=False):
+            return download(api_key, team_id, task_id_value, action, stream)
+        return self._submit(self._download, task_id, output_path, download_func, action is not None, processors)
+
+    def download_certificate(self, task_id, output_path):
+        return self._submit(self._download, task_id, output_path, download_certified_secure)
+
+    def download_certificate_json(self, task_id, output_path, json_format='pretty'):
+        """
+        :param json_format: 'pretty', 'compact' or 'raw'
+        """
+        return self._submit(self._download, task_id, output_path, download_certified_secure_json, False,
+                            json_processors(json_format))
+
+    # Queries
+
+    def task_status(self, task_id):
+        """
+        :return: Future of the task status json
+        """
+        def get_status(task_id_value):
+            response = status(self.api_key, self.team_id, task_id_value, TASKS_URL)
+            validate_response(response)
+            return response_json(response)
+        return self._submit(get_status, task_id)
+
+    def obfuscation_map_exists(self, task_id):
+        return self._submit(lambda task_id_value: bool(_get_obfuscation_map_status(self.api_key, self.team_id,
+                                                                                  task_id_value)), task_id)
+
+    def validate(self, app_path):
+        """
+        :return: Future of the validation status json of a locally signed app
+        """
+        return self._submit(lambda app_path_value: response_json(validate_app(self.api_key, app_path_value)), app_path)
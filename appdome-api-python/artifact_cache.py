@@ -0,0 +1,327 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from os import getenv
+
+from artifact_stream import stream_to_file, CHUNK_SIZE, _run_processors, _finish_processors, _abort_processors
+from file_lock import file_lock
+from utils import validate_response, validate_output_path, SERVER_BASE_URL
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+ARTIFACT_CACHE_ENV = 'APPDOME_ARTIFACT_CACHE'
+ARTIFACT_CACHE_MAX_MB_ENV = 'APPDOME_ARTIFACT_CACHE_MAX_MB'
+DEFAULT_MAX_SIZE_MB = 5 * 1024
+FICLONE = 0x40049409  # Linux ioctl cloning a file on copy-on-write filesystems (btrfs, xfs)
+
+
+def _reflink(source_path, target_path):
+    if not fcntl or not hasattr(fcntl, 'ioctl'):
+        return False
+    try:
+        with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        return True
+    except OSError:
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        return False
+
+
+def _temp_path(target_path, suffix):
+    return f"{target_path}.{os.getpid()}.{threading.get_ident()}.{suffix}"
+
+
+def link_file(source_path, target_path, copy=True):
+    """
+    Places source_path at target_path without copying its bytes when the filesystem allows it: a hardlink, then a
+    reflink, and a copy otherwise. An existing target is replaced atomically.
+
+    :param copy: Copy the file when it cannot be linked
+    :return: 'hardlink', 'reflink' or 'copy', None when the file could not be linked and copy is False
+    """
+    temp_path = _temp_path(target_path, 'link')
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(source_path, temp_path)
+        method = 'hardlink'
+    except OSError:
+        if _reflink(source_path, temp_path):
+            method = 'reflink'
+        elif not copy:
+            return None
+        else:
+            shutil.copyfile(source_path, temp_path)
+            method = 'copy'
+    os.replace(temp_path, target_path)
+    return method
+
+
+def copy_file(source, target_path):
+    """
+    Copies an open file to target_path, replacing an existing target atomically.
+    """
+    temp_path = _temp_path(target_path, 'link')
+    try:
+        with open(temp_path, 'wb') as f:
+            shutil.copyfileobj(source, f, CHUNK_SIZE)
+        os.replace(temp_path, target_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class ArtifactCache:
+    """
+    Local content cache of downloaded artifacts, keyed on server, team, task id, kind (output, deobfuscation_script,
+    sign_second_output, certificate, certificate-json) and the processing variant. Cached artifacts are revalidated
+    with If-None-Match/If-Modified-Since and linked into the output path on 304 Not Modified. Artifacts the server
+    sends without an ETag or Last-Modified header cannot be revalidated and are not cached.
+
+    The blobs are named by their sha256, and the index is changed under a file lock, so concurrent jobs on the host
+    can share one cache directory. Copies between filesystems are made outside of the lock. The least recently used
+    artifacts are evicted beyond max_size_mb.
+    """
+    def __init__(self, cache_dir, max_size_mb=DEFAULT_MAX_SIZE_MB):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.blobs_dir = os.path.join(cache_dir, 'blobs')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock_path = os.path.join(cache_dir, '.lock')
+        os.makedirs(self.blobs_dir, exist_ok=True)
+
+    @staticmethod
+    def key(server_url, team_id, task_id, kind, variant=None):
+        return hashlib.sha256(f"{server_url}|{team_id or ''}|{task_id}|{kind}|{variant or ''}"
+                              .encode('utf-8')).hexdigest()
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.blobs_dir, sha256)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logging.warning(f"Ignoring invalid artifact cache index {self.index_path}")
+            return {}
+        return index if isinstance(index, dict) else {}
+
+    def _write_index(self, index):
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(temp_path, self.index_path)
+
+    def _valid_blob(self, entry):
+        """
+        Outputs are hardlinked to their blob, so a blob changed in place through an output no longer matches the
+        size and mtime recorded when it was cached.
+        """
+        try:
+            stat = os.stat(self._blob_path(entry['sha256']))
+        except OSError:
+            return False
+        return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']
+
+    def lookup(self, key):
+        """
+        :return: Index entry of a valid cached artifact, or None
+        """
+        with file_lock(self.lock_path):
+            index = self._read_index()
+            entry = index.get(key)
+            if entry and not self._valid_blob(entry):
+                del index[key]
+                self._remove_unreferenced(index, entry['sha256'])
+                self._write_index(index)
+                return None
+            return entry
+
+    def link_cached(self, key, output_path):
+        """
+        Links a cached artifact into the output path, unless it was evicted since it was looked up.
+
+        :return: Index entry of the linked artifact with the link 'method', or None
+        """
+        with file_lock(self.lock_path):
+            index = self._read_index()
+            entry = index.get(key)
+            if not entry or not self._valid_blob(entry):
+                return None
+            blob_path = self._blob_path(entry['sha256'])
+            method = link_file(blob_path, output_path, copy=False)
+            # An open blob stays readable when another job evicts it during the copy
+            blob = open(blob_path, 'rb') if not method else None
+            entry['last_used'] = time.time()
+            self._write_index(index)
+        if blob:
+            with blob:
+                copy_file(blob, output_path)
+            method = 'copy'
+        return dict(entry, method=method)
+
+    def store(self, key, path, digest, etag, last_modified):
+        """
+        Adds a downloaded artifact to the cache, linking it rather than copying when possible.
+        """
+        blob_path = self._blob_path(digest['sha256'])
+        # The blob is staged outside of the lock, as it is a copy when the cache is on another filesystem
+        staged_path = None
+        if not os.path.exists(blob_path):
+            staged_path = _temp_path(blob_path, 'staged')
+            link_file(path, staged_path)
+        try:
+            with file_lock(self.lock_path):
+                index = self._read_index()
+                if not os.path.exists(blob_path):
+                    if not staged_path:
+                        logging.debug(f"Cached artifact {digest['sha256']} was evicted while it was stored")
+                        return
+                    os.replace(staged_path, blob_path)
+                stat = os.stat(blob_path)
+                index[key] = {'sha256': digest['sha256'], 'size': digest['size'], 'mtime_ns': stat.st_mtime_ns,
+                              'etag': etag, 'last_modified': last_modified, 'last_used': time.time()}
+                self._evict(index)
+                self._write_index(index)
+        finally:
+            if staged_path and os.path.exists(staged_path):
+                os.remove(staged_path)
+
+    def _remove_unreferenced(self, index, sha256):
+        if not any(entry['sha256'] == sha256 for entry in index.values()):
+            try:
+                os.remove(self._blob_path(sha256))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _evict(self, index):
+        sizes = {entry['sha256']: entry['size'] for entry in index.values()}
+        total = sum(sizes.values())
+        for key, entry in sorted(index.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_size:
+                break
+            del index[key]
+            if not any(other['sha256'] == entry['sha256'] for other in index.values()):
+                total -= entry['size']
+                self._remove_unreferenced(index, entry['sha256'])
+            logging.debug(f"Evicted cached artifact {entry['sha256']}")
+
+    def fetch(self, key, request_func, output_path, processors=None, missing_ok=False):
+        """
+        Downloads an artifact through the cache.
+
+        :param key: Cache key, see cache_key
+        :param request_func: Callable sending the download request with stream=True, given extra request headers
+        :param processors: Download post-processing chain (see stream_to_file). On a cache hit the stages read the
+            cached artifact, for their checks and side effects
+        :param missing_ok: Return None instead of failing when the server has no such artifact (404)
+        :return: stream_to_file result with 'cached' True when the output was taken from the cache
+        """
+        processors = processors or []
+        entry = self.lookup(key)
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        response = request_func(headers)
+        if entry and response.status_code == 304:
+            response.close()
+            entry = self.link_cached(key, output_path)
+            if entry:
+                logging.info(f"{output_path} not modified, taken from the artifact cache ({entry['method']})")
+                digest = {'size': entry['size'], 'sha256': entry['sha256'], 'cached': True}
+                digest.update(self._replay(output_path, processors))
+                return digest
+            response = request_func({})
+        if missing_ok and response.status_code == 404:
+            response.close()
+            return None
+        validate_response(response)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        digest = stream_to_file(response, output_path, processors=processors)
+        if etag or last_modified:
+            self.store(key, output_path, digest, etag, last_modified)
+        digest['cached'] = False
+        return digest
+
+    @staticmethod
+    def _replay(path, processors):
+        if not processors:
+            return {}
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    _run_processors(processors, chunk)
+            _finish_processors(processors, lambda tail: None)
+        except BaseException:
+            _abort_processors(processors)
+            raise
+        results = {}
+        for processor in processors:
+            result = processor.result()
+            if result is not None:
+                results[processor.name] = result
+        return results
+
+
+def cache_key(team_id, task_id, kind, processors=None):
+    """
+    :param kind: Artifact kind, e.g. 'output' or 'certificate-json'
+    :param processors: Download post-processing chain, whose stages that change the bytes are part of the key
+    """
+    variants = [processor.variant() for processor in processors or [] if processor.variant()]
+    return ArtifactCache.key(SERVER_BASE_URL, team_id, task_id, kind, ','.join(variants))
+
+
+def fetch_artifact(cache, team_id, task_id, kind, request_func, output_path, processors=None, missing_ok=False):
+    """
+    Downloads an artifact through the cache when there is one, otherwise directly.
+
+    :param cache: ArtifactCache or None
+    :param kind: Artifact kind, e.g. 'output' or 'certificate-json'
+    :param request_func: Callable sending the download request with stream=True, given extra request headers
+    :return: stream_to_file result, or None for a missing artifact with missing_ok
+    """
+    if cache:
+        return cache.fetch(cache_key(team_id, task_id, kind, processors), request_func, output_path, processors,
+                           missing_ok)
+    response = request_func({})
+    if missing_ok and response.status_code == 404:
+        response.close()
+        return None
+    validate_response(response)
+    return stream_to_file(response, output_path, processors=processors)
+
+
+def add_artifact_cache_args(parser):
+    parser.add_argument('--cache_dir', metavar='cache_directory', default=getenv(ARTIFACT_CACHE_ENV),
+                        help='Local cache of the downloaded artifacts, revalidated with the server and shared by the '
+                             f'jobs on the host. Default is environment variable \'{ARTIFACT_CACHE_ENV}\'')
+    parser.add_argument('--cache_max_mb', type=float,
+                        default=float(getenv(ARTIFACT_CACHE_MAX_MB_ENV, DEFAULT_MAX_SIZE_MB)),
+                        help=f'Maximum size of the artifact cache in MB. Default is {DEFAULT_MAX_SIZE_MB}')
+
+
+def init_artifact_cache(args):
+    """
+    :return: ArtifactCache when --cache_dir was given, otherwise None
+    """
+    if not args.cache_dir:
+        return None
+    validate_output_path(os.path.join(args.cache_dir, 'index.json'))
+    return ArtifactCache(args.cache_dir, args.cache_max_mb)
@@ -0,0 +1,211 @@
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+
+from utils import log_and_exit, add_metric, AppdomeIntegrityError
+
+CHUNK_SIZE = 1024 * 1024
+MANIFEST_VERSION = 1
+
+
+def file_sha256(path, chunk_size=CHUNK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _b64_to_hex(value):
+    try:
+        return binascii.hexlify(base64.b64decode(value)).decode('ascii')
+    except (binascii.Error, ValueError):
+        return None
+
+
+def expected_digests(headers):
+    """
+    Collects the checksums the server sent with a response.
+
+    :param headers: Response headers
+    :return: Dict of algorithm ('sha256' or 'md5') to lower case hex digest
+    """
+    expected = {}
+    if headers.get('X-Checksum-Sha256'):
+        expected['sha256'] = headers['X-Checksum-Sha256'].strip().lower()
+    elif headers.get('x-amz-checksum-sha256'):
+        expected['sha256'] = _b64_to_hex(headers['x-amz-checksum-sha256'].strip())
+    for digest in headers.get('Digest', '').split(','):
+        algorithm, _, value = digest.strip().partition('=')
+        if algorithm.lower() == 'sha-256' and value and 'sha256' not in expected:
+            expected['sha256'] = _b64_to_hex(value)
+    if headers.get('Content-MD5'):
+        expected['md5'] = _b64_to_hex(headers['Content-MD5'].strip())
+    return {algorithm: value for algorithm, value in expected.items() if value}
+
+
+def _expected_length(headers):
+    if headers.get('Content-Encoding', 'identity').lower() != 'identity':
+        return None  # Content-Length is the size of the encoded body
+    try:
+        return int(headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+
+
+class HashingWriter:
+    """
+    File object wrapper that computes the size and SHA-256 of everything written through it.
+    """
+    def __init__(self, f):
+        self._f = f
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        chunk = data.encode('utf-8') if isinstance(data, str) else data
+        self._f.write(chunk)
+        self._sha256.update(chunk)
+        self.size += len(chunk)
+
+    def digest(self):
+        return {'size': self.size, 'sha256': self._sha256.hexdigest()}
+
+
+def _run_processors(processors, chunk, start=0):
+    for processor in processors[start:]:
+        if not chunk:
+            break
+        chunk = processor.process(chunk)
+    return chunk
+
+
+def _finish_processors(processors, write):
+    for index, processor in enumerate(processors):
+        tail = _run_processors(processors, processor.finish(), index + 1)
+        if tail:
+            write(tail)
+
+
+def _abort_processors(processors):
+    for processor in processors:
+        try:
+            processor.abort()
+        except Exception as e:
+            logging.warning(f"Could not abort download stage {processor.name}: {e}")
+
+
+def stream_to_file(response, output_path, chunk_size=CHUNK_SIZE, processors=None):
+    """
+    Streams a response body to a file, computing its digests while the bytes arrive. The body is checked against
+    the Content-Length and any checksum the server sent before the file is moved into place.
+
+    :param response: Response opened with stream=True
+    :param output_path: Output file path
+    :param chunk_size: Read chunk size in bytes
+    :param processors: Chain of post_processors.StreamProcessor the body passes through on its way to the file
+    :return: Dict with the written 'size' and 'sha256', and the result of every processor under its name
+    """
+    processors = processors or []
+    expected = expected_digests(response.headers)
+    expected_length = _expected_length(response.headers)
+    hashers = {algorithm: hashlib.new(algorithm) for algorithm in expected}
+    temp_path = output_path + '.part'
+    received = 0
+    try:
+        with open(temp_path, 'wb') as f:
+            writer = HashingWriter(f)
+            for chunk in response.iter_content(chunk_size):
+                received += len(chunk)
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+                chunk = _run_processors(processors, chunk)
+                if chunk:
+                    writer.write(chunk)
+            if expected_length is not None and received != expected_length:
+                log_and_exit(f"Downloaded {output_path} has {received} bytes, server sent Content-Length "
+                             f"{expected_length}", AppdomeIntegrityError)
+            for algorithm, expected_digest in expected.items():
+                if hashers[algorithm].hexdigest() != expected_digest:
+                    log_and_exit(f"Downloaded {output_path} {algorithm} {hashers[algorithm].hexdigest()} does not "
+                                 f"match the server checksum {expected_digest}", AppdomeIntegrityError)
+            _finish_processors(processors, writer.write)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        _abort_processors(processors)
+        raise
+    finally:
+        add_metric('bytes', received)
+        response.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    digest = writer.digest()
+    for processor in processors:
+        result = processor.result()
+        if result is not None:
+            digest[processor.name] = result
+    return digest
+
+
+class ArtifactManifest:
+    """
+    Manifest of the produced artifacts (path, size, sha256, task id and timing), so later steps and resumed runs
+    can trust the outputs without reading them again. Safe to share between concurrent downloads.
+    """
+    def __init__(self, path):
+        """
+        :param path: Manifest json file path. Entries of an existing manifest are kept
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._artifacts = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self._artifacts = {entry['path']: entry for entry in json.load(f).get('artifacts', [])}
+            except (ValueError, KeyError, AttributeError) as e:
+                logging.warning(f"Ignoring unreadable artifact manifest {path}: {e}")
+
+    def add(self, artifact_path, size, sha256, task_id=None, kind=None, started=None, finished=None, **details):
+        """
+        Records an artifact. Timing arguments are epoch seconds, details are post-processing results.
+        """
+        stat = os.stat(artifact_path)
+        entry = {'path': artifact_path, 'size': size, 'sha256': sha256, 'task_id': task_id, 'kind': kind,
+                 'mtime_ns': stat.st_mtime_ns}
+        entry.update(details)
+        if started is not None and finished is not None:
+            entry['started'] = datetime.fromtimestamp(started, timezone.utc).isoformat()
+            entry['finished'] = datetime.fromtimestamp(finished, timezone.utc).isoformat()
+            entry['duration_sec'] = round(finished - started, 3)
+        with self._lock:
+            self._artifacts[artifact_path] = entry
+
+    def get(self, artifact_path):
+        with self._lock:
+            return self._artifacts.get(artifact_path)
+
+    def is_current(self, artifact_path):
+        """
+        :return: True when the artifact on disk still has the recorded size and modification time
+        """
+        entry = self.get(artifact_path)
+        if not entry or not os.path.exists(artifact_path):
+            return False
+        stat = os.stat(artifact_path)
+        return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']
+
+    def write(self):
+        with self._lock:
+            manifest = {'version': MANIFEST_VERSION, 'updated': datetime.now(timezone.utc).isoformat(),
+                        'artifacts': sorted(self._artifacts.values(), key=lambda entry: entry['path'])}
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(temp_path, self.path)
+        logging.info(f"Artifact manifest written to {self.path}")
@@ -0,0 +1,371 @@
+import base64
+import hashlib
+import logging
+import os
+import queue
+import threading
+from abc import ABC, abstractmethod
+from os import getenv
+from os.path import basename, join
+from urllib.parse import urlparse
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+from post_processors import StreamProcessor
+from utils import log_and_exit, validate_output_path, AppdomePublishError
+
+TEE_ENV = 'APPDOME_TEE'
+S3_SCHEMES = ('s3', 's3+http', 's3+https')
+S3_PART_SIZE = 8 * 1024 * 1024
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+# Chunks waiting for a sink before the download waits for it, so a slow destination bounds the memory it uses
+SINK_QUEUE_CHUNKS = 8
+_COMMIT = object()
+_ABORT = object()
+
+
+class Sink(ABC):
+    """
+    Destination receiving a copy of a download while it streams. The size and sha256 of the bytes the destination
+    received are computed on the way. Sinks open their destination on the first write, so creating one is free.
+    """
+    kind = None
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.status = 'pending'
+        self.error = None
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self.details = {}
+
+    def write(self, chunk):
+        self._sha256.update(chunk)
+        self.size += len(chunk)
+        self._write(chunk)
+
+    @abstractmethod
+    def _write(self, chunk):
+        pass
+
+    @abstractmethod
+    def commit(self):
+        """
+        Makes the copy visible at the destination once the download is complete and verified.
+
+        :return: Dict of destination specific details recorded with the result
+        """
+        pass
+
+    def abort(self):
+        """
+        Discards what was written so far. Must be safe to call at any point, and more than once.
+        """
+
+    def discard(self):
+        """
+        Removes the committed copy, when the local file could not be moved into place after the copies were committed.
+        """
+
+    def result(self):
+        result = {'kind': self.kind, 'destination': self.destination, 'status': self.status, 'size': self.size,
+                  'sha256': self._sha256.hexdigest()}
+        result.update(self.details)
+        if self.error:
+            result['error'] = self.error
+        return result
+
+
+class DirectorySink(Sink):
+    """
+    Mirrors the download to a local directory, e.g. a network share. The file appears there only once complete.
+    """
+    kind = 'directory'
+
+    def __init__(self, directory, file_name):
+        self.path = join(directory, file_name)
+        super().__init__(self.path)
+        self._temp_path = self.path + '.part'
+        self._f = None
+
+    def _write(self, chunk):
+        if self._f is None:
+            self._f = open(self._temp_path, 'wb')
+        self._f.write(chunk)
+
+    def commit(self):
+        self._write(b'')
+        self._f.close()
+        os.replace(self._temp_path, self.path)
+        return {}
+
+    def abort(self):
+        if self._f is not None:
+            self._f.close()
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class S3Sink(Sink):
+    """
+    Uploads the download to an S3-compatible bucket with a multipart upload, one part_size part at a time as the
+    bytes arrive. Every part is sent with its Content-MD5 so the store checks it, and the ETag of the completed object
+    is compared to the one expected from the part digests. Downloads smaller than one part are sent with a single put.
+    """
+    kind = 's3'
+
+    def __init__(self, client, bucket, key, destination, part_size=S3_PART_SIZE):
+        super().__init__(destination)
+        self._client = client
+        self.bucket = bucket
+        self.key = key
+        self._part_size = max(part_size, S3_MIN_PART_SIZE)
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._part_md5s = []
+
+    def _write(self, chunk):
+        self._buffer += chunk
+        while len(self._buffer) >= self._part_size:
+            self._upload_part(bytes(self._buffer[:self._part_size]))
+            del self._buffer[:self._part_size]
+
+    def _upload_part(self, body):
+        if self._upload_id is None:
+            self._upload_id = self._client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        md5 = hashlib.md5(body).digest()
+        part_number = len(self._parts) + 1
+        r = self._client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                     PartNumber=part_number, Body=body,
+                                     ContentMD5=base64.b64encode(md5).decode('ascii'))
+        self._parts.append({'PartNumber': part_number, 'ETag': r['ETag']})
+        self._part_md5s.append(md5)
+
+    def commit(self):
+        if self._upload_id is None:
+            body = bytes(self._buffer)
+            md5 = hashlib.md5(body)
+            r = self._client.put_object(Bucket=self.bucket, Key=self.key, Body=body,
+                                        ContentMD5=base64.b64encode(md5.digest()).decode('ascii'))
+            expected_etag = md5.hexdigest()
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            r = self._client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                       MultipartUpload={'Parts': self._parts})
+            expected_etag = f"{hashlib.md5(b''.join(self._part_md5s)).hexdigest()}-{len(self._parts)}"
+            self._upload_id = None
+        self._buffer = bytearray()
+        etag = r.get('ETag', '').strip('"')
+        if etag != expected_etag:
+            # Stores encrypting with KMS or computing their own ETags do not return the md5 based ETag
+            logging.warning(f"{self.destination} ETag {etag} is not the expected {expected_etag}, the parts were "
+                            f"checked with their Content-MD5 on upload")
+        return {'etag': etag, 'etag_verified': etag == expected_etag, 'parts': max(len(self._parts), 1)}
+
+    def abort(self):
+        if self._upload_id is not None:
+            upload_id, self._upload_id = self._upload_id, None
+            self._client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=upload_id)
+
+    def discard(self):
+        self._client.delete_object(Bucket=self.bucket, Key=self.key)
+
+
+class _SinkWriter:
+    """
+    Writes to one sink from its own thread, so the destinations receive the download concurrently. A failed sink is
+    reported in its result and no longer slows the download down.
+    """
+    def __init__(self, sink):
+        self.sink = sink
+        self._queue = queue.Queue(SINK_QUEUE_CHUNKS)
+        self._thread = threading.Thread(target=self._run, name=f"tee-{sink.kind}", daemon=True)
+        self._thread.start()
+
+    def put(self, item):
+        self._queue.put(item)
+
+    def join(self):
+        self._thread.join()
+
+    def _run(self):
+        sink = self.sink
+        while True:
+            item = self._queue.get()
+            if item is _ABORT:
+                if sink.status != 'failed':
+                    sink.status = 'aborted'
+                self._abort()
+                return
+            if sink.status == 'failed':
+                if item is _COMMIT:
+                    return
+                continue
+            try:
+                if item is _COMMIT:
+                    sink.details = sink.commit()
+                    sink.status = 'written'
+                    logging.info(f"Written {sink.size} bytes to {sink.destination}")
+                    return
+                sink.write(item)
+            except Exception as e:
+                sink.status = 'failed'
+                sink.error = str(e)
+                logging.error(f"Writing {sink.destination} failed: {e}")
+                self._abort()
+                if item is _COMMIT:
+                    return
+
+    def _abort(self):
+        try:
+            self.sink.abort()
+        except Exception as e:
+            logging.warning(f"Could not discard the partial {self.sink.destination}: {e}")
+
+
+class TeeProcessor(StreamProcessor):
+    """
+    Last stage of the download post-processing chain, copying the bytes written to the local file to more
+    destinations while the download streams. The copies are completed once the download is verified, and discarded
+    when it fails, so the artifact is neither read again nor uploaded after the download. When the local file cannot
+    be moved into place after the copies were committed, the committed copies are deleted again, so a destination
+    never holds an artifact the run reported as failed.
+    """
+    name = 'tee'
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self._writers = None
+        self._finished = False
+
+    def _start(self):
+        if self._writers is None:
+            self._writers = [_SinkWriter(sink) for sink in self.sinks]
+
+    def process(self, chunk):
+        self._start()
+        for writer in self._writers:
+            writer.put(chunk)
+        return chunk
+
+    def finish(self):
+        self._end(_COMMIT)
+        self._finished = True
+        return b''
+
+    def abort(self):
+        if self._finished:
+            self._discard()
+        elif self._writers is not None:
+            self._end(_ABORT)
+
+    def _discard(self):
+        for sink in self.sinks:
+            if sink.status != 'written':
+                continue
+            try:
+                sink.discard()
+                sink.status = 'discarded'
+            except Exception as e:
+                sink.error = f"committed copy could not be deleted: {e}"
+                logging.warning(f"Could not delete {sink.destination} of the failed download: {e}")
+
+    def _end(self, item):
+        self._start()
+        for writer in self._writers:
+            writer.put(item)
+        for writer in self._writers:
+            writer.join()
+
+    def result(self):
+        if self._writers is None:
+            return None
+        return [sink.result() for sink in self.sinks]
+
+
+def _s3_location(destination):
+    """
+    :param destination: s3://bucket/prefix for AWS, s3+http(s)://host:port/bucket/prefix for other S3-compatible
+        stores
+    :return: (endpoint_url or None, bucket, prefix)
+    """
+    url = urlparse(destination)
+    if url.scheme == 's3':
+        return None, url.netloc, url.path.strip('/')
+    bucket, _, prefix = url.path.strip('/').partition('/')
+    return f"{url.scheme[len('s3+'):]}://{url.netloc}", bucket, prefix.strip('/')
+
+
+class TeeDestinations:
+    """
+    Destinations every downloaded artifact is copied to: local directories, and S3-compatible buckets. S3
+    credentials are taken from the standard AWS configuration (environment, profile or instance role).
+    """
+    def __init__(self, destinations, part_size=S3_PART_SIZE):
+        self.part_size = part_size
+        self._directories = []
+        self._buckets = []
+        for destination in destinations:
+            if urlparse(destination).scheme in S3_SCHEMES:
+                if not boto3:
+                    log_and_exit(f"Writing to {destination} requires boto3: pip install boto3")
+                endpoint_url, bucket, prefix = _s3_location(destination)
+                if not bucket:
+                    log_and_exit(f"No bucket in tee destination {destination}")
+                client = boto3.client('s3', endpoint_url=endpoint_url)
+                self._buckets.append((client, bucket, prefix, destination.rstrip('/')))
+            else:
+                validate_output_path(join(destination, 'placeholder'))
+                self._directories.append(destination)
+
+    def processor(self, output_path):
+        """
+        :return: TeeProcessor copying a download to all the destinations, under the output file name
+        """
+        file_name = basename(output_path)
+        sinks = [DirectorySink(directory, file_name) for directory in self._directories]
+        for client, bucket, prefix, destination in self._buckets:
+            key = f"{prefix}/{file_name}" if prefix else file_name
+            sinks.append(S3Sink(client, bucket, key, f"{destination}/{file_name}", self.part_size))
+        return TeeProcessor(sinks)
+
+
+def check_tee(digest, output_path):
+    """
+    Fails when a tee destination of a download was not written. The local file is kept.
+
+    :param digest: Download result (see stream_to_file), with the tee results under 'tee'
+    """
+    failed = [result for result in (digest or {}).get('tee') or [] if result['status'] != 'written']
+    if failed:
+        log_and_exit(f"{output_path} was not written to " +
+                     ', '.join(f"{result['destination']} ({result.get('error', result['status'])})"
+                               for result in failed), AppdomePublishError)
+
+
+def add_tee_args(parser):
+    parser.add_argument('--tee', nargs='+', metavar='destination', default=getenv(TEE_ENV, '').split() or None,
+                        help='Also write every downloaded file, while it downloads, to these destinations: local '
+                             'directories, s3://bucket/prefix, or s3+http(s)://host:port/bucket/prefix for other '
+                             f'S3-compatible stores. Default is environment variable \'{TEE_ENV}\'')
+    parser.add_argument('--tee_part_mb', type=float, default=S3_PART_SIZE / (1024 * 1024),
+                        help=f'Size of the S3 multipart upload parts in MB, at least 5. '
+                             f'Default is {S3_PART_SIZE // (1024 * 1024)}')
+
+
+def init_tee(args):
+    """
+    :return: TeeDestinations when --tee was given, otherwise None
+    """
+    if not args.tee:
+        return None
+    return TeeDestinations(args.tee, int(args.tee_part_mb * 1024 * 1024))
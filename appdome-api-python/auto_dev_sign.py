@@ -2,8 +2,9 @@ import argparse
 import logging
 
 from utils import (cleaned_fd_list, add_provisioning_profiles_entitlements, run_task_action, add_google_play_signing_fingerprint,
-                   ANDROID_SIGNING_FINGERPRINT_KEY, validate_response, add_common_args, init_common_args, init_overrides, add_private_signing_args, TASK_ID_KEY,
+                   ANDROID_SIGNING_FINGERPRINT_KEY, validate_response, add_common_args, init_common_args, init_overrides, add_private_signing_args,
                    add_trusted_signing_fingerprint_list, validate_trusted_fingerprint_list_args)
+from models import parse_task
 
 AUTO_DEV_SIGN_ACTION = 'sign_script'
 
@@ -55,7 +56,7 @@ def main():
         r = auto_dev_sign_ios(args.api_key, args.team_id, args.task_id, args.provisioning_profiles, args.entitlements, overrides)
 
     validate_response(r)
-    logging.info(f"Auto-DEV private signing for Build id: {r.json()[TASK_ID_KEY]} started")
+    logging.info(f"Auto-DEV private signing for Build id: {parse_task(r).task_id} started")
 
 
 if __name__ == '__main__':
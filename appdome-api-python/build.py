@@ -2,10 +2,9 @@ import argparse
 import json
 import logging
 
-import requests
-
-from utils import (request_headers, empty_files, validate_response, debug_log_request, TASKS_URL,
-                   ACTION_KEY, OVERRIDES_KEY, add_common_args, init_common_args, init_overrides, team_params, TASK_ID_KEY)
+from utils import (http_post, request_headers, empty_files, validate_response, debug_log_request, TASKS_URL,
+                   ACTION_KEY, OVERRIDES_KEY, add_common_args, init_common_args, init_overrides, team_params)
+from models import parse_task
 
 
 def create_build_request(api_key, team_id, app_id, fusion_set_id, overrides=None, use_diagnostic_logs=False):
@@ -28,7 +27,7 @@ def create_build_request(api_key, team_id, app_id, fusion_set_id, overrides=None
 def build(api_key, team_id, app_id, fusion_set_id, overrides=None, use_diagnostic_logs=False, files=None):
     url, headers, body, params = create_build_request(api_key, team_id, app_id, fusion_set_id, overrides, use_diagnostic_logs)
     debug_log_request(url, headers=headers, params=params, data=body)
-    return requests.post(url, headers=headers, params=params, data=body, files=files if files else empty_files())
+    return http_post(url, headers=headers, params=params, data=body, files=files if files else empty_files())
 
 
 def parse_arguments():
@@ -49,7 +48,7 @@ def main():
 
     r = build(args.api_key, args.team_id, args.app_id, args.fusion_set_id, overrides, args.diagnostic_logs)
     validate_response(r)
-    logging.info(f"Build started: Build id: {r.json()[TASK_ID_KEY]}")
+    logging.info(f"Build started: Build id: {parse_task(r).task_id}")
 
 
 if __name__ == '__main__':
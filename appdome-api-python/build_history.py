@@ -0,0 +1,273 @@
+import argparse
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone, timedelta
+from os import getenv
+from statistics import median
+
+from artifact_stream import file_sha256
+from utils import collect_metrics, percentile, log_and_exit, init_logging, validate_output_path
+
+BUILD_HISTORY_ENV = 'APPDOME_BUILD_HISTORY'
+GROUP_COLUMNS = {'phase': None, 'app': 'runs.app', 'fusion_set': 'runs.fusion_set_id', 'platform': 'runs.platform'}
+
+HISTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started TEXT NOT NULL,
+    finished TEXT,
+    duration_sec REAL,
+    status TEXT,
+    app TEXT,
+    app_sha256 TEXT,
+    platform TEXT,
+    fusion_set_id TEXT,
+    team_id TEXT,
+    task_ids TEXT
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    phase TEXT NOT NULL,
+    started TEXT NOT NULL,
+    duration_sec REAL NOT NULL,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    polls INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS phases_run_id ON phases (run_id);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+'''
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class RunRecord:
+    """
+    One pipeline run in the build history. Phases may be recorded from several threads (fan-outs).
+    """
+    def __init__(self, history, run_id):
+        self.history = history
+        self.run_id = run_id
+        self.task_ids = []
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Records the wall time of the enclosed block, with the bytes transferred and status requests made by this
+        thread in it.
+
+        :param name: Phase name, e.g. 'upload' or 'download output'
+        """
+        started = _now()
+        start_time = time.monotonic()
+        status = 'failed'
+        with collect_metrics() as metrics:
+            try:
+                yield
+                status = 'succeeded'
+            finally:
+                self.history.add_phase(self.run_id, name, started, time.monotonic() - start_time,
+                                       metrics.get('bytes', 0), metrics.get('polls', 0), status)
+
+    def app_digest(self, app_sha256):
+        """
+        Records the sha256 of the app once it is known, for apps hashed while they were uploaded.
+        """
+        self.history.set_app_sha256(self.run_id, app_sha256)
+
+    def task(self, kind, task_id):
+        """
+        :param kind: Task kind, e.g. 'build' or 'sign [release]'
+        """
+        with self._lock:
+            self.task_ids.append({'kind': kind, 'task_id': task_id})
+
+    def finish(self, status):
+        with self._lock:
+            task_ids = list(self.task_ids)
+        self.history.finish_run(self.run_id, status, time.monotonic() - self._started, task_ids)
+
+
+class BuildHistory:
+    """
+    Local SQLite store of pipeline runs and their phase durations, transferred bytes and status poll counts.
+    Safe to share between threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(HISTORY_SCHEMA)
+
+    def start_run(self, app=None, app_sha256=None, platform=None, fusion_set_id=None, team_id=None):
+        """
+        :return: RunRecord of the new run
+        """
+        with self._lock, self._db:
+            cursor = self._db.execute('INSERT INTO runs (started, app, app_sha256, platform, fusion_set_id, team_id) '
+                                      'VALUES (?, ?, ?, ?, ?, ?)',
+                                      (_now(), app, app_sha256, platform, fusion_set_id, team_id))
+        return RunRecord(self, cursor.lastrowid)
+
+    def add_phase(self, run_id, phase, started, duration_sec, size, polls, status):
+        with self._lock, self._db:
+            self._db.execute('INSERT INTO phases VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (run_id, phase, started, round(duration_sec, 3), size, polls, status))
+
+    def set_app_sha256(self, run_id, app_sha256):
+        with self._lock, self._db:
+            self._db.execute('UPDATE runs SET app_sha256 = ? WHERE id = ?', (app_sha256, run_id))
+
+    def finish_run(self, run_id, status, duration_sec, task_ids):
+        with self._lock, self._db:
+            self._db.execute('UPDATE runs SET finished = ?, status = ?, duration_sec = ?, task_ids = ? WHERE id = ?',
+                             (_now(), status, round(duration_sec, 3), json.dumps(task_ids), run_id))
+
+    def phase_durations(self, group_by='phase', since=None, status='succeeded'):
+        """
+        :param group_by: One of GROUP_COLUMNS
+        :param since: Only phases started after this ISO time (optional)
+        :param status: Only phases with this status, None for all
+        :return: Dict of (group, phase) to the list of (started, duration_sec, bytes, polls) in start order
+        """
+        column = GROUP_COLUMNS[group_by]
+        query = (f"SELECT {column or 'NULL'}, phases.phase, phases.started, phases.duration_sec, phases.bytes, "
+                 f"phases.polls FROM phases JOIN runs ON runs.id = phases.run_id WHERE 1 = 1")
+        params = []
+        if since:
+            query += ' AND phases.started >= ?'
+            params.append(since)
+        if status:
+            query += ' AND phases.status = ?'
+            params.append(status)
+        groups = {}
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY phases.started', params).fetchall()
+        for group, phase, started, duration_sec, size, polls in rows:
+            groups.setdefault((group, phase), []).append((started, duration_sec, size, polls))
+        return groups
+
+    def close(self):
+        self._db.close()
+
+
+def summarize(groups):
+    """
+    :param groups: Result of BuildHistory.phase_durations
+    :return: List of per group and phase duration percentiles, bytes and poll counts
+    """
+    summary = []
+    for (group, phase), samples in sorted(groups.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+        durations = sorted(sample[1] for sample in samples)
+        summary.append({'group': group, 'phase': phase, 'count': len(samples),
+                        'p50_sec': percentile(durations, 50), 'p95_sec': percentile(durations, 95),
+                        'p99_sec': percentile(durations, 99),
+                        'mean_bytes': round(sum(sample[2] for sample in samples) / len(samples)),
+                        'mean_polls': round(sum(sample[3] for sample in samples) / len(samples), 1)})
+    return summary
+
+
+def find_regressions(groups, recent=5, threshold=0.25, min_baseline=5):
+    """
+    Compares the median duration of the most recent samples of every group and phase to the median of the samples
+    before them.
+
+    :param recent: Number of most recent samples to compare
+    :param threshold: Relative slowdown reported as a regression, e.g. 0.25 for 25% slower
+    :param min_baseline: Minimum number of earlier samples for a comparison
+    :return: List of regressions, slowest first
+    """
+    regressions = []
+    for (group, phase), samples in groups.items():
+        if len(samples) < recent + min_baseline:
+            continue
+        baseline = median(sample[1] for sample in samples[:-recent])
+        current = median(sample[1] for sample in samples[-recent:])
+        if baseline > 0 and current > baseline * (1 + threshold):
+            regressions.append({'group': group, 'phase': phase, 'baseline_p50_sec': baseline,
+                                'recent_p50_sec': current, 'slowdown': round(current / baseline - 1, 3),
+                                'since': samples[-recent][0]})
+    return sorted(regressions, key=lambda regression: -regression['slowdown'])
+
+
+def add_build_history_args(parser):
+    parser.add_argument('--build_history', metavar='history_sqlite_file', default=getenv(BUILD_HISTORY_ENV),
+                        help='Record the run and its phase durations, bytes and status polls in this SQLite file. '
+                             f'Default: ${BUILD_HISTORY_ENV}')
+
+
+def init_build_history(args, platform=None, fusion_set_id=None):
+    """
+    :return: RunRecord of this run when --build_history was given, otherwise None
+    """
+    if not args.build_history:
+        return None
+    validate_output_path(args.build_history)
+    # A streamed app may not be complete, or readable twice, before the upload, which records its sha256 instead
+    streamed = getattr(args, 'stream_upload', False)
+    app_sha256 = file_sha256(args.app) if getattr(args, 'app', None) and not streamed else None
+    app = getattr(args, 'app', None) or getattr(args, 'app_id', None)
+    return BuildHistory(args.build_history).start_run(app, app_sha256, platform, fusion_set_id, args.team_id)
+
+
+def _format_row(row, columns):
+    return '  '.join(f"{str(row[key]):<{width}}" for key, width in columns)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Report phase durations and regressions of the recorded builds')
+    parser.add_argument('command', choices=['history'], help='history: report the recorded build history')
+    parser.add_argument('--build_history', metavar='history_sqlite_file', default=getenv(BUILD_HISTORY_ENV),
+                        help=f'Build history SQLite file. Default: ${BUILD_HISTORY_ENV}')
+    parser.add_argument('--by', choices=list(GROUP_COLUMNS), default='phase',
+                        help='Group the durations by phase only, or by app, fusion set or platform and phase')
+    parser.add_argument('--days', type=float, metavar='days', help='Only report phases of the last days')
+    parser.add_argument('--include_failed', action='store_true', help='Include failed phases')
+    parser.add_argument('--recent', type=int, default=5, help='Number of most recent runs checked for regressions. Default: 5')
+    parser.add_argument('--regression_threshold', type=float, default=0.25,
+                        help='Relative slowdown of the recent runs reported as a regression. Default: 0.25')
+    parser.add_argument('--json', metavar='report_json_file', help='Write the report to a json file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show debug logs')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    init_logging(args.verbose)
+    if not args.build_history:
+        log_and_exit(f"--build_history or ${BUILD_HISTORY_ENV} must be specified")
+    history = BuildHistory(args.build_history)
+    try:
+        since = (datetime.now(timezone.utc) - timedelta(days=args.days)).isoformat() if args.days else None
+        groups = history.phase_durations(args.by, since, None if args.include_failed else 'succeeded')
+    finally:
+        history.close()
+
+    summary = summarize(groups)
+    regressions = find_regressions(groups, args.recent, args.regression_threshold)
+    columns = ([('group', 40)] if args.by != 'phase' else []) + [
+        ('phase', 32), ('count', 6), ('p50_sec', 9), ('p95_sec', 9), ('p99_sec', 9), ('mean_bytes', 12),
+        ('mean_polls', 10)]
+    print(_format_row({key: key for key, _ in columns}, columns))
+    for row in summary:
+        print(_format_row(row, columns))
+    for regression in regressions:
+        group = f"{regression['group']} " if regression['group'] is not None else ''
+        print(f"Regression: {group}{regression['phase']} p50 {regression['baseline_p50_sec']}s -> "
+              f"{regression['recent_p50_sec']}s (+{regression['slowdown']:.0%}) since {regression['since']}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'group_by': args.by, 'phases': summary, 'regressions': regressions}, f, indent=2)
+        logging.info(f"Build history report written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
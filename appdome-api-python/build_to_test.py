@@ -3,10 +3,9 @@ import json
 import logging
 from enum import Enum
 
-import requests
-
-from utils import (request_headers, empty_files, validate_response, debug_log_request, BUILD_TO_TEST_URL, log_and_exit,
-                   ACTION_KEY, OVERRIDES_KEY, add_common_args, init_common_args, init_overrides, team_params, TASK_ID_KEY)
+from utils import (http_post, request_headers, empty_files, validate_response, debug_log_request, BUILD_TO_TEST_URL, log_and_exit,
+                   ACTION_KEY, OVERRIDES_KEY, add_common_args, init_common_args, init_overrides, team_params)
+from models import parse_task
 
 
 class BuildToTestVendors(Enum):
@@ -61,7 +60,7 @@ def build_to_test(api_key, team_id, app_id, fusion_set_id, vendor,
     else:
         files = {REPRO_OVERRIDE: open(repro_override, 'rb')} if repro_override else None
     debug_log_request(url, headers=headers, params=params, data=body)
-    return requests.post(url, headers=headers, params=params, data=body, files=files if files else empty_files())
+    return http_post(url, headers=headers, params=params, data=body, files=files if files else empty_files())
 
 
 def init_automation_vendor(automation_vendor):
@@ -94,7 +93,7 @@ def main():
     r = build_to_test(args.api_key, args.team_id, args.app_id, args.fusion_set_id, automation_vendor.name,
                       automation_vendor_err_msg, overrides, args.diagnostic_logs)
     validate_response(r)
-    logging.info(f"Build_to_test started: Build id: {r.json()[TASK_ID_KEY]}")
+    logging.info(f"Build_to_test started: Build id: {parse_task(r).task_id}")
 
 
 if __name__ == '__main__':
@@ -1,17 +1,20 @@
 import argparse
 import logging
 
-from utils import (validate_response, add_common_args, init_common_args, validate_output_path, task_output_command)
+from artifact_cache import add_artifact_cache_args, init_artifact_cache, fetch_artifact
+from utils import (add_common_args, init_common_args, validate_output_path, task_output_command)
 
 
-def download_certified_secure(api_key, team_id, task_id):
-    return task_output_command(api_key, team_id, task_id, 'certificate')
+def download_certified_secure(api_key, team_id, task_id, stream=False, session=None, extra_headers=None):
+    return task_output_command(api_key, team_id, task_id, 'certificate', stream=stream, session=session,
+                               extra_headers=extra_headers)
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Download Certified Secure pdf file')
     add_common_args(parser, add_task_id=True)
     parser.add_argument('-co', '--certificate_output', required=True, metavar='certificate_output_file', help='Output file for Certified Secure pdf')
+    add_artifact_cache_args(parser)
     return parser.parse_args()
 
 
@@ -19,10 +22,10 @@ def main():
     args = parse_arguments()
     init_common_args(args)
     validate_output_path(args.certificate_output)
-    r = download_certified_secure(args.api_key, args.team_id, args.task_id)
-    validate_response(r)
-    with open(args.certificate_output, 'wb') as f:
-        f.write(r.content)
+    fetch_artifact(init_artifact_cache(args), args.team_id, args.task_id, 'certificate',
+                   lambda headers: download_certified_secure(args.api_key, args.team_id, args.task_id, stream=True,
+                                                             extra_headers=headers),
+                   args.certificate_output)
     logging.info(f"Downloaded file to {args.certificate_output}")
 
 
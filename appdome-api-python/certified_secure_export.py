@@ -0,0 +1,249 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from artifact_stream import stream_to_file
+from certified_secure import download_certified_secure
+from certified_secure_json import download_certified_secure_json
+from utils import (validate_response, add_common_args, init_common_args, validate_output_path, log_and_exit,
+                   pooled_session, erased_temp_dir)
+
+PDF_NAME = 'certified_secure.pdf'
+JSON_NAME = 'certified_secure.json'
+MAX_INDEXED_FIELDS = 1000
+
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS exports (
+    task_id TEXT PRIMARY KEY,
+    pdf_member TEXT,
+    json_member TEXT,
+    pdf_sha256 TEXT,
+    json_sha256 TEXT,
+    exported_at TEXT
+);
+CREATE TABLE IF NOT EXISTS fields (
+    task_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS fields_key_value ON fields (key, value);
+CREATE INDEX IF NOT EXISTS fields_task_id ON fields (task_id);
+'''
+
+
+def flatten_fields(obj, prefix=''):
+    """
+    Flattens a json document to (dotted key, value) pairs of its scalar values, e.g. ('protections[0].name', 'x').
+    """
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            yield from flatten_fields(value, f"{prefix}.{key}" if prefix else str(key))
+    elif isinstance(obj, list):
+        for index, value in enumerate(obj):
+            yield from flatten_fields(value, f"{prefix}[{index}]")
+    else:
+        yield prefix, None if obj is None else str(obj)
+
+
+class CertificateIndex:
+    """
+    SQLite index of the exported Certified Secure artifacts and the fields of their json, for searching an export
+    without opening the archive. Safe to share between threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(INDEX_SCHEMA)
+
+    def exported_task_ids(self):
+        with self._lock:
+            return {row[0] for row in self._db.execute('SELECT task_id FROM exports')}
+
+    def add(self, task_id, pdf_member, json_member, pdf_sha256, json_sha256, fields):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM fields WHERE task_id = ?', (task_id,))
+            self._db.executemany('INSERT INTO fields (task_id, key, value) VALUES (?, ?, ?)',
+                                 [(task_id, key, value) for key, value in fields])
+            self._db.execute('INSERT OR REPLACE INTO exports VALUES (?, ?, ?, ?, ?, ?)',
+                             (task_id, pdf_member, json_member, pdf_sha256, json_sha256,
+                              datetime.now(timezone.utc).isoformat()))
+
+    def search(self, text=None, key=None):
+        """
+        :param text: Substring of a field value (optional)
+        :param key: Field key pattern, '%' matches any characters (optional)
+        :return: List of (task_id, key, value) rows
+        """
+        query = 'SELECT task_id, key, value FROM fields WHERE 1 = 1'
+        params = []
+        if key:
+            query += ' AND key LIKE ?'
+            params.append(key)
+        if text:
+            query += ' AND value LIKE ?'
+            params.append(f"%{text}%")
+        with self._lock:
+            return self._db.execute(query + ' ORDER BY task_id, key', params).fetchall()
+
+    def close(self):
+        self._db.close()
+
+
+class CertificateExporter:
+    """
+    Exports the Certified Secure pdf and json of many tasks into one zip archive. Artifacts are downloaded
+    concurrently over pooled connections and streamed to a spool directory, then appended to the archive by one
+    writer at a time, so memory does not grow with the artifacts. Tasks already in the index and the archive are
+    skipped.
+
+    A run appends to a copy of the archive, which replaces the archive when the run is committed, and only then are
+    its tasks added to the index. A run that is killed leaves the archive and the index of the previous runs intact.
+    """
+    def __init__(self, api_key, team_id, archive_path, index, spool_dir, max_workers=8):
+        self.api_key = api_key
+        self.team_id = team_id
+        self.archive_path = archive_path
+        self.index = index
+        self.spool_dir = spool_dir
+        self.max_workers = max_workers
+        self._archive_lock = threading.Lock()
+        self._exported = []
+        self._staged_path = archive_path + '.part'
+        if os.path.exists(archive_path):
+            try:
+                with zipfile.ZipFile(archive_path) as archive:
+                    self._members = set(archive.namelist())
+            except zipfile.BadZipFile as e:
+                log_and_exit(f"{archive_path} is not a readable zip archive ({e}), move it away to export again")
+            shutil.copyfile(archive_path, self._staged_path)
+            self._archive = zipfile.ZipFile(self._staged_path, 'a', zipfile.ZIP_DEFLATED)
+        else:
+            self._members = set()
+            self._archive = zipfile.ZipFile(self._staged_path, 'w', zipfile.ZIP_DEFLATED)
+        self._session = pooled_session(max_workers)
+
+    def _download(self, task_id, download_func, name):
+        path = os.path.join(self.spool_dir, f"{task_id}-{name}")
+        response = download_func(self.api_key, self.team_id, task_id, stream=True, session=self._session)
+        validate_response(response)
+        return path, stream_to_file(response, path)['sha256']
+
+    def export_task(self, task_id):
+        """
+        :return: Error message, or None when the task was exported
+        """
+        pdf_path = json_path = None
+        try:
+            pdf_path, pdf_sha256 = self._download(task_id, download_certified_secure, PDF_NAME)
+            json_path, json_sha256 = self._download(task_id, download_certified_secure_json, JSON_NAME)
+            with open(json_path, 'r') as f:
+                fields = list(flatten_fields(json.load(f)))[:MAX_INDEXED_FIELDS]
+            pdf_member = f"{task_id}/{PDF_NAME}"
+            json_member = f"{task_id}/{JSON_NAME}"
+            with self._archive_lock:
+                self._archive.write(pdf_path, pdf_member)
+                self._archive.write(json_path, json_member)
+                self._exported.append((task_id, pdf_member, json_member, pdf_sha256, json_sha256, fields))
+            logging.info(f"Exported Certified Secure files of task {task_id}")
+            return None
+        except Exception as e:
+            logging.error(f"Export of task {task_id} failed: {e}")
+            return str(e)
+        finally:
+            for path in (pdf_path, json_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+    def export(self, task_ids):
+        """
+        :return: Dict of task id to error message of the failed tasks
+        """
+        exported = {task_id for task_id in self.index.exported_task_ids()
+                    if f"{task_id}/{PDF_NAME}" in self._members and f"{task_id}/{JSON_NAME}" in self._members}
+        pending = [task_id for task_id in dict.fromkeys(task_ids) if task_id not in exported]
+        if len(pending) < len(task_ids):
+            logging.info(f"Skipping {len(task_ids) - len(pending)} already exported tasks")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            errors = dict(zip(pending, executor.map(self.export_task, pending)))
+        return {task_id: error for task_id, error in errors.items() if error}
+
+    def commit(self):
+        """
+        Replaces the archive with the one this run appended to, then indexes the tasks it exported.
+        """
+        self._archive.close()
+        os.replace(self._staged_path, self.archive_path)
+        for exported in self._exported:
+            self.index.add(*exported)
+
+    def close(self):
+        """
+        Discards the run when it was not committed.
+        """
+        self._session.close()
+        if self._archive.fp is not None:
+            self._archive.close()
+        if os.path.exists(self._staged_path):
+            os.remove(self._staged_path)
+
+
+def read_task_ids(task_ids, task_ids_file):
+    task_ids = list(task_ids or [])
+    if task_ids_file:
+        with open(task_ids_file, 'r') as f:
+            task_ids += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return task_ids
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Export the Certified Secure pdf and json files of many tasks to one archive')
+    add_common_args(parser)
+    parser.add_argument('--task_ids', nargs='+', metavar='task_id', help='Task ids to export')
+    parser.add_argument('--task_ids_file', metavar='task_ids_file', help='File with a task id per line')
+    parser.add_argument('--archive', required=True, metavar='archive_zip_file', help='Output zip archive. Existing archives are appended to')
+    parser.add_argument('--index', metavar='index_sqlite_file', help='Index database of the exported json fields. Default: <archive>.index.sqlite')
+    parser.add_argument('--max_workers', type=int, default=8, help='Maximum number of concurrent downloads. Default is 8')
+    parser.add_argument('--search', metavar='text', help='Search the index for json field values containing text instead of exporting')
+    parser.add_argument('--search_key', metavar='key_pattern', help='Limit the search to field keys matching this pattern (%% matches anything)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    init_common_args(args)
+    index = CertificateIndex(args.index or args.archive + '.index.sqlite')
+    try:
+        if args.search or args.search_key:
+            for task_id, key, value in index.search(args.search, args.search_key):
+                print(f"{task_id}\t{key}\t{value}")
+            return
+
+        task_ids = read_task_ids(args.task_ids, args.task_ids_file)
+        if not task_ids:
+            log_and_exit("task_ids or task_ids_file must be specified")
+        validate_output_path(args.archive)
+        with erased_temp_dir() as spool_dir:
+            exporter = CertificateExporter(args.api_key, args.team_id, args.archive, index, spool_dir,
+                                           args.max_workers)
+            try:
+                errors = exporter.export(task_ids)
+                exporter.commit()
+            finally:
+                exporter.close()
+        if errors:
+            log_and_exit(f"{len(errors)} of {len(task_ids)} exports failed: {', '.join(sorted(errors))}")
+        logging.info(f"Certified Secure files written to {args.archive}")
+    finally:
+        index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,51 @@
 import argparse
 import logging
-from json import load, dump
+import os
 from os.path import exists
-from shutil import move
-from utils import (validate_response, add_common_args, init_common_args, validate_output_path, task_output_command)
 
+from artifact_cache import add_artifact_cache_args, init_artifact_cache, fetch_artifact
+from artifact_stream import HashingWriter, CHUNK_SIZE
+from post_processors import JSON_FORMATS, JsonFormatter, json_processors
+from utils import (add_common_args, init_common_args, validate_output_path, task_output_command)
 
-def download_certified_secure_json(api_key, team_id, task_id):
-    return task_output_command(api_key, team_id, task_id, 'certificate-json')
 
+def download_certified_secure_json(api_key, team_id, task_id, stream=False, session=None, extra_headers=None):
+    return task_output_command(api_key, team_id, task_id, 'certificate-json', stream=stream, session=session,
+                               extra_headers=extra_headers)
 
-def format_json_file(file_path):
+
+def format_json_file(file_path, indent=2):
+    """
+    Re-formats a json file that is already on disk in place. Downloads format the json while streaming instead,
+    see post_processors.JsonFormatter.
+
+    :param indent: Indentation, None for the compact format
+    :return: Dict with the 'size' and 'sha256' of the formatted file, or None when the file does not exist
+    """
+    if not file_path or not exists(file_path):
+        return None
+    formatter = JsonFormatter(indent)
     temp_write_file_path = file_path + '-tmp'
-    if not file_path or not exists(file_path) or exists(temp_write_file_path):
-        return
     try:
-        with open(file_path) as f:
-            obj = load(f)
-        with open(temp_write_file_path, 'w') as f:
-            dump(obj, f, indent=2, separators=(',', ': '))
-        move(temp_write_file_path, file_path)
-        logging.debug(f"Formatted {file_path}")
-    except Exception:
-        pass
+        with open(file_path, 'rb') as source, open(temp_write_file_path, 'wb') as f:
+            writer = HashingWriter(f)
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                writer.write(formatter.process(chunk))
+            writer.write(formatter.finish())
+        os.replace(temp_write_file_path, file_path)
+    finally:
+        if exists(temp_write_file_path):
+            os.remove(temp_write_file_path)
+    logging.debug(f"Formatted {file_path}")
+    return writer.digest()
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Download Certified Secure json file')
     add_common_args(parser, add_task_id=True)
     parser.add_argument('-cj', '--certificate_json', required=True, metavar='certificate_json_output_file', help='Output file for Certified Secure json')
+    parser.add_argument('--certificate_json_format', choices=JSON_FORMATS, default='pretty', help='Format of the json file. Default: pretty')
+    add_artifact_cache_args(parser)
     return parser.parse_args()
 
 
@@ -36,12 +53,11 @@ def main():
     args = parse_arguments()
     init_common_args(args)
     validate_output_path(args.certificate_json)
-    r = download_certified_secure_json(args.api_key, args.team_id, args.task_id)
-    validate_response(r)
-    with open(args.certificate_json, 'wb') as f:
-        f.write(r.content)
+    fetch_artifact(init_artifact_cache(args), args.team_id, args.task_id, 'certificate-json',
+                   lambda headers: download_certified_secure_json(args.api_key, args.team_id, args.task_id,
+                                                                  stream=True, extra_headers=headers),
+                   args.certificate_json, json_processors(args.certificate_json_format))
     logging.info(f"Downloaded file to {args.certificate_json}")
-    format_json_file(args.certificate_json)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,182 @@
+import json
+import logging
+import secrets
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+from utils import (http_post, TASKS_URL, request_headers, team_params, build_url, debug_log_request)
+
+DEFAULT_FALLBACK_INTERVAL_SEC = 120
+
+_active_receiver = None
+
+
+class _CallbackHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0) or 0))
+        parts = urlparse(self.path).path.strip('/').split('/')
+        # /appdome/<secret>/tasks/<task_id>
+        if len(parts) != 4 or parts[0] != 'appdome' or parts[2] != 'tasks':
+            return self._reply(404)
+        if not secrets.compare_digest(parts[1], self.server.receiver.secret):
+            return self._reply(403)
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            payload = {}
+        self.server.receiver.notify(parts[3], payload if isinstance(payload, dict) else {})
+        self._reply(204)
+
+    def _reply(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class CompletionReceiver:
+    """
+    Local HTTP receiver of task completion callbacks. Tasks registered with callback_url() are waited on with
+    wait() instead of being polled; every callback only wakes the waiter, which then confirms the status with one
+    status request. One receiver serves all the tasks of the process.
+    """
+    def __init__(self, host='0.0.0.0', port=0, public_url=None, fallback_interval_sec=DEFAULT_FALLBACK_INTERVAL_SEC):
+        """
+        :param host: Interface to listen on
+        :param port: Port to listen on, 0 picks a free port
+        :param public_url: Base url the server calls back (e.g. a tunnel or load balancer forwarding to this
+            receiver). Default is http://<host>:<port>
+        :param fallback_interval_sec: Status polling interval while waiting for callbacks, in case one is lost
+        """
+        self.fallback_interval_sec = fallback_interval_sec
+        self.secret = secrets.token_urlsafe(16)
+        self._events = {}
+        self._payloads = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _CallbackHandler)
+        self._server.daemon_threads = True
+        self._server.receiver = self
+        self.base_url = (public_url or f"http://{host if host != '0.0.0.0' else '127.0.0.1'}:"
+                                       f"{self._server.server_port}").rstrip('/')
+        self._thread = threading.Thread(target=self._server.serve_forever, name='appdome-callbacks', daemon=True)
+        self._thread.start()
+        logging.info(f"Listening for task completion callbacks on port {self._server.server_port}")
+
+    def _event(self, task_id):
+        with self._lock:
+            return self._events.setdefault(task_id, threading.Event())
+
+    def callback_url(self, task_id):
+        return f"{self.base_url}/appdome/{self.secret}/tasks/{task_id}"
+
+    def notify(self, task_id, payload):
+        logging.debug(f"Callback for task {task_id}: {payload}")
+        with self._lock:
+            self._payloads[task_id] = payload
+        self._event(task_id).set()
+
+    def wait(self, task_id, timeout_sec):
+        """
+        Waits for a callback of the task.
+
+        :return: The callback payload, or None when none arrived in time
+        """
+        event = self._event(task_id)
+        if not event.wait(timeout_sec):
+            return None
+        event.clear()
+        with self._lock:
+            return self._payloads.pop(task_id, {})
+
+    def forget(self, task_id):
+        with self._lock:
+            self._events.pop(task_id, None)
+            self._payloads.pop(task_id, None)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def register_task_callback(api_key, team_id, task_id, callback_url):
+    """
+    Asks the server to call back when the task status changes. The tasks/<task_id>/callback endpoint is assumed, it
+    is not part of the documented Appdome API, so registration is expected to fail on servers without it and the task
+    is polled instead.
+
+    :return: True when the callback was registered
+    """
+    url = build_url(TASKS_URL, task_id, 'callback')
+    headers = request_headers(api_key)
+    params = team_params(team_id)
+    body = {'callback_url': callback_url}
+    debug_log_request(url, headers=headers, params=params, data=body)
+    try:
+        response = http_post(url, headers=headers, params=params, data=body)
+    except Exception as e:
+        logging.warning(f"Could not register completion callback of task {task_id}, polling instead: {e}")
+        return False
+    if response.status_code not in (200, 201, 204):
+        logging.warning(f"Could not register completion callback of task {task_id} (status {response.status_code}), "
+                        f"polling instead")
+        return False
+    return True
+
+
+def active_completion_receiver():
+    """
+    :return: The completion receiver status waits use, or None when tasks are polled
+    """
+    return _active_receiver
+
+
+def start_completion_receiver(host='0.0.0.0', port=0, public_url=None,
+                              fallback_interval_sec=DEFAULT_FALLBACK_INTERVAL_SEC):
+    """
+    Starts the process wide completion receiver used by wait_for_status_complete.
+    """
+    global _active_receiver
+    if _active_receiver:
+        _active_receiver.close()
+    _active_receiver = CompletionReceiver(host, port, public_url, fallback_interval_sec)
+    return _active_receiver
+
+
+def stop_completion_receiver():
+    global _active_receiver
+    if _active_receiver:
+        _active_receiver.close()
+        _active_receiver = None
+
+
+def add_completion_args(parser):
+    parser.add_argument('--callbacks', action='store_true',
+                        help='Wait for task completion callbacks from the server instead of polling the status. '
+                             'Relies on an assumed tasks/<task_id>/callback endpoint, which is not part of the '
+                             'documented API: tasks are polled as usual when the server does not accept it')
+    parser.add_argument('--callback_host', default='0.0.0.0', help='Interface of the callback receiver')
+    parser.add_argument('--callback_port', type=int, default=0, help='Port of the callback receiver. Default: any')
+    parser.add_argument('--callback_public_url', metavar='url',
+                        help='Url the server calls back, forwarding to the receiver. Default: the receiver address')
+    parser.add_argument('--callback_fallback_interval', type=int, default=DEFAULT_FALLBACK_INTERVAL_SEC,
+                        metavar='seconds', help='Status polling interval while waiting for callbacks. '
+                                                f'Default: {DEFAULT_FALLBACK_INTERVAL_SEC}')
+
+
+def init_completion_receiver(args):
+    """
+    Starts the completion receiver when --callbacks was given.
+    """
+    if not args.callbacks and not args.callback_public_url:
+        return None
+    return start_completion_receiver(args.callback_host, args.callback_port, args.callback_public_url,
+                                     args.callback_fallback_interval)
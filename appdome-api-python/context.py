@@ -1,7 +1,13 @@
 import argparse
 import logging
+from os.path import exists
 
-from utils import run_task_action, cleaned_fd_list, validate_response, add_common_args, init_common_args, TASK_ID_KEY
+from utils import (run_task_action, cleaned_fd_list, validate_response, add_common_args, init_common_args, log_and_exit,
+                   read_named_configs)
+from models import parse_task
+
+CONTEXT_VARIANT_KEYS = ('name', 'new_bundle_id', 'new_version', 'new_build_num', 'new_display_name', 'app_icon',
+                        'icon_overlay', 'context_overrides', 'output')
 
 
 def context(api_key, team_id, task_id, new_bundle_id=None, new_version=None,
@@ -33,6 +39,27 @@ def context(api_key, team_id, task_id, new_bundle_id=None, new_version=None,
         return run_task_action(api_key, team_id, 'context', task_id, overrides, files)
 
 
+def init_context_variants(context_variants_file):
+    """
+    Loads white-label context variants from a json file.
+
+    The file holds a list of variants, each with a unique 'name' and any of 'new_bundle_id', 'new_version',
+    'new_build_num', 'new_display_name', 'app_icon', 'icon_overlay', 'context_overrides' (dict) and 'output'.
+
+    :param context_variants_file: Path to the variants json file
+    :return: List of variant dicts
+    """
+    variants = read_named_configs(context_variants_file, 'Context variant', CONTEXT_VARIANT_KEYS)
+    for variant in variants:
+        name = variant['name']
+        for icon_key in ('app_icon', 'icon_overlay'):
+            if variant.get(icon_key) and not exists(variant[icon_key]):
+                log_and_exit(f"Context variant [{name}] {icon_key} file {variant[icon_key]} does not exist")
+        if variant.get('context_overrides') is not None and not isinstance(variant['context_overrides'], dict):
+            log_and_exit(f"Context variant [{name}] context_overrides must be a JSON object")
+    return variants
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Initialize Context on Appdome')
     add_common_args(parser, add_task_id=True)
@@ -48,6 +75,12 @@ def add_context_args(parser):
     parser.add_argument('--icon_overlay', metavar='icon_file', help='Path to App overlay icon file')
 
 
+def add_context_variants_args(parser):
+    parser.add_argument('--context_variants', metavar='context_variants_json_file',
+                        help='Path to json file with a list of white-label context variants to create concurrently '
+                             'from a single build. Each variant is signed and downloaded to its own output')
+
+
 def main():
     args = parse_arguments()
     init_common_args(args)
@@ -55,7 +88,7 @@ def main():
     r = context(args.api_key, args.team_id, args.task_id, args.new_bundle_id, args.new_version, args.new_build_num,
                 args.new_display_name, args.app_icon, args.icon_overlay)
     validate_response(r)
-    logging.info(f"Context for Build id: {r.json()[TASK_ID_KEY]} started")
+    logging.info(f"Context for Build id: {parse_task(r).task_id} started")
 
 
 if __name__ == '__main__':
@@ -2,6 +2,7 @@ import logging
 import zipfile
 import os
 from abc import ABC, abstractmethod
+from artifact_stream import file_sha256
 from utils import erased_temp_dir
 
 
@@ -9,15 +10,19 @@ class CrashAnalytics(ABC):
     """
     Abstract base class for crash analytics services (e.g., Crashlytics, DataDog).
     """
-    def __init__(self, deobfuscation_script_output, faid_or_dd_api_key):
+    def __init__(self, deobfuscation_script_output, faid_or_dd_api_key, ledger=None, force=False):
         """
         Initialize CrashAnalytics with the deobfuscation script output path and API key.
 
         :param deobfuscation_script_output: Path to the deobfuscation script output zip file
         :param faid_or_dd_api_key: Data Dig API key or Firebase App ID depending on the service
+        :param ledger: UploadLedger of the uploads that already succeeded (optional)
+        :param force: Upload even when the ledger has the upload
         """
         self.deobfuscation_script_output = deobfuscation_script_output
         self.faid_or_dd_api_key = faid_or_dd_api_key
+        self.ledger = ledger
+        self.force = force
 
     @abstractmethod
     def upload_mappingfileid_file(self, tmpdir):
@@ -25,21 +30,43 @@ class CrashAnalytics(ABC):
         Abstract method to be implemented by subclasses to upload mapping file to their respective services.
 
         :param tmpdir: Temporary directory where files are extracted
+        :return: True when the mapping file was uploaded
         """
         pass
 
+    def upload_once(self, destination, mapping_file_path, mapping_id, upload):
+        """
+        Runs upload unless the ledger has a successful upload of the same mapping content and id to destination.
+
+        :param destination: Service and target of the upload, e.g. 'crashlytics:<app id>'
+        :param mapping_id: Build or mapping file id of the upload
+        :param upload: Callable without arguments returning True when the upload succeeded
+        :return: True when the mapping file was uploaded now or before
+        """
+        if not self.ledger:
+            return upload()
+        content_sha256 = file_sha256(mapping_file_path)
+        if not self.force and self.ledger.contains(destination, content_sha256, mapping_id):
+            logging.info(f"Mapping file {mapping_id} was already uploaded to {destination.split(':')[0]}. "
+                         f"Skipping upload (use --force to upload again).")
+            return True
+        uploaded = upload()
+        if uploaded:
+            self.ledger.record(destination, content_sha256, mapping_id)
+        return uploaded
+
     def upload_deobfuscation_map(self):
         """
         Upload the deobfuscation mapping file to the specified service after extracting the contents.
 
-        :return: None
+        :return: True when the mapping file was uploaded
         """
         if not os.path.exists(self.deobfuscation_script_output):
             logging.warning("Missing deobfuscation script. Skipping code deobfuscation mapping file upload.")
-            return
+            return False
         if not self.faid_or_dd_api_key:
             logging.warning("Missing API key or ID. Skipping code deobfuscation mapping file upload.")
-            return
+            return False
         try:
             with erased_temp_dir() as tmpdir:
                 with zipfile.ZipFile(self.deobfuscation_script_output, "r") as zip_file:
@@ -48,11 +75,12 @@ class CrashAnalytics(ABC):
                 mapping_file = os.path.join(tmpdir, "mapping.txt")
                 if not os.path.exists(mapping_file):
                     logging.warning("Missing mapping.txt file. Skipping code deobfuscation mapping file upload.")
-                    return
+                    return False
 
                 # Delegate to subclass for specific mappingfileid_file handling
-                self.upload_mappingfileid_file(tmpdir)
+                return bool(self.upload_mappingfileid_file(tmpdir))
         except Exception as e:
             logging.error(f"An error occurred during file extraction or mapping file processing: {e}")
+            return False
 
 
@@ -1,40 +1,149 @@
 import os
 import logging
-import subprocess
+import threading
+import zlib
+import xml.etree.ElementTree as ElementTree
+from os import getenv
+
+import requests
+
 from crash_analytics import CrashAnalytics
+from utils import pooled_session, log_and_exit, request_timeout, AppdomeError, AppdomeApiError
+
+MAPPING_FILE_ID_XML = "com_google_firebase_crashlytics_mappingfileid.xml"
+MAPPING_FILE_ID_NAME = "com.google.firebase.crashlytics.mapping_file_id"
+GOOGLE_API_KEY_NAME = "google_api_key"
+CRASHLYTICS_UPLOAD_URL = getenv('CRASHLYTICS_UPLOAD_URL', 'https://firebasecrashlyticssymbols.googleapis.com/v1/'
+                                                          'project/-/app/{app_id}/upload/java/{mapping_file_id}')
+FIREBASE_ACCESS_TOKEN_ENV = 'FIREBASE_ACCESS_TOKEN'
+FIREBASE_API_KEY_ENV = 'FIREBASE_API_KEY'
+UPLOAD_CHUNK_SIZE = 256 * 1024
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def read_string_resources(xml_path):
+    """
+    :param xml_path: Android string resources file, e.g. com_google_firebase_crashlytics_mappingfileid.xml
+    :return: Dict of string resource name to value
+    """
+    try:
+        root = ElementTree.parse(xml_path).getroot()
+    except ElementTree.ParseError as e:
+        log_and_exit(f"Invalid Crashlytics mapping file id resource {xml_path}: {e}")
+    return {element.get('name'): (element.text or '').strip() for element in root.iter('string')}
+
+
+def gzip_chunks(path, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Reads a file and yields it gzip compressed, so large mapping files are uploaded without being loaded or
+    compressed in memory as a whole.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+    yield compressor.flush()
+
+
+def _session():
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = pooled_session()
+        return _shared_session
 
 
 class Crashlytics(CrashAnalytics):
     """
     Crashlytics service for uploading deobfuscation mapping files to Firebase Crashlytics.
     """
-    def __init__(self, deobfuscation_script_output, firebase_app_id):
+    def __init__(self, deobfuscation_script_output, firebase_app_id, access_token=None, api_key=None, session=None,
+                 retries=2, ledger=None, force=False):
         """
         Initialize Crashlytics with the deobfuscation script output path and Firebase App ID.
 
         :param deobfuscation_script_output: Path to the deobfuscation script output file
         :param firebase_app_id: Firebase App ID for Crashlytics
+        :param access_token: OAuth2 access token of the Firebase project (default: $FIREBASE_ACCESS_TOKEN)
+        :param api_key: Google API key of the app (default: $FIREBASE_API_KEY, or the google_api_key resource of
+            the deobfuscation script output)
+        :param session: requests session for the upload, default is a pooled session shared by all uploads
+        :param retries: Retries of an upload on connection errors, 429 and 5xx responses
+        :param ledger: UploadLedger of the uploads that already succeeded (optional)
+        :param force: Upload even when the ledger has the upload
         """
-        super().__init__(deobfuscation_script_output, firebase_app_id)
+        super().__init__(deobfuscation_script_output, firebase_app_id, ledger, force)
+        self.access_token = access_token or getenv(FIREBASE_ACCESS_TOKEN_ENV)
+        self.api_key = api_key or getenv(FIREBASE_API_KEY_ENV)
+        self.session = session
+        self.retries = retries
 
     def upload_mappingfileid_file(self, tmpdir):
         """
         Upload the Crashlytics mapping file to Firebase using the provided Firebase App ID.
 
         :param tmpdir: Temporary directory where files are extracted
-        :return: None
+        :return: True when the mapping file was uploaded
         """
-        mappingfileid_file = os.path.join(tmpdir, "com_google_firebase_crashlytics_mappingfileid.xml")
+        mappingfileid_file = os.path.join(tmpdir, MAPPING_FILE_ID_XML)
 
         if not os.path.exists(mappingfileid_file):
-            logging.warning("Missing com_google_firebase_crashlytics_mappingfileid.xml file. "
+            logging.warning(f"Missing {MAPPING_FILE_ID_XML} file. "
                             "Skipping code deobfuscation mapping file upload to Crashlytics.")
-            return
-
-        subprocess.call(
-            f"firebase crashlytics:mappingfile:upload --app={self.faid_or_dd_api_key} --resource-file={mappingfileid_file} "
-            f"{os.path.join(tmpdir, 'mapping.txt')}", shell=True)
+            return False
 
+        resources = read_string_resources(mappingfileid_file)
+        mapping_file_id = resources.get(MAPPING_FILE_ID_NAME)
+        if not mapping_file_id:
+            log_and_exit(f"{MAPPING_FILE_ID_XML} has no {MAPPING_FILE_ID_NAME} string")
+        mapping_file_path = os.path.join(tmpdir, 'mapping.txt')
+        return self.upload_once(f"crashlytics:{self.faid_or_dd_api_key}", mapping_file_path, mapping_file_id,
+                                lambda: self.api_call_upload_mapping_file(
+                                    mapping_file_id, mapping_file_path,
+                                    self.api_key or resources.get(GOOGLE_API_KEY_NAME)))
 
+    def api_call_upload_mapping_file(self, mapping_file_id, mapping_file_path, api_key=None):
+        """
+        Uploads mapping.txt gzip compressed and streamed, retrying connection errors, 429 and 5xx responses.
 
+        :param mapping_file_id: Crashlytics mapping file id of the build
+        :param mapping_file_path: Path to the mapping.txt file
+        :param api_key: Google API key of the app (default: the api_key of this instance)
+        :return: True
+        :raise AppdomeError: When there is neither an access token nor an API key to authenticate the upload
+        """
+        api_key = api_key or self.api_key
+        if not self.access_token and not api_key:
+            log_and_exit(f"Crashlytics mapping file upload requires ${FIREBASE_ACCESS_TOKEN_ENV}, "
+                         f"${FIREBASE_API_KEY_ENV} or a {GOOGLE_API_KEY_NAME} resource in the deobfuscation zip")
+        url = CRASHLYTICS_UPLOAD_URL.format(app_id=self.faid_or_dd_api_key, mapping_file_id=mapping_file_id)
+        headers = {'Content-Type': 'application/octet-stream', 'Content-Encoding': 'gzip'}
+        if self.access_token:
+            headers['Authorization'] = f"Bearer {self.access_token}"
+        if api_key:
+            headers['X-Goog-Api-Key'] = api_key
 
+        session = self.session or _session()
+        for attempt in range(self.retries + 1):
+            try:
+                # The body generator is recreated on every attempt, so a retry sends the whole file again
+                response = session.post(url, headers=headers, data=gzip_chunks(mapping_file_path),
+                                        timeout=request_timeout())
+            except requests.exceptions.ConnectionError as e:
+                if attempt == self.retries:
+                    raise AppdomeError(f"Crashlytics mapping file upload failed: {e}") from e
+                continue
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.retries:
+                break
+            logging.debug(f"Retrying Crashlytics mapping file upload after status {response.status_code}")
+        if response.status_code not in (200, 201, 202, 204):
+            log_and_exit(f"Failed to upload mapping file to Crashlytics. Status code: {response.status_code}. "
+                         f"Response: {response.text}", AppdomeApiError, status_code=response.status_code,
+                         response_text=response.text)
+        logging.info(f"Mapping file {mapping_file_id} uploaded successfully to Crashlytics!")
+        return True
@@ -1,41 +1,50 @@
+import hashlib
 import os
 import logging
 import json
 import requests
 from crash_analytics import CrashAnalytics
 from CustomMultipartEncoder import CustomMultipartEncoder
+from utils import request_timeout
 
 
 class DataDog(CrashAnalytics):
     """
     DataDog service for uploading deobfuscation mapping files to DataDog.
     """
-    def __init__(self, deobfuscation_script_output, dd_api_key):
+    def __init__(self, deobfuscation_script_output, dd_api_key, ledger=None, force=False):
         """
         Initialize DataDog with the deobfuscation script output path and DataDog API key.
 
         :param deobfuscation_script_output: Path to the deobfuscation script output file
         :param dd_api_key: DataDog API key
+        :param ledger: UploadLedger of the uploads that already succeeded (optional)
+        :param force: Upload even when the ledger has the upload
         """
-        super().__init__(deobfuscation_script_output, dd_api_key)
+        super().__init__(deobfuscation_script_output, dd_api_key, ledger, force)
 
     def upload_mappingfileid_file(self, tmpdir):
         """
         Upload the DataDog mapping file using the provided DataDog API key.
 
         :param tmpdir: Temporary directory where files are extracted
-        :return: None
+        :return: True when the mapping file was uploaded
         """
         mappingfileid_file = os.path.join(tmpdir, "data_dog_metadata.json")
 
         if not os.path.exists(mappingfileid_file):
             logging.warning("Missing datadog_mapping file. Skipping code deobfuscation mapping file upload to DataDog.")
-            return
+            return False
 
         build_id, service_name, version = self.load_json(mappingfileid_file)
-        self.api_call_upload_mapping_file(api_key=self.faid_or_dd_api_key, build_id=build_id, version_name=version,
-                                          service_name=service_name,
-                                          mapping_file_path=os.path.join(tmpdir, "mapping.txt"))
+        mapping_file_path = os.path.join(tmpdir, "mapping.txt")
+        # The api key identifies the DataDog organization, only its hash is kept in the ledger
+        organization = hashlib.sha256(self.faid_or_dd_api_key.encode('utf-8')).hexdigest()[:16]
+        destination = f"datadog:{os.environ.get('DD_SITE', 'datadoghq.com')}:{organization}:{service_name}"
+        return self.upload_once(destination, mapping_file_path, f"{build_id}:{version}",
+                                lambda: self.api_call_upload_mapping_file(
+                                    api_key=self.faid_or_dd_api_key, build_id=build_id, version_name=version,
+                                    service_name=service_name, mapping_file_path=mapping_file_path))
 
     def load_json(self, file_path):
         """
@@ -63,7 +72,7 @@ class DataDog(CrashAnalytics):
         :param version_name: Version name from metadata
         :param service_name: Service name from metadata
         :param mapping_file_path: Path to the mapping.txt file
-        :return: None
+        :return: True when the mapping file was uploaded
         """
 
         # Set environment variables (if needed)
@@ -95,10 +104,11 @@ class DataDog(CrashAnalytics):
         }
 
         # Send the POST request to Datadog
-        response = requests.post(url, headers=headers, data=encoder.to_string())
+        response = requests.post(url, headers=headers, data=encoder.to_string(), timeout=request_timeout())
 
         if response.status_code == 202:
             logging.info("Mapping file uploaded successfully to Data Dog!")
-        else:
-            logging.info(f"Failed to upload mapping file to DataDog. Status code: {response.status_code}")
-            logging.info(f"Response: {response.text}")
+            return True
+        logging.info(f"Failed to upload mapping file to DataDog. Status code: {response.status_code}")
+        logging.info(f"Response: {response.text}")
+        return False
@@ -0,0 +1,89 @@
+import logging
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+# Relative share of the remaining time budget each pipeline phase gets, in pipeline order
+PHASE_WEIGHTS = {'upload': 1, 'build': 6, 'context': 1, 'sign': 2, 'download': 1}
+
+_active_deadline = None
+
+
+def _phase_key(name):
+    """
+    Maps a phase name to its PHASE_WEIGHTS key, e.g. 'sign [release]' to 'sign' and 'mapping upload' to 'download'.
+    """
+    key = name.split(' [')[0].split(' ')[0]
+    return key if key in PHASE_WEIGHTS else 'download'
+
+
+class Deadline:
+    """
+    End-to-end time budget of a pipeline. Every phase gets a share of the time that is left when it starts,
+    in proportion to its weight among the phases still to run, so time a phase does not use carries over to the
+    next ones. Network calls and polling loops of a phase must finish before the phase deadline.
+    """
+    def __init__(self, total_sec, weights=None):
+        self.total_sec = total_sec
+        self.weights = weights or PHASE_WEIGHTS
+        self.expires = monotonic() + total_sec
+        self._local = threading.local()
+
+    def _phase_budget_sec(self, name):
+        keys = list(self.weights)
+        key = _phase_key(name)
+        pending_weight = sum(self.weights[k] for k in keys[keys.index(key):])
+        return max(self.expires - monotonic(), 0) * self.weights[key] / pending_weight
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Limits the enclosed block to the budget of the phase.
+
+        :param name: Phase name, e.g. 'build' or 'download output'
+        """
+        parent = getattr(self._local, 'phase', None)
+        budget_sec = self._phase_budget_sec(name)
+        self._local.phase = (name, min(monotonic() + budget_sec, self.expires))
+        logging.debug(f"Deadline of phase {name}: {budget_sec:.1f} seconds")
+        try:
+            yield
+        finally:
+            self._local.phase = parent
+
+    def remaining(self):
+        """
+        :return: (seconds left, name of the phase whose deadline applies or None for the pipeline deadline)
+        """
+        phase = getattr(self._local, 'phase', None)
+        if phase and phase[1] < self.expires:
+            return phase[1] - monotonic(), phase[0]
+        return self.expires - monotonic(), None
+
+
+def active_deadline():
+    """
+    :return: The pipeline deadline of the process, or None when there is none
+    """
+    return _active_deadline
+
+
+def start_deadline(total_sec):
+    """
+    Starts the process wide pipeline deadline, passed down to every Appdome API call and status polling loop.
+    """
+    global _active_deadline
+    _active_deadline = Deadline(total_sec) if total_sec else None
+    return _active_deadline
+
+
+@contextmanager
+def deadline_phase(name):
+    """
+    Runs the enclosed block under the budget of a phase of the active deadline, if any.
+    """
+    if not _active_deadline:
+        yield
+        return
+    with _active_deadline.phase(name):
+        yield
@@ -2,20 +2,19 @@ import argparse
 import logging
 from os.path import basename
 
-import requests
-
-from utils import (build_url, team_params, SERVER_API_V1_URL, request_headers, validate_response,
+from utils import (http_post, build_url, team_params, SERVER_API_V1_URL, request_headers, validate_response,
                    debug_log_request, add_common_args, init_common_args)
+from models import parse_upload
 
 
-def direct_upload(api_key, team_id, file_path):
+def direct_upload(api_key, team_id, file_path, file_name=None):
     url = build_url(SERVER_API_V1_URL, 'upload')
     params = team_params(team_id)
     headers = request_headers(api_key)
     with open(file_path, 'rb') as f:
-        files = {'file': (basename(file_path), f)}
+        files = {'file': (file_name or basename(file_path), f)}
         debug_log_request(url, headers=headers, params=params, files=files)
-        return requests.post(url, headers=headers, params=params, files=files)
+        return http_post(url, headers=headers, params=params, files=files)
 
 
 def parse_arguments():
@@ -30,7 +29,7 @@ def main():
     init_common_args(args)
     r = direct_upload(args.api_key, args.team_id, args.app_path)
     validate_response(r)
-    logging.info(f"Direct upload success: App id: {r.json()['id']}")
+    logging.info(f"Direct upload success: App id: {parse_upload(r).id}")
 
 
 if __name__ == '__main__':
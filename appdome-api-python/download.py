@@ -1,26 +1,41 @@
 import argparse
 import logging
+from time import time
 
-from utils import (validate_response, add_common_args, init_common_args, validate_output_path, task_output_command)
+from utils import (add_common_args, init_common_args, validate_output_path, task_output_command)
 from status import _get_obfuscation_map_status
+from artifact_cache import add_artifact_cache_args, init_artifact_cache, fetch_artifact
+from artifact_stream import ArtifactManifest
+from artifact_tee import add_tee_args, init_tee, check_tee
 
 
-def download(api_key, team_id, task_id, action=None):
-    return task_output_command(api_key, team_id, task_id, 'output', action)
+def download(api_key, team_id, task_id, action=None, stream=False, extra_headers=None):
+    return task_output_command(api_key, team_id, task_id, 'output', action, stream, extra_headers=extra_headers)
 
 
-def download_action(api_key, team_id, task_id, command_output_path, action):
+def download_action(api_key, team_id, task_id, command_output_path, action, manifest=None, processors=None,
+                    cache=None, tee=None):
+    """
+    :param processors: Download post-processing chain (see artifact_stream.stream_to_file)
+    :param tee: artifact_tee.TeeDestinations the output is also written to, after the processors
+    """
     if not command_output_path:
         return
     validate_output_path(command_output_path)
-    r = download(api_key, team_id, task_id, action)
-    if action == 'deobfuscation_script' and r.status_code == 404:
+    if tee:
+        processors = list(processors or []) + [tee.processor(command_output_path)]
+    started = time()
+    digest = fetch_artifact(cache, team_id, task_id, action or 'output',
+                            lambda headers: download(api_key, team_id, task_id, action, True, headers),
+                            command_output_path, processors, missing_ok=action == 'deobfuscation_script')
+    if digest is None:
         logging.debug(f"couldn't find deobfuscation scripts.")
         return
-    validate_response(r)
-    with open(command_output_path, 'wb') as f:
-        f.write(r.content)
+    if manifest:
+        manifest.add(command_output_path, task_id=task_id, kind=action or 'output', started=started, finished=time(),
+                     **digest)
     logging.info(f"Downloaded {action + ' ' if action else ''}output file to {command_output_path}")
+    check_tee(digest, command_output_path)
 
 
 def parse_arguments():
@@ -29,16 +44,25 @@ def parse_arguments():
     parser.add_argument('-o', '--output', required=True, metavar='output_app_file', help='Output file for fused and signed app after Appdome')
     parser.add_argument('--deobfuscation_script_output', metavar='deobfuscation_scripts_zip_file', help='Output file deobfuscation scripts when building with "Obfuscate App Logic"')
     parser.add_argument('--sign_second_output', metavar='second_output_app_file', help='Output file for secondary output file - universal apk when building an aab app')
+    parser.add_argument('--manifest', metavar='manifest_json_file', help='Output file for a manifest with the size, sha256 and timing of every downloaded file')
+    add_artifact_cache_args(parser)
+    add_tee_args(parser)
     return parser.parse_args()
 
 
 def main():
     args = parse_arguments()
     init_common_args(args)
-    download_action(args.api_key, args.team_id, args.task_id, args.output, None)
+    validate_output_path(args.manifest)
+    manifest = ArtifactManifest(args.manifest) if args.manifest else None
+    cache = init_artifact_cache(args)
+    tee = init_tee(args)
+    download_action(args.api_key, args.team_id, args.task_id, args.output, None, manifest, cache=cache, tee=tee)
     if _get_obfuscation_map_status(args.api_key, args.team_id, args.task_id):
-        download_action(args.api_key, args.team_id, args.task_id, args.deobfuscation_script_output, 'deobfuscation_script')
-    download_action(args.api_key, args.team_id, args.task_id, args.sign_second_output, 'sign_second_output')
+        download_action(args.api_key, args.team_id, args.task_id, args.deobfuscation_script_output, 'deobfuscation_script', manifest, cache=cache, tee=tee)
+    download_action(args.api_key, args.team_id, args.task_id, args.sign_second_output, 'sign_second_output', manifest, cache=cache, tee=tee)
+    if manifest:
+        manifest.write()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,144 @@
+import logging
+import os
+import threading
+from types import SimpleNamespace
+
+import requests
+
+try:
+    import httpx
+    import h2  # noqa: F401 - httpx negotiates HTTP/2 only when the h2 package is installed
+except ImportError:
+    httpx = None
+
+HTTP2_ENV = 'APPDOME_HTTP2'
+# APPDOME_HTTP2 value sending cleartext HTTP/2 without negotiation, to servers known to speak it (e.g. a local mock)
+PRIOR_KNOWLEDGE = 'h2c'
+# Errors raised while the connection is being opened, before any of the request is sent
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout) if httpx else ()
+
+
+class Http2Response:
+    """
+    Exposes an httpx response through the parts of the requests.Response interface the client uses, so callers
+    do not depend on the transport.
+    """
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.http_version = response.http_version
+        try:
+            body = response.request.content
+        except httpx.RequestNotRead:  # streamed multipart body
+            body = None
+        self.request = SimpleNamespace(url=str(response.request.url), headers=response.request.headers, body=body)
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def elapsed(self):
+        try:
+            return self._response.elapsed
+        except RuntimeError:  # streamed responses have no elapsed time until they are closed
+            return None
+
+    @property
+    def content(self):
+        return self._response.read()
+
+    @property
+    def text(self):
+        self._response.read()
+        return self._response.text
+
+    def json(self, **kwargs):
+        self._response.read()
+        return self._response.json(**kwargs)
+
+    def iter_content(self, chunk_size=None):
+        return self._response.iter_bytes(chunk_size)
+
+    def close(self):
+        self._response.close()
+
+
+class Http2Transport:
+    """
+    Sends requests over HTTP/2 when the server supports it, so concurrent requests to the same host are multiplexed
+    on one connection with compressed headers. The protocol is negotiated per connection (TLS ALPN) and falls back to
+    HTTP/1.1. The client is thread safe and shared by all threads.
+    """
+    def __init__(self, max_connections=10, prior_knowledge=False):
+        """
+        :param max_connections: Maximum connections per host, used when the server only speaks HTTP/1.1
+        :param prior_knowledge: Send HTTP/2 without negotiating it, also over cleartext http:// connections. Servers
+            that only speak HTTP/1.1 fail
+        """
+        self.client = httpx.Client(http1=not prior_knowledge, http2=True, timeout=None,
+                                   limits=httpx.Limits(max_connections=max_connections,
+                                                       max_keepalive_connections=max_connections))
+        # httpcore takes the next HTTP/2 stream id before sending the request headers without holding a lock, so
+        # concurrent requests could send their headers out of order (or reuse an id) and the server resets the
+        # connection. Request starts are serialized until their headers are sent; the rest is still multiplexed.
+        self._headers_lock = threading.Lock()
+
+    def request(self, method, url, params=None, headers=None, data=None, files=None, json=None, stream=False,
+                timeout=None, allow_redirects=True):
+        """
+        Sends a request with the requests keyword arguments.
+
+        :return: Http2Response
+        """
+        content = None
+        if data is not None and not isinstance(data, (dict, list, tuple)):
+            content, data = data, None  # Raw body: text, bytes, a file or an iterator of bytes
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        request = self.client.build_request(method.upper(), url, params=params, headers=headers, data=data,
+                                            files=files, json=json, content=content, timeout=timeout)
+        held = [self._headers_lock.acquire()]
+
+        def release_after_headers(event, info):
+            if held[0] and event.endswith(('send_request_headers.complete', 'send_request_headers.failed')):
+                held[0] = False
+                self._headers_lock.release()
+
+        request.extensions['trace'] = release_after_headers
+        try:
+            response = self.client.send(request, stream=stream, follow_redirects=allow_redirects)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+        finally:
+            if held[0]:  # The request failed before its headers were sent
+                held[0] = False
+                self._headers_lock.release()
+        logging.debug(f"{method.upper()} {url} sent over {response.http_version}")
+        return Http2Response(response)
+
+    def close(self):
+        self.client.close()
+
+
+def init_http2_transport(enabled=None):
+    """
+    Creates the HTTP/2 transport when enabled with APPDOME_HTTP2=on or --http2. Returns None when disabled or when
+    httpx with HTTP/2 support is not installed, in which case requests are sent with requests over HTTP/1.1.
+    APPDOME_HTTP2=h2c sends HTTP/2 with prior knowledge (see Http2Transport).
+
+    :param enabled: Overrides the environment variable
+    """
+    mode = os.getenv(HTTP2_ENV, 'off').lower()
+    if enabled is None:
+        enabled = mode in ('on', 'true', '1', PRIOR_KNOWLEDGE)
+    if not enabled:
+        return None
+    if httpx is None:
+        logging.warning("HTTP/2 requires 'pip install httpx[http2]', falling back to HTTP/1.1")
+        return None
+    return Http2Transport(prior_knowledge=mode == PRIOR_KNOWLEDGE)
@@ -0,0 +1,513 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from os import getenv
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+import appdome_api
+from utils import log_and_exit, init_logging, AppdomeError, AppdomeLeaseError
+
+JOB_QUEUE_ENV = 'APPDOME_JOB_QUEUE'
+DEFAULT_LEASE_SEC = 300
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_SEC = 5
+LEASE_EXPIRED_ERROR = 'Lease expired after the last attempt'
+
+QUEUE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    argv TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker_id TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_tasks (
+    job_id TEXT NOT NULL REFERENCES jobs (job_id),
+    kind TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    worker_id TEXT NOT NULL,
+    recorded REAL NOT NULL,
+    PRIMARY KEY (job_id, kind)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created);
+'''
+
+
+class Job:
+    """
+    A pipeline job: the appdome_api.py arguments of one app, and the task ids previous attempts recorded.
+    """
+    def __init__(self, job_id, argv, attempts=0, tasks=None):
+        self.job_id = job_id
+        self.argv = argv
+        self.attempts = attempts
+        self.tasks = tasks or {}
+
+
+class JobQueue(ABC):
+    """
+    Backend of the job queue shared by the workers. A worker leases a job for lease_sec and renews the lease with
+    heartbeats while it runs it. A job whose lease expired, because its worker died or was preempted, is leased
+    again by another worker, up to max_attempts. Task ids are recorded once per job and kind, and only by the
+    worker holding the lease.
+    """
+    @abstractmethod
+    def enqueue(self, job_id, argv, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        :param argv: appdome_api.py arguments of the job
+        :return: False when a job with this id was already queued
+        """
+        pass
+
+    @abstractmethod
+    def lease(self, worker_id, lease_sec):
+        """
+        :return: Next queued or expired Job, now leased to worker_id, or None when there is none
+        """
+        pass
+
+    @abstractmethod
+    def heartbeat(self, job_id, worker_id, lease_sec):
+        """
+        Renews a lease for lease_sec.
+
+        :return: False when worker_id does not hold the lease anymore
+        """
+        pass
+
+    @abstractmethod
+    def record_task(self, job_id, worker_id, kind, task_id):
+        """
+        Records the task id of a job step, once. A later record of the same kind keeps the first task id.
+
+        :param kind: Task kind, e.g. 'upload', 'build' or 'sign [release]'
+        :return: The recorded task id
+        :raise AppdomeLeaseError: When worker_id does not hold the lease
+        """
+        pass
+
+    @abstractmethod
+    def finish(self, job_id, worker_id, state, error=None):
+        """
+        :param state: 'succeeded' or 'failed'
+        :return: False when worker_id does not hold the lease anymore
+        """
+        pass
+
+    @abstractmethod
+    def jobs(self):
+        """
+        :return: List of job dicts (job_id, state, worker_id, attempts, max_attempts, error, tasks), oldest first
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    Job queue in an SQLite file, which the workers of several nodes can share on network storage. Every change is
+    a short immediate transaction, so concurrent workers wait on the database lock instead of racing.
+    """
+    def __init__(self, path, busy_timeout_sec=30):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=busy_timeout_sec, isolation_level=None, check_same_thread=False)
+        with self._transaction():
+            for statement in QUEUE_SCHEMA.split(';'):
+                if statement.strip():
+                    self._db.execute(statement)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _holds(self, job_id, worker_id):
+        return self._db.execute("SELECT 1 FROM jobs WHERE job_id = ? AND worker_id = ? AND state = 'leased'",
+                                (job_id, worker_id)).fetchone() is not None
+
+    def enqueue(self, job_id, argv, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        now = time.time()
+        with self._transaction():
+            cursor = self._db.execute("INSERT OR IGNORE INTO jobs (job_id, argv, state, max_attempts, created, updated) "
+                                      "VALUES (?, ?, 'queued', ?, ?, ?)", (job_id, json.dumps(argv), max_attempts,
+                                                                           now, now))
+        return cursor.rowcount == 1
+
+    def lease(self, worker_id, lease_sec):
+        now = time.time()
+        with self._transaction():
+            self._db.execute("UPDATE jobs SET state = 'failed', error = ?, updated = ? WHERE state = 'leased' AND "
+                             "lease_expires < ? AND attempts >= max_attempts", (LEASE_EXPIRED_ERROR, now, now))
+            row = self._db.execute("SELECT job_id, argv, attempts FROM jobs WHERE state = 'queued' OR "
+                                   "(state = 'leased' AND lease_expires < ?) ORDER BY created LIMIT 1",
+                                   (now,)).fetchone()
+            if not row:
+                return None
+            job_id, argv, attempts = row
+            self._db.execute("UPDATE jobs SET state = 'leased', worker_id = ?, lease_expires = ?, "
+                             "attempts = attempts + 1, updated = ? WHERE job_id = ?",
+                             (worker_id, now + lease_sec, now, job_id))
+            tasks = dict(self._db.execute('SELECT kind, task_id FROM job_tasks WHERE job_id = ?', (job_id,)))
+        return Job(job_id, json.loads(argv), attempts + 1, tasks)
+
+    def heartbeat(self, job_id, worker_id, lease_sec):
+        now = time.time()
+        with self._transaction():
+            cursor = self._db.execute("UPDATE jobs SET lease_expires = ?, updated = ? WHERE job_id = ? AND "
+                                      "worker_id = ? AND state = 'leased'", (now + lease_sec, now, job_id, worker_id))
+        return cursor.rowcount == 1
+
+    def record_task(self, job_id, worker_id, kind, task_id):
+        with self._transaction():
+            if not self._holds(job_id, worker_id):
+                log_and_exit(f"Job {job_id} is not leased by {worker_id} anymore", AppdomeLeaseError)
+            self._db.execute('INSERT OR IGNORE INTO job_tasks VALUES (?, ?, ?, ?, ?)',
+                             (job_id, kind, task_id, worker_id, time.time()))
+            return self._db.execute('SELECT task_id FROM job_tasks WHERE job_id = ? AND kind = ?',
+                                    (job_id, kind)).fetchone()[0]
+
+    def finish(self, job_id, worker_id, state, error=None):
+        with self._transaction():
+            cursor = self._db.execute("UPDATE jobs SET state = ?, error = ?, lease_expires = NULL, updated = ? "
+                                      "WHERE job_id = ? AND worker_id = ? AND state = 'leased'",
+                                      (state, error, time.time(), job_id, worker_id))
+        return cursor.rowcount == 1
+
+    def jobs(self):
+        with self._lock:
+            rows = self._db.execute('SELECT job_id, state, worker_id, attempts, max_attempts, error FROM jobs '
+                                    'ORDER BY created').fetchall()
+            tasks = {}
+            for job_id, kind, task_id in self._db.execute('SELECT job_id, kind, task_id FROM job_tasks'):
+                tasks.setdefault(job_id, {})[kind] = task_id
+        return [{'job_id': job_id, 'state': state, 'worker_id': worker_id, 'attempts': attempts,
+                 'max_attempts': max_attempts, 'error': error, 'tasks': tasks.get(job_id, {})}
+                for job_id, state, worker_id, attempts, max_attempts, error in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# Redis scripts run atomically on the server. KEYS[1] is the queue sorted set, scored by the time a job can be leased
+_REDIS_ENQUEUE = '''
+local key = ARGV[1] .. ':job:' .. ARGV[2]
+if redis.call('EXISTS', key) == 1 then return 0 end
+redis.call('HSET', key, 'argv', ARGV[3], 'state', 'queued', 'attempts', 0, 'max_attempts', ARGV[4],
+           'created', ARGV[5])
+redis.call('ZADD', KEYS[1], ARGV[5], ARGV[2])
+redis.call('RPUSH', ARGV[1] .. ':jobs', ARGV[2])
+return 1
+'''
+_REDIS_LEASE = '''
+local now = tonumber(ARGV[2])
+while true do
+    local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, 1)
+    if #ids == 0 then return false end
+    local key = ARGV[1] .. ':job:' .. ids[1]
+    local attempts = tonumber(redis.call('HGET', key, 'attempts'))
+    if attempts >= tonumber(redis.call('HGET', key, 'max_attempts')) then
+        redis.call('ZREM', KEYS[1], ids[1])
+        redis.call('HSET', key, 'state', 'failed', 'error', ARGV[5])
+    else
+        local expires = now + tonumber(ARGV[4])
+        redis.call('ZADD', KEYS[1], expires, ids[1])
+        redis.call('HSET', key, 'state', 'leased', 'worker_id', ARGV[3], 'attempts', attempts + 1,
+                   'lease_expires', expires)
+        return {ids[1], redis.call('HGET', key, 'argv'), attempts + 1,
+                redis.call('HGETALL', ARGV[1] .. ':tasks:' .. ids[1])}
+    end
+end
+'''
+_REDIS_HOLDS = '''
+local key = ARGV[1] .. ':job:' .. ARGV[2]
+if redis.call('HGET', key, 'worker_id') ~= ARGV[3] or redis.call('HGET', key, 'state') ~= 'leased' then
+    return false
+end
+'''
+_REDIS_HEARTBEAT = _REDIS_HOLDS + '''
+local expires = tonumber(ARGV[4]) + tonumber(ARGV[5])
+redis.call('HSET', key, 'lease_expires', expires)
+redis.call('ZADD', KEYS[1], expires, ARGV[2])
+return 1
+'''
+_REDIS_RECORD_TASK = _REDIS_HOLDS + '''
+local tasks = ARGV[1] .. ':tasks:' .. ARGV[2]
+redis.call('HSETNX', tasks, ARGV[4], ARGV[5])
+return redis.call('HGET', tasks, ARGV[4])
+'''
+_REDIS_FINISH = _REDIS_HOLDS + '''
+redis.call('HSET', key, 'state', ARGV[4], 'error', ARGV[5])
+redis.call('HDEL', key, 'lease_expires')
+redis.call('ZREM', KEYS[1], ARGV[2])
+return 1
+'''
+
+
+class RedisJobQueue(JobQueue):
+    """
+    Job queue on a Redis (or Redis protocol compatible) server. Requires the redis package.
+    """
+    def __init__(self, url, prefix='appdome'):
+        if not redis:
+            log_and_exit("The redis job queue requires the redis package: pip install redis")
+        self.prefix = prefix
+        self.queue_key = f"{prefix}:queue"
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+        self._scripts = {name: self._client.register_script(script) for name, script in (
+            ('enqueue', _REDIS_ENQUEUE), ('lease', _REDIS_LEASE), ('heartbeat', _REDIS_HEARTBEAT),
+            ('record_task', _REDIS_RECORD_TASK), ('finish', _REDIS_FINISH))}
+
+    def _run(self, name, *args):
+        return self._scripts[name](keys=[self.queue_key], args=[self.prefix] + list(args))
+
+    def enqueue(self, job_id, argv, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        return self._run('enqueue', job_id, json.dumps(argv), max_attempts, time.time()) == 1
+
+    def lease(self, worker_id, lease_sec):
+        leased = self._run('lease', time.time(), worker_id, lease_sec, LEASE_EXPIRED_ERROR)
+        if not leased:
+            return None
+        job_id, argv, attempts, tasks = leased
+        return Job(job_id, json.loads(argv), int(attempts), dict(zip(tasks[::2], tasks[1::2])))
+
+    def heartbeat(self, job_id, worker_id, lease_sec):
+        return bool(self._run('heartbeat', job_id, worker_id, time.time(), lease_sec))
+
+    def record_task(self, job_id, worker_id, kind, task_id):
+        recorded = self._run('record_task', job_id, worker_id, kind, task_id)
+        if not recorded:
+            log_and_exit(f"Job {job_id} is not leased by {worker_id} anymore", AppdomeLeaseError)
+        return recorded
+
+    def finish(self, job_id, worker_id, state, error=None):
+        return bool(self._run('finish', job_id, worker_id, state, error or ''))
+
+    def jobs(self):
+        jobs = []
+        for job_id in self._client.lrange(f"{self.prefix}:jobs", 0, -1):
+            job = self._client.hgetall(f"{self.prefix}:job:{job_id}")
+            jobs.append({'job_id': job_id, 'state': job.get('state'), 'worker_id': job.get('worker_id'),
+                         'attempts': int(job.get('attempts', 0)), 'max_attempts': int(job.get('max_attempts', 0)),
+                         'error': job.get('error') or None,
+                         'tasks': self._client.hgetall(f"{self.prefix}:tasks:{job_id}")})
+        return jobs
+
+    def close(self):
+        self._client.close()
+
+
+def open_job_queue(url):
+    """
+    :param url: redis://host:port/db for a Redis queue, otherwise an SQLite file path (optionally sqlite:///path)
+    :return: JobQueue
+    """
+    if not url:
+        log_and_exit(f"--queue or ${JOB_QUEUE_ENV} must be specified")
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisJobQueue(url)
+    return SQLiteJobQueue(url[len('sqlite:///'):] if url.startswith('sqlite:///') else url)
+
+
+class JobLease:
+    """
+    A job leased by a worker. While it is entered, a heartbeat thread renews the lease every third of lease_sec.
+    The lease is lost when a heartbeat is refused, or when the heartbeats failed for lease_sec and the queue let the
+    lease expire. From then on check and record_task fail with AppdomeLeaseError, which stops the pipeline of the job
+    at its next phase.
+    """
+    def __init__(self, queue, job, worker_id, lease_sec=DEFAULT_LEASE_SEC):
+        self.queue = queue
+        self.job = job
+        self.worker_id = worker_id
+        self.lease_sec = lease_sec
+        self.lost = False
+        self._renewed = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def task(self, kind):
+        """
+        :return: Task id of kind recorded by a previous attempt of the job, to be re-attached, or None
+        """
+        return self.job.tasks.get(kind)
+
+    def check(self):
+        """
+        :raise AppdomeLeaseError: Once the lease was lost, since another worker may be running the job by now
+        """
+        if self.lost:
+            log_and_exit(f"Lease of job {self.job.job_id} was lost", AppdomeLeaseError)
+
+    def record_task(self, kind, task_id):
+        self.check()
+        recorded = self.queue.record_task(self.job.job_id, self.worker_id, kind, task_id)
+        self.job.tasks[kind] = recorded
+        return recorded
+
+    def finish(self, state, error=None):
+        self._stop.set()
+        if not self.queue.finish(self.job.job_id, self.worker_id, state, error):
+            logging.warning(f"Job {self.job.job_id} was taken over by another worker before it finished")
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.lease_sec / 3):
+            try:
+                renewed = self.queue.heartbeat(self.job.job_id, self.worker_id, self.lease_sec)
+            except Exception as e:
+                logging.warning(f"Heartbeat of job {self.job.job_id} failed: {e}")
+                renewed = time.monotonic() - self._renewed < self.lease_sec
+            else:
+                if renewed:
+                    self._renewed = time.monotonic()
+            if not renewed:
+                self.lost = True
+                logging.error(f"Lease of job {self.job.job_id} was lost")
+                return
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._heartbeat, name=f"appdome-lease-{self.job.job_id}", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_pipeline_job(lease):
+    """
+    Runs the appdome_api.py pipeline of a leased job, re-attaching to the tasks a previous attempt recorded.
+    """
+    appdome_api.main(lease.job.argv, job=lease)
+
+
+def run_worker(queue, worker_id, run_job=run_pipeline_job, lease_sec=DEFAULT_LEASE_SEC, poll_sec=DEFAULT_POLL_SEC,
+               max_jobs=None, exit_when_empty=False):
+    """
+    Leases and runs jobs one at a time until the queue is empty (with exit_when_empty) or max_jobs ran.
+
+    :param run_job: Callable running a JobLease, raising when the job failed
+    :return: Dict of job state to the number of jobs that ended in it
+    """
+    counts = {'succeeded': 0, 'failed': 0, 'lost': 0}
+    while max_jobs is None or sum(counts.values()) < max_jobs:
+        job = queue.lease(worker_id, lease_sec)
+        if not job:
+            if exit_when_empty:
+                break
+            time.sleep(poll_sec)
+            continue
+        logging.info(f"Worker {worker_id} leased job {job.job_id} (attempt {job.attempts})"
+                     f"{f', re-attaching to {job.tasks}' if job.tasks else ''}")
+        with JobLease(queue, job, worker_id, lease_sec) as lease:
+            try:
+                run_job(lease)
+            except AppdomeLeaseError as e:
+                logging.error(f"Job {job.job_id} stopped: {e}")
+                counts['lost'] += 1
+                continue
+            except Exception as e:
+                if lease.lost:
+                    logging.error(f"Job {job.job_id} stopped after its lease was lost: {e}")
+                    counts['lost'] += 1
+                    continue
+                logging.error(f"Job {job.job_id} failed: {e}")
+                lease.finish('failed', str(e))
+                counts['failed'] += 1
+                continue
+            lease.finish('succeeded')
+            counts['succeeded'] += 1
+            logging.info(f"Job {job.job_id} succeeded")
+    return counts
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Queue appdome_api.py pipelines and run them on any number of workers',
+                                     epilog='enqueue takes the appdome_api.py arguments of the job after --')
+    parser.add_argument('command', choices=['enqueue', 'worker', 'status'],
+                        help='enqueue: queue a pipeline job, worker: run queued jobs, status: list the jobs')
+    parser.add_argument('--queue', metavar='queue_url', default=getenv(JOB_QUEUE_ENV),
+                        help=f'SQLite file on storage shared by the workers, or redis://host:port/db. '
+                             f'Default: ${JOB_QUEUE_ENV}')
+    parser.add_argument('--job_id', help='Job id (enqueue), unique in the queue')
+    parser.add_argument('--max_attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help=f'Attempts of a job whose worker died (enqueue). Default: {DEFAULT_MAX_ATTEMPTS}')
+    parser.add_argument('--worker_id', default=f"{socket.gethostname()}-{os.getpid()}",
+                        help='Worker id (worker). Default: <host name>-<pid>')
+    parser.add_argument('--lease_sec', type=float, default=DEFAULT_LEASE_SEC,
+                        help=f'Lease of a job, renewed by heartbeats while it runs (worker). Default: {DEFAULT_LEASE_SEC}')
+    parser.add_argument('--poll_sec', type=float, default=DEFAULT_POLL_SEC,
+                        help=f'Interval between checks of an empty queue (worker). Default: {DEFAULT_POLL_SEC}')
+    parser.add_argument('--max_jobs', type=int, help='Exit after running this many jobs (worker)')
+    parser.add_argument('--exit_when_empty', action='store_true', help='Exit once the queue is empty (worker)')
+    parser.add_argument('--json', action='store_true', help='Print the jobs as json (status)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show debug logs')
+    argv = sys.argv[1:]
+    pipeline_args = []
+    if '--' in argv:
+        argv, pipeline_args = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+    args.pipeline_args = pipeline_args
+    return args
+
+
+def main():
+    args = parse_arguments()
+    init_logging(args.verbose)
+    queue = open_job_queue(args.queue)
+    try:
+        if args.command == 'enqueue':
+            if not args.job_id or not args.pipeline_args:
+                log_and_exit("enqueue requires --job_id and the appdome_api.py arguments of the job after --")
+            if not queue.enqueue(args.job_id, args.pipeline_args, args.max_attempts):
+                log_and_exit(f"Job {args.job_id} is already queued")
+            logging.info(f"Job {args.job_id} queued")
+        elif args.command == 'worker':
+            counts = run_worker(queue, args.worker_id, lease_sec=args.lease_sec, poll_sec=args.poll_sec,
+                                max_jobs=args.max_jobs, exit_when_empty=args.exit_when_empty)
+            logging.info(f"Worker {args.worker_id} done: {counts}")
+            if counts['failed']:
+                raise AppdomeError(f"{counts['failed']} jobs failed")
+        else:
+            jobs = queue.jobs()
+            if args.json:
+                print(json.dumps(jobs, indent=2))
+                return
+            for job in jobs:
+                print(f"{job['job_id']:<24} {job['state']:<10} attempts {job['attempts']}/{job['max_attempts']} "
+                      f"{job['worker_id'] or ''} {job['error'] or ''}".rstrip())
+    finally:
+        queue.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,462 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import socketserver
+import statistics
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from itertools import count
+from urllib.parse import urlparse, parse_qs
+from urllib.request import urlopen, Request
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+ACTION_PATTERN = re.compile(rb'name="action"\r\n\r\n(\w+)|action=(\w+)')
+SAMPLE_INTERVAL_SEC = 0.2
+
+
+class MockAppdomeHandler(BaseHTTPRequestHandler):
+    """
+    Minimal Appdome API: uploads complete at once, tasks complete after the configured duration of their action.
+    Fusion set releases fail on purpose by fusion set id: 'busy-*' ids get a 429 on their first release and 'drop-*'
+    ids are released but the connection is closed before the response.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body=None, code=200, raw=None, content_type='application/json'):
+        data = raw if raw is not None else json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            data = bytearray()
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    return bytes(data)
+                data += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_PUT(self):
+        self._read_body()
+        self._send({})
+
+    def do_POST(self):
+        body = self._read_body()
+        path = urlparse(self.path).path
+        server = self.server
+        if path.endswith('/upload-using-link') or path.endswith('/upload'):
+            return self._send({'id': f"app{next(server.ids)}"})
+        if path.endswith('/callback'):
+            return self._register_callback(path.split('/')[-2], body)
+        if '/release_fs/' in path:
+            return self._release(path.split('/')[-1], parse_qs(urlparse(self.path).query).get('team_id', [''])[0])
+        if path.endswith('/tasks') or path.endswith('/build-to-test'):
+            match = ACTION_PATTERN.search(body)
+            action = (match.group(1) or match.group(2)).decode('ascii') if match else 'fuse'
+            duration = server.durations.get(action, server.durations['fuse'])
+            task_id = f"task{next(server.ids)}"
+            server.tasks[task_id] = time.time() + duration * random.uniform(1 - server.jitter, 1 + server.jitter)
+            return self._send({'task_id': task_id})
+        self._send({'error': 'not found'}, 404)
+
+    def _release(self, fusion_set_id, team_id):
+        server = self.server
+        with server.lock:
+            attempts = server.release_attempts[(fusion_set_id, team_id)] = \
+                server.release_attempts.get((fusion_set_id, team_id), 0) + 1
+            if fusion_set_id.startswith('busy') and attempts == 1:
+                return self._send({'error': 'too many requests'}, 429)
+            new_fusion_set_id = f"{fusion_set_id}-{team_id}-{len(server.releases) + 1}"
+            server.releases.append(new_fusion_set_id)
+        if fusion_set_id.startswith('drop'):
+            self.close_connection = True
+            return
+        self._send({'new_fusion_set_id': new_fusion_set_id})
+
+    def _register_callback(self, task_id, body):
+        match = re.search(rb'callback_url=([^&]+)', body)
+        if not match or task_id not in self.server.tasks:
+            return self._send({'error': 'not found'}, 404)
+        callback_url = parse_qs(b'callback_url=' + match.group(1))[b'callback_url'][0].decode('utf-8')
+        payload = json.dumps({'task_id': task_id, 'status': 'completed'}).encode('utf-8')
+
+        def post_callback():
+            try:
+                urlopen(Request(callback_url, data=payload, headers={'Content-Type': 'application/json'}), timeout=10)
+            except OSError:
+                pass
+        delay = max(0.0, self.server.tasks[task_id] - time.time())
+        threading.Timer(delay, post_callback).start()
+        self._send({})
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        parts = path.split('/')
+        server = self.server
+        if path.endswith('/upload-link'):
+            return self._send({'url': f"http://127.0.0.1:{server.server_port}/s3/object", 'file_id': 'file'})
+        if path.endswith('/status'):
+            done = time.time() >= server.tasks.get(parts[-2], 0)
+            return self._send({'status': 'completed' if done else 'progress', 'obfuscationMapExists': False})
+        if path.endswith('/output'):
+            return self._send(raw=server.output, content_type='application/octet-stream')
+        if path.endswith('/certificate-json'):
+            return self._send({'task_id': parts[-2], 'protections': []})
+        if path == '/mock/releases':
+            return self._send(server.releases)
+        self._send({'error': 'not found'}, 404)
+
+
+class _H2MockRequest(MockAppdomeHandler):
+    """
+    One request of an HTTP/2 stream, handled by the MockAppdomeHandler routes. The response is kept instead of
+    written, and is None when the route drops the connection.
+    """
+    def __init__(self, server, method, path, headers, body):
+        self.server = server
+        self.command = method
+        self.path = path
+        self.headers = headers
+        self.close_connection = False
+        self.response = None
+        self._body = body
+
+    def _read_body(self):
+        return self._body
+
+    def _send(self, body=None, code=200, raw=None, content_type='application/json'):
+        self.response = (code, content_type, raw if raw is not None else json.dumps(body).encode('utf-8'))
+
+
+class _H2MockConnection(socketserver.BaseRequestHandler):
+    """
+    Cleartext HTTP/2 (h2c with prior knowledge) connection to the mock server. Streams are answered concurrently,
+    each from its own thread, and response bodies respect the flow control window of the client.
+    """
+    def handle(self):
+        self._conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False,
+                                                                           header_encoding='utf-8'))
+        self._window = threading.Condition()
+        self._streams = {}
+        self._closed = False
+        with self._window:
+            self._conn.initiate_connection()
+            self._flush()
+        while True:
+            try:
+                data = self.request.recv(65536)
+            except OSError:
+                data = b''
+            with self._window:
+                if not data:
+                    self._closed = True
+                    self._window.notify_all()
+                    return
+                for event in self._conn.receive_data(data):
+                    self._on_event(event)
+                self._flush()
+                self._window.notify_all()
+
+    def _on_event(self, event):
+        if isinstance(event, h2.events.RequestReceived):
+            self._streams[event.stream_id] = (dict(event.headers), bytearray())
+        elif isinstance(event, h2.events.DataReceived):
+            self._streams[event.stream_id][1].extend(event.data)
+            self._conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            headers, body = self._streams.pop(event.stream_id)
+            threading.Thread(target=self._respond, args=(event.stream_id, headers, bytes(body)), daemon=True).start()
+
+    def _flush(self):
+        data = self._conn.data_to_send()
+        if data:
+            self.request.sendall(data)
+
+    def _respond(self, stream_id, headers, body):
+        request = _H2MockRequest(self.server, headers[':method'], headers[':path'], headers, body)
+        getattr(request, f"do_{request.command}")()
+        with self._window:
+            try:
+                self._send_response(stream_id, request.response)
+            except (h2.exceptions.StreamClosedError, OSError):
+                pass  # The client reset the stream or closed the connection
+
+    def _send_response(self, stream_id, response):
+        if response is None:
+            self._conn.reset_stream(stream_id, h2.errors.ErrorCodes.INTERNAL_ERROR)
+            self._flush()
+            return
+        code, content_type, data = response
+        self._conn.send_headers(stream_id, [(':status', str(code)), ('content-type', content_type),
+                                            ('content-length', str(len(data)))], end_stream=not data)
+        self._flush()
+        view = memoryview(data)
+        while view:
+            size = min(self._conn.local_flow_control_window(stream_id), self._conn.max_outbound_frame_size,
+                       len(view))
+            if size <= 0:
+                if self._closed:
+                    return
+                self._window.wait(1)
+                continue
+            self._conn.send_data(stream_id, view[:size].tobytes(), end_stream=size == len(view))
+            self._flush()
+            view = view[size:]
+
+
+class _H2MockServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+def _serve_mock(port_queue, durations, jitter, output_size, http2=False):
+    if http2:
+        server = _H2MockServer(('127.0.0.1', 0), _H2MockConnection)
+        server.server_port = server.server_address[1]
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), MockAppdomeHandler)
+        server.daemon_threads = True
+        server.request_queue_size = 1024
+    server.ids = count(1)
+    server.tasks = {}
+    server.lock = threading.Lock()
+    server.releases = []
+    server.release_attempts = {}
+    server.durations = durations
+    server.jitter = jitter
+    server.output = b'PK' + os.urandom(output_size)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def start_mock_server(durations, jitter=0.2, output_size=1024 * 1024, http2=False):
+    """
+    Starts the mock Appdome server in its own process, so its sockets and threads are not counted as the client's.
+
+    :param durations: Dict of task action ('fuse', 'context', 'sign', ...) to its duration in seconds
+    :param jitter: Relative random variation of the durations
+    :param output_size: Size of the downloaded output in bytes
+    :param http2: Serve cleartext HTTP/2 with prior knowledge only (requires the h2 package), instead of HTTP/1.1
+    :return: (process, server base url)
+    """
+    if http2 and h2 is None:
+        raise RuntimeError("An HTTP/2 mock server requires 'pip install h2'")
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve_mock, args=(port_queue, durations, jitter, output_size, http2),
+                                      daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{port_queue.get(timeout=30)}/"
+
+
+def _open_fds():
+    try:
+        fds = os.listdir('/proc/self/fd')
+    except OSError:
+        return None, None
+    sockets = 0
+    for fd in fds:
+        try:
+            sockets += os.readlink(f"/proc/self/fd/{fd}").startswith('socket:')
+        except OSError:
+            pass
+    return len(fds), sockets
+
+
+class ResourceSampler:
+    """
+    Samples open FDs, sockets, threads and RSS of the process, and the scheduler latency: how late a sleeping
+    thread wakes up, which grows with GIL and thread contention.
+    """
+    def __init__(self, interval_sec=SAMPLE_INTERVAL_SEC):
+        self.interval_sec = interval_sec
+        self.samples = []
+        self.wake_delays_ms = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='load-sampler', daemon=True)
+
+    def _run(self):
+        from profiler import current_rss
+        while not self._stop.is_set():
+            before = time.monotonic()
+            time.sleep(self.interval_sec)
+            self.wake_delays_ms.append((time.monotonic() - before - self.interval_sec) * 1000)
+            fds, sockets = _open_fds()
+            self.samples.append({'fds': fds, 'sockets': sockets, 'threads': threading.active_count(),
+                                 'rss': current_rss()})
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+    def _max(self, key):
+        values = [sample[key] for sample in self.samples if sample[key] is not None]
+        return max(values) if values else None
+
+    def summary(self):
+        from utils import percentile
+        delays = sorted(self.wake_delays_ms) or [0]
+        max_rss = self._max('rss')
+        return {'max_fds': self._max('fds'), 'max_sockets': self._max('sockets'), 'max_threads': self._max('threads'),
+                'max_rss_mb': round(max_rss / 1024 / 1024, 1) if max_rss else None,
+                'scheduler_latency_p50_ms': round(percentile(delays, 50), 2),
+                'scheduler_latency_p99_ms': round(percentile(delays, 99), 2)}
+
+
+def _run_pipeline(client, app_path, output_dir, index):
+    started = time.monotonic()
+    task_id = client.build(client.upload(app_path), 'load-fusion-set')
+    context_task_id = client.context(task_id, new_bundle_id=f"com.load.app{index}")
+    signed_task_id = client.private_sign_android(context_task_id, 'AA:BB')
+    output = client.download(signed_task_id, os.path.join(output_dir, f"app{index}.apk"))
+    certificate = client.download_certificate_json(signed_task_id, os.path.join(output_dir, f"app{index}.json"))
+    return output, certificate, started
+
+
+def run_load(pipelines, app_path, output_dir, max_workers, status_interval_sec, http2=None, completion_receiver=None):
+    """
+    Runs concurrent upload, build, context, sign and download pipelines on one AppdomeClient.
+
+    :param pipelines: Number of concurrent pipelines
+    :param max_workers: Client thread pool size, default is 5 per pipeline (one per step)
+    :param completion_receiver: Wait for the mock server callbacks instead of polling (optional)
+    :return: Result dict with throughput, pipeline latency and resource usage
+    """
+    from appdome_client import AppdomeClient
+    from utils import percentile
+
+    latencies = []
+    failures = 0
+    run_started = time.monotonic()
+    with ResourceSampler() as sampler:
+        with AppdomeClient('load-api-key', 'load-team', max_workers=max_workers or pipelines * 5,
+                           status_interval_sec=status_interval_sec, http2=http2,
+                           completion_receiver=completion_receiver) as client:
+            runs = [_run_pipeline(client, app_path, output_dir, index) for index in range(pipelines)]
+            for output, certificate, started in runs:
+                try:
+                    output.result()
+                    certificate.result()
+                    latencies.append(time.monotonic() - started)
+                except Exception as e:
+                    failures += 1
+                    logging.error(f"Pipeline failed: {e}")
+    duration_sec = time.monotonic() - run_started
+    latencies.sort()
+    result = {'pipelines': pipelines, 'failures': failures, 'duration_sec': round(duration_sec, 2),
+              'pipelines_per_minute': round(len(latencies) / duration_sec * 60, 1),
+              'latency_p50_sec': round(percentile(latencies, 50), 2),
+              'latency_p95_sec': round(percentile(latencies, 95), 2),
+              'latency_mean_sec': round(statistics.mean(latencies), 2) if latencies else None}
+    result.update(sampler.summary())
+    return result
+
+
+def _check_http_version(server_url, http_version):
+    """
+    Fails when the client does not reach the mock server over http_version, so a round does not silently measure
+    another protocol.
+    """
+    from utils import http_get, http2_transport, log_and_exit
+    http2_transport(True)
+    response = http_get(f"{server_url}api/v1/tasks/probe/status")
+    if getattr(response, 'http_version', 'HTTP/1.1') != http_version:
+        log_and_exit(f"Requests to the mock server were sent over {getattr(response, 'http_version', 'HTTP/1.1')} "
+                     f"instead of {http_version}")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Drive concurrent Appdome pipelines against a local mock server and '
+                                                 'report client throughput and resource usage')
+    parser.add_argument('--pipelines', type=int, nargs='+', default=[10, 50, 100], metavar='count',
+                        help='Concurrent pipeline counts to run, one round each. Default: 10 50 100')
+    parser.add_argument('--build_sec', type=float, default=5, help='Mock build duration. Default: 5')
+    parser.add_argument('--context_sec', type=float, default=1, help='Mock context duration. Default: 1')
+    parser.add_argument('--sign_sec', type=float, default=2, help='Mock signing duration. Default: 2')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Relative variation of the durations. Default: 0.2')
+    parser.add_argument('--app_size_mb', type=float, default=1, help='Uploaded app size. Default: 1')
+    parser.add_argument('--output_size_mb', type=float, default=1, help='Downloaded output size. Default: 1')
+    parser.add_argument('--status_interval_sec', type=float, default=1, help='Status polling interval. Default: 1')
+    parser.add_argument('--max_workers', type=int, help='Client thread pool size. Default: 5 per pipeline')
+    parser.add_argument('--http2', action='store_true', default=None,
+                        help='Serve the mock over cleartext HTTP/2 and send the requests over it (requires httpx[http2])')
+    parser.add_argument('--callbacks', action='store_true',
+                        help='Wait for task completion callbacks posted by the mock server instead of polling')
+    parser.add_argument('--report', metavar='report_json_file', help='Output file for the results')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show debug logs')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='[%(asctime)s] [%(levelname)s] %(message)s')
+    durations = {'fuse': args.build_sec, 'context': args.context_sec, 'sign': args.sign_sec,
+                 'seal': args.sign_sec, 'sign_script': args.sign_sec}
+    process, server_url = start_mock_server(durations, args.jitter, int(args.output_size_mb * 1024 * 1024),
+                                            bool(args.http2))
+    # The client modules read the server url and governor state when they are imported
+    os.environ['APPDOME_SERVER_BASE_URL'] = server_url
+    os.environ.setdefault('APPDOME_GOVERNOR_STATE', os.path.join(tempfile.mkdtemp(), 'governor.json'))
+    if args.http2:
+        # The mock speaks cleartext HTTP/2, which is sent without negotiation. Over HTTPS it is negotiated with ALPN
+        from http2_transport import HTTP2_ENV, PRIOR_KNOWLEDGE
+        os.environ[HTTP2_ENV] = PRIOR_KNOWLEDGE
+        _check_http_version(server_url, 'HTTP/2')
+
+    results = []
+    receiver = None
+    if args.callbacks:
+        from completion_receiver import CompletionReceiver
+        receiver = CompletionReceiver(host='127.0.0.1')
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            app_path = os.path.join(work_dir, 'load.apk')
+            with open(app_path, 'wb') as f:
+                f.write(os.urandom(int(args.app_size_mb * 1024 * 1024)))
+            for pipelines in args.pipelines:
+                output_dir = os.path.join(work_dir, f"run{pipelines}")
+                os.makedirs(output_dir)
+                result = run_load(pipelines, app_path, output_dir, args.max_workers, args.status_interval_sec,
+                                  args.http2, receiver)
+                results.append(result)
+                print(json.dumps(result), flush=True)
+    finally:
+        if receiver:
+            receiver.close()
+        process.terminate()
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
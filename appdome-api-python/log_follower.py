@@ -0,0 +1,249 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+
+from models import StatusMessage
+
+TEXT_FORMAT = 'text'
+JSONL_FORMAT = 'jsonl'
+WORKFLOW_LOG_FORMATS = (TEXT_FORMAT, JSONL_FORMAT)
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+
+def _utc_now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _time_key(creation_time):
+    """
+    Sort key for a message creation time. Numeric (epoch) values are compared as numbers, anything else as strings.
+    """
+    try:
+        return 0, float(creation_time), ''
+    except (TypeError, ValueError):
+        return 1, 0.0, str(creation_time)
+
+
+def message_identity(message):
+    """
+    Identity of a workflow message, used to drop messages the server returns more than once.
+
+    :param message: StatusMessage
+    :return: Hashable identity
+    """
+    if message.id:
+        return 'id', str(message.id)
+    return 'content', message.creation_time, message.message_type, message.text
+
+
+class RotatingBufferedWriter:
+    """
+    Buffered append-only writer with size based rotation (path -> path.1 -> ... -> path.<backup_count>).
+    """
+    def __init__(self, path, max_bytes=0, backup_count=3, buffer_size=DEFAULT_BUFFER_SIZE):
+        """
+        :param path: Output file path
+        :param max_bytes: Rotate once the file grows beyond this size. 0 disables rotation
+        :param backup_count: Number of rotated files to keep
+        :param buffer_size: Write buffer size in bytes
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self._file = None
+        self._size = 0
+
+    def _open(self):
+        self._file = open(self.path, 'a', buffering=self.buffer_size, encoding='utf-8')
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backup_count > 0:
+            for idx in range(self.backup_count - 1, 0, -1):
+                src = f"{self.path}.{idx}"
+                if os.path.exists(src):
+                    os.replace(src, f"{self.path}.{idx + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def write(self, line):
+        if self._file is None:
+            self._open()
+        data_len = len(line.encode('utf-8'))
+        if self.max_bytes and self._size and self._size + data_len > self.max_bytes:
+            self._rotate()
+        self._file.write(line)
+        self._size += data_len
+
+    def flush(self):
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class WorkflowLogFollower:
+    """
+    Follows the workflow messages of a task from the status responses that are already being polled.
+
+    Keeps a strict message cursor (the lastDate sent to the status API), drops messages that were already seen
+    (by creation time and message identity) and writes new messages through a buffered writer, either as plain
+    text or as JSON Lines with timestamps. Each follower is bound to a single task and output file, so several
+    tasks can be followed concurrently without any extra requests.
+    """
+    def __init__(self, output_path=None, output_format=TEXT_FORMAT, max_bytes=0, backup_count=3, echo=None,
+                 task_id=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        """
+        :param output_path: Path to the workflow output logs file. None to only echo messages
+        :param output_format: 'text' or 'jsonl'
+        :param max_bytes: Rotate the output file once it grows beyond this size. 0 disables rotation
+        :param backup_count: Number of rotated files to keep
+        :param echo: Print new messages to stdout. Default is to print them only when there is no output file, so
+            concurrent tasks writing their own files do not interleave their messages on stdout
+        :param task_id: Task the messages belong to, used to prefix echoed lines and in JSON Lines records
+        :param buffer_size: Write buffer size in bytes
+        """
+        if output_format not in WORKFLOW_LOG_FORMATS:
+            raise ValueError(f"Unknown workflow output logs format [{output_format}]")
+        self.output_format = output_format
+        self.echo = not output_path if echo is None else echo
+        self.task_id = task_id
+        self.operation = None
+        self._cursor = None
+        self._seen_at_cursor = set()
+        self._lock = threading.Lock()
+        self._writer = RotatingBufferedWriter(output_path, max_bytes, backup_count, buffer_size) \
+            if output_path else None
+
+    @property
+    def cursor(self):
+        """Creation time of the newest message seen so far, to be sent as lastDate."""
+        return self._cursor
+
+    def begin(self, operation):
+        """
+        Marks the start of a new operation (build, context, sign...) in the output.
+
+        :param operation: Operation name
+        """
+        with self._lock:
+            self.operation = operation
+            if self.output_format == JSONL_FORMAT:
+                self._write_record({'event': 'operation', 'operation': operation})
+            else:
+                self._write(f"{operation}:\n")
+
+    def feed(self, messages):
+        """
+        Processes the messages of a status response.
+
+        :param messages: StatusMessage list, or message dicts as returned by the status API
+        :return: List of messages that were not seen before, in creation order
+        """
+        if not messages:
+            return []
+        messages = [message if isinstance(message, StatusMessage) else StatusMessage.from_json(message)
+                    for message in messages]
+        with self._lock:
+            new_messages = []
+            for message in sorted(messages, key=lambda m: _time_key(m.creation_time)):
+                if self._is_new(message):
+                    new_messages.append(message)
+                    self._emit(message)
+            if self._writer:
+                self._writer.flush()
+            return new_messages
+
+    def _is_new(self, message):
+        creation_time = message.creation_time
+        identity = message_identity(message)
+        if self._cursor is not None and creation_time is not None:
+            cursor_key, message_key = _time_key(self._cursor), _time_key(creation_time)
+            if message_key < cursor_key:
+                return False
+            if message_key > cursor_key:
+                self._cursor = creation_time
+                self._seen_at_cursor = {identity}
+                return True
+        elif creation_time is not None:
+            self._cursor = creation_time
+        if identity in self._seen_at_cursor:
+            return False
+        self._seen_at_cursor.add(identity)
+        return True
+
+    def _emit(self, message):
+        message_text = message.text
+        if not message_text:
+            return
+        if self.echo:
+            prefix = f"[{self.task_id}] " if self.task_id else ''
+            print(f" - {prefix}{message_text}", flush=True)
+        if self.output_format == JSONL_FORMAT:
+            self._write_record({'event': 'message', 'operation': self.operation,
+                                'creation_time': message.creation_time,
+                                'message_type': message.message_type, 'text': message_text})
+        else:
+            self._write(message_text + '\n')
+
+    def _write_record(self, record):
+        record = dict(record, timestamp=_utc_now())
+        if self.task_id:
+            record['task_id'] = self.task_id
+        self._write(json.dumps(record) + '\n')
+
+    def _write(self, line):
+        if self._writer:
+            self._writer.write(line)
+
+    def flush(self):
+        with self._lock:
+            if self._writer:
+                self._writer.flush()
+
+    def close(self):
+        with self._lock:
+            if self._writer:
+                self._writer.close()
+                logging.debug(f"Closed workflow output logs {self._writer.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def add_workflow_logs_args(parser):
+    parser.add_argument('-wol', '--workflow_output_logs', metavar='workflow_output_logs',
+                        help='Enter path to a workflow output logs file (optional)')
+    parser.add_argument('--workflow_output_logs_format', choices=WORKFLOW_LOG_FORMATS, default=TEXT_FORMAT,
+                        help='Format of the workflow output logs file. Default is text')
+    parser.add_argument('--workflow_output_logs_max_bytes', type=int, default=0, metavar='max_bytes',
+                        help='Rotate the workflow output logs file once it grows beyond this size. Default is no rotation')
+
+
+def init_workflow_log_follower(args, task_id=None, output_path=None):
+    """
+    Creates a follower from the workflow output logs arguments.
+
+    :param args: Parsed arguments (see add_workflow_logs_args)
+    :param task_id: Task the follower is bound to (optional)
+    :param output_path: Overrides args.workflow_output_logs, e.g. to give each concurrent task its own file
+    :return: WorkflowLogFollower or None when workflow output logs were not requested
+    """
+    output_path = output_path or getattr(args, 'workflow_output_logs', None)
+    if not output_path:
+        return None
+    return WorkflowLogFollower(output_path, getattr(args, 'workflow_output_logs_format', TEXT_FORMAT),
+                               getattr(args, 'workflow_output_logs_max_bytes', 0), task_id=task_id)
@@ -0,0 +1,141 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from utils import TASK_ID_KEY
+
+_PARSED_ATTR = '_appdome_json'
+_UNSET = object()
+
+
+def loads(data):
+    """
+    Parses JSON with orjson when it is installed, otherwise with the json module.
+
+    :param data: JSON document as bytes or str
+    """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def response_json(response):
+    """
+    Parses the JSON body of a response once. Further calls on the same response return the same object.
+
+    :param response: requests.Response or a response with the same interface
+    :raise ValueError: When the body is not JSON
+    """
+    parsed = getattr(response, _PARSED_ATTR, _UNSET)
+    if parsed is _UNSET:
+        parsed = loads(response.content)
+        setattr(response, _PARSED_ATTR, parsed)
+    return parsed
+
+
+class Model:
+    """
+    Base of the response models: slotted classes holding the fields the client uses, built once from a payload.
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, name) == getattr(other, name)
+                                                 for name in self.__slots__)
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.__slots__ if name != 'raw')
+        return f"{type(self).__name__}({fields})"
+
+
+class UploadResult(Model):
+    """Response of an app upload."""
+    __slots__ = ('id', 'raw')
+
+    def __init__(self, id, raw=None):
+        self.id = id
+        self.raw = raw
+
+    @classmethod
+    def from_json(cls, payload):
+        return cls(payload.get('id'), payload)
+
+
+class TaskResult(Model):
+    """Response of a request starting a task: build, context, sign..."""
+    __slots__ = ('task_id', 'raw')
+
+    def __init__(self, task_id, raw=None):
+        self.task_id = task_id
+        self.raw = raw
+
+    @classmethod
+    def from_json(cls, payload):
+        return cls(payload.get(TASK_ID_KEY), payload)
+
+
+class StatusMessage(Model):
+    """Workflow message of a task status."""
+    __slots__ = ('id', 'creation_time', 'message_type', 'text')
+
+    def __init__(self, id=None, creation_time=None, message_type='', text=''):
+        self.id = id
+        self.creation_time = creation_time
+        self.message_type = message_type
+        self.text = text
+
+    @classmethod
+    def from_json(cls, payload):
+        return cls(payload.get('id') or payload.get('_id'), payload.get('creation_time'),
+                   payload.get('message_type', ''), (payload.get('message') or {}).get('text', ''))
+
+
+class TaskStatus(Model):
+    """
+    Status of a task. Only the fields the client uses are kept, so tracking many tasks does not keep their whole
+    status payloads.
+    """
+    __slots__ = ('status', 'message', 'obfuscation_map_exists', 'messages')
+
+    def __init__(self, status='', message=None, obfuscation_map_exists=False, messages=()):
+        self.status = status
+        self.message = message
+        self.obfuscation_map_exists = obfuscation_map_exists
+        self.messages = messages
+
+    @classmethod
+    def from_json(cls, payload):
+        return cls(payload.get('status', ''), payload.get('message'), payload.get('obfuscationMapExists', False),
+                   tuple(StatusMessage.from_json(message) for message in payload.get('messages') or ()))
+
+
+class ValidationStatus(Model):
+    """Status of an app validation. raw is the validation output."""
+    __slots__ = ('validation_state', 'raw')
+
+    def __init__(self, validation_state='', raw=None):
+        self.validation_state = validation_state
+        self.raw = raw
+
+    @classmethod
+    def from_json(cls, payload):
+        return cls(payload.get('validation_state', ''), payload)
+
+
+def parse_upload(response):
+    return UploadResult.from_json(response_json(response))
+
+
+def parse_task(response):
+    return TaskResult.from_json(response_json(response))
+
+
+def parse_status(response):
+    return TaskStatus.from_json(response_json(response))
+
+
+def parse_validation_status(response):
+    return ValidationStatus.from_json(response_json(response))
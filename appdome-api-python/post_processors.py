@@ -0,0 +1,610 @@
+import codecs
+import hashlib
+import logging
+import os
+import re
+import struct
+import zlib
+from fnmatch import fnmatch
+
+from utils import log_and_exit, AppdomeIntegrityError
+
+JSON_FORMATS = ['pretty', 'compact', 'raw']
+
+LOCAL_HEADER = b'PK\x03\x04'
+DATA_DESCRIPTOR = b'PK\x07\x08'
+CENTRAL_HEADER = b'PK\x01\x02'
+END_OF_CENTRAL_DIRECTORY = b'PK\x05\x06'
+ZIP64_END_LOCATOR = b'PK\x06\x07'
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_MARKER = 0xFFFFFFFF
+MAX_CENTRAL_DIRECTORY_SIZE = 64 * 1024 * 1024
+
+_STRING_SPECIAL = re.compile(rb'["\\\x00-\x1f]')
+_WHITESPACE = frozenset(b' \t\r\n')
+_STRUCTURAL = frozenset(b'{}[],:"')
+_HEX_DIGITS = frozenset(b'0123456789abcdefABCDEF')
+_ESCAPES = frozenset(b'"\\/bfnrtu')
+_QUOTE, _BACKSLASH, _OPEN_OBJECT, _COMMA, _COLON, _U = b'"\\{,:u'
+_OPENING_BRACKETS = frozenset(b'[{')
+_OPENING = {ord(']'): ord('['), ord('}'): ord('{')}
+_NUMBER = re.compile(rb'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?')
+_LITERALS = (b'true', b'false', b'null')
+_SCALAR = re.compile(rb'[^ \t\r\n{}\[\],:"]+')
+_MAX_SCALAR_SIZE = 1024
+_EXPECT_VALUE, _EXPECT_KEY, _EXPECT_COLON, _EXPECT_AFTER_VALUE, _EXPECT_DONE = range(5)
+
+
+class StreamProcessor:
+    """
+    A stage of the download post-processing chain. Every stage sees the bytes produced by the previous stage while
+    the download streams, so no extra pass over the file is needed.
+    """
+    name = None
+
+    def process(self, chunk):
+        """
+        :param chunk: Next bytes of the stream
+        :return: The bytes to pass on (the same chunk for stages that only inspect the stream)
+        """
+        return chunk
+
+    def finish(self):
+        """
+        Called once the stream ended. Raises AppdomeIntegrityError when the stream is invalid.
+
+        :return: Remaining bytes to pass on
+        """
+        return b''
+
+    def abort(self):
+        """
+        Called instead of finish when the download failed, to discard what the stage produced.
+        """
+
+    def result(self):
+        """
+        :return: Json serializable result recorded under the stage name, or None
+        """
+        return None
+
+    def variant(self):
+        """
+        :return: Description of how the stage changes the bytes (e.g. 'json-2'), None for stages that only inspect
+            the stream. Cached artifacts are kept per variant
+        """
+        return None
+
+
+class JsonValidator(StreamProcessor):
+    """
+    Checks a json document token by token as it streams: the utf-8 encoding, the strings and their escapes, numbers
+    and literals, and the grammar of objects and arrays. The document is never parsed into memory, only the stack of
+    open containers and the current number or literal are kept.
+    """
+    name = 'json'
+
+    def __init__(self):
+        self._stack = bytearray()
+        self._expect = _EXPECT_VALUE
+        self._opened = False
+        self._in_string = False
+        self._string_is_key = False
+        self._escape = False
+        self._unicode_digits = 0
+        self._scalar = bytearray()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._offset = 0
+
+    def _fail(self, reason):
+        log_and_exit(f"Downloaded json is invalid at byte {self._offset}: {reason}", AppdomeIntegrityError)
+
+    def _output(self):
+        """
+        :return: Buffer the stage writes its output to, None for stages passing the chunk on unchanged
+        """
+        return None
+
+    def _emit(self, out, token):
+        """
+        Writes a structural byte, or bytes of a number or literal, to the output.
+        """
+
+    def process(self, chunk):
+        try:
+            self._utf8.decode(chunk)
+        except UnicodeDecodeError as e:
+            self._offset += e.start
+            self._fail("not utf-8")
+        out = self._output()
+        i = 0
+        length = len(chunk)
+        while i < length:
+            if self._in_string:
+                end = self._string(chunk, i)
+                if out is not None:
+                    out += chunk[i:end]
+                self._offset += end - i
+                i = end
+                continue
+            c = chunk[i]
+            if c in _WHITESPACE or c in _STRUCTURAL:
+                if self._scalar:
+                    self._end_scalar()
+                if c in _OPENING_BRACKETS:
+                    # Written at the depth of the enclosing container
+                    self._emit(out, c)
+                    self._token(c)
+                elif c not in _WHITESPACE:
+                    self._token(c)
+                    self._emit(out, c)
+            else:
+                end = _SCALAR.match(chunk, i).end()
+                if not self._scalar:
+                    self._value_start()
+                self._scalar += chunk[i:end]
+                if len(self._scalar) > _MAX_SCALAR_SIZE:
+                    self._fail("number or literal is too long")
+                self._emit(out, chunk[i:end])
+                self._offset += end - i
+                i = end
+                continue
+            self._offset += 1
+            i += 1
+        return chunk if out is None else bytes(out)
+
+    def _string(self, chunk, i):
+        """
+        :return: Index past the string bytes of chunk consumed from i
+        """
+        start = i
+        length = len(chunk)
+        while i < length:
+            c = chunk[i]
+            if self._unicode_digits:
+                if c not in _HEX_DIGITS:
+                    self._offset += i - start
+                    self._fail("invalid \\u escape")
+                self._unicode_digits -= 1
+                i += 1
+            elif self._escape:
+                if c not in _ESCAPES:
+                    self._offset += i - start
+                    self._fail(f"invalid escape \\{chr(c)}")
+                self._escape = False
+                self._unicode_digits = 4 if c == _U else 0
+                i += 1
+            else:
+                match = _STRING_SPECIAL.search(chunk, i)
+                if not match:
+                    return length
+                i = match.end()
+                c = chunk[i - 1]
+                if c == _BACKSLASH:
+                    self._escape = True
+                elif c == _QUOTE:
+                    self._in_string = False
+                    if self._string_is_key:
+                        self._expect = _EXPECT_COLON
+                    else:
+                        self._value_end()
+                    return i
+                else:
+                    self._offset += match.start() - start
+                    self._fail("control character in a string")
+        return i
+
+    def _value_start(self, key=False):
+        if key and self._expect == _EXPECT_KEY:
+            self._string_is_key = True
+        elif self._expect == _EXPECT_VALUE:
+            self._string_is_key = False
+        elif self._expect == _EXPECT_DONE:
+            self._fail("data after the end of the document")
+        else:
+            self._fail("unexpected value")
+        self._opened = False
+
+    def _value_end(self):
+        self._expect = _EXPECT_AFTER_VALUE if self._stack else _EXPECT_DONE
+
+    def _end_scalar(self):
+        scalar = bytes(self._scalar)
+        self._scalar.clear()
+        if scalar not in _LITERALS and not _NUMBER.fullmatch(scalar):
+            self._fail(f"invalid token {scalar[:32]!r}")
+        self._value_end()
+
+    def _token(self, c):
+        if c == _QUOTE:
+            self._value_start(key=True)
+            self._in_string = True
+        elif c in b'[{':
+            self._value_start()
+            self._stack.append(c)
+            self._expect = _EXPECT_KEY if c == _OPEN_OBJECT else _EXPECT_VALUE
+            self._opened = True
+        elif c in b']}':
+            if not self._stack or self._stack[-1] != _OPENING[c]:
+                self._fail(f"unexpected {chr(c)}")
+            if self._expect != _EXPECT_AFTER_VALUE and not self._opened:
+                self._fail(f"missing value before {chr(c)}")
+            self._stack.pop()
+            self._opened = False
+            self._value_end()
+        elif c == _COMMA:
+            if self._expect != _EXPECT_AFTER_VALUE:
+                self._fail("unexpected ,")
+            self._expect = _EXPECT_KEY if self._stack[-1] == _OPEN_OBJECT else _EXPECT_VALUE
+        elif self._expect != _EXPECT_COLON:
+            self._fail("unexpected :")
+        else:
+            self._expect = _EXPECT_VALUE
+
+    def finish(self):
+        try:
+            self._utf8.decode(b'', final=True)
+        except UnicodeDecodeError:
+            self._fail("not utf-8")
+        if self._scalar:
+            self._end_scalar()
+        if self._in_string or self._expect != _EXPECT_DONE:
+            self._fail("the document is truncated")
+        return b''
+
+
+class JsonFormatter(JsonValidator):
+    """
+    Re-indents (pretty) or strips the whitespace of (compact) a json document token by token as it streams, and
+    validates it on the way. String contents are copied unchanged.
+    """
+
+    def __init__(self, indent=2):
+        """
+        :param indent: Indentation of the pretty format, None for the compact format
+        """
+        super().__init__()
+        self.indent = indent
+        self._pending_open = False
+
+    def variant(self):
+        return f"json-{self.indent}"
+
+    def _output(self):
+        return bytearray()
+
+    def _newline(self, out):
+        if self.indent is not None:
+            out += b'\n' + b' ' * (self.indent * len(self._stack))
+
+    def _emit(self, out, token):
+        opened = self._pending_open
+        self._pending_open = False
+        if isinstance(token, bytes):
+            if opened:
+                self._newline(out)
+            out += token
+            return
+        c = token
+        if opened and c not in b']}':
+            self._newline(out)
+        if c in b'[{':
+            out.append(c)
+            self._pending_open = True
+        elif c in b']}':
+            if not opened:
+                self._newline(out)
+            out.append(c)
+        elif c == _COMMA:
+            out.append(c)
+            self._newline(out)
+        elif c == _COLON:
+            out += b': ' if self.indent is not None else b':'
+        else:
+            out.append(c)
+
+
+def json_processors(json_format):
+    """
+    :param json_format: One of JSON_FORMATS
+    :return: Processors list for a json download
+    """
+    if json_format == 'pretty':
+        return [JsonFormatter()]
+    if json_format == 'compact':
+        return [JsonFormatter(indent=None)]
+    return [JsonValidator()]
+
+
+class Digester(StreamProcessor):
+    """
+    Computes additional digests of the stream (the sha256 of the written file is always computed).
+    """
+    name = 'digests'
+
+    def __init__(self, algorithms=('md5', 'sha1')):
+        self._hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+
+    def process(self, chunk):
+        for hasher in self._hashers.values():
+            hasher.update(chunk)
+        return chunk
+
+    def result(self):
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in self._hashers.items()}
+
+
+def _zip64_values(extra, *fields):
+    """
+    :param extra: Extra field bytes of a zip header
+    :param fields: Header values, the ones set to the zip64 marker are read from the zip64 extra field in order
+    :return: The resolved values
+    """
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack_from('<HH', extra, offset)
+        if header_id == ZIP64_EXTRA_ID:
+            values = []
+            position = offset + 4
+            for value in fields:
+                if value == ZIP64_MARKER and position + 8 <= offset + 4 + size:
+                    value = struct.unpack_from('<Q', extra, position)[0]
+                    position += 8
+                values.append(value)
+            return values
+        offset += 4 + size
+    return list(fields)
+
+
+def _safe_member_path(extract_dir, name):
+    path = os.path.normpath(os.path.join(extract_dir, name))
+    if os.path.isabs(name) or not path.startswith(os.path.normpath(extract_dir) + os.sep):
+        log_and_exit(f"Zip member [{name}] would be extracted outside of {extract_dir}", AppdomeIntegrityError)
+    return path
+
+
+class _ZipMember:
+    def __init__(self, offset, name, method, crc, compressed_size, size, flags, zip64, verify_crc, extract_path):
+        self.offset = offset
+        self.name = name
+        self.method = method
+        self.crc = crc
+        self.compressed_size = compressed_size
+        self.size = size
+        self.has_descriptor = bool(flags & 0x08)
+        self.zip64 = zip64
+        self.remaining = compressed_size
+        self._inflate = self.method == 8 and (verify_crc or extract_path or self.has_descriptor)
+        self._check = verify_crc and self.method in (0, 8)
+        self._inflater = zlib.decompressobj(-zlib.MAX_WBITS) if self._inflate else None
+        self._crc = 0
+        self._size = 0
+        self._file = None
+        self.extract_path = None
+        if extract_path and self.method in (0, 8) and not name.endswith('/'):
+            os.makedirs(os.path.dirname(extract_path), exist_ok=True)
+            self._file = open(extract_path, 'wb')
+            self.extract_path = extract_path
+
+    @property
+    def inflater(self):
+        return self._inflater
+
+    def _write(self, data):
+        if self._check:
+            self._crc = zlib.crc32(data, self._crc)
+            self._size += len(data)
+        if self._file:
+            self._file.write(data)
+
+    def feed(self, data):
+        """
+        :return: Number of bytes of data that belong to the member
+        """
+        if self._inflater:
+            self._write(self._inflater.decompress(data))
+            return len(data) - len(self._inflater.unused_data)
+        if self._check or self._file:
+            self._write(data)
+        return len(data)
+
+    def finish(self):
+        if self._file:
+            self._file.close()
+        if self._inflater and not self._inflater.eof:
+            log_and_exit(f"Zip member [{self.name}] has a truncated deflate stream", AppdomeIntegrityError)
+        if self._check and (self._crc != self.crc or self._size != self.size):
+            log_and_exit(f"Zip member [{self.name}] failed verification: crc {self._crc:08x} size {self._size}, "
+                         f"expected crc {self.crc:08x} size {self.size}", AppdomeIntegrityError)
+
+
+class ZipProcessor(StreamProcessor):
+    """
+    Verifies a zip (apk, aab, ipa) while it streams, like 'unzip -t': every local entry is parsed and, with
+    verify_crc, inflated and checked against its crc, and the central directory at the end is checked against the
+    entries that were seen. Members matching the extract patterns are written to extract_dir on the way.
+    """
+    name = 'zip'
+
+    def __init__(self, verify_crc=True, extract=None, extract_dir=None,
+                 max_central_directory_size=MAX_CENTRAL_DIRECTORY_SIZE):
+        """
+        :param verify_crc: Inflate every member and check its crc and size
+        :param extract: List of member name patterns (fnmatch) to extract
+        :param extract_dir: Directory to extract members to
+        :param max_central_directory_size: Maximum bytes kept after the last entry (signing block and central
+            directory)
+        """
+        self.verify_crc = verify_crc
+        self.extract = extract or []
+        self.extract_dir = extract_dir
+        self.max_central_directory_size = max_central_directory_size
+        self._buffer = bytearray()
+        self._offset = 0
+        self._state = 'header'
+        self._member = None
+        self._entries = {}
+        self._extracted = []
+        self._central_start = None
+        self._verified_entries = 0
+
+    def _advance(self, count):
+        del self._buffer[:count]
+        self._offset += count
+
+    def _extract_path(self, name):
+        if self.extract_dir and any(fnmatch(name, pattern) for pattern in self.extract):
+            return _safe_member_path(self.extract_dir, name)
+        return None
+
+    def _read_local_header(self):
+        if len(self._buffer) < 30:
+            return False
+        (_, _, flags, method, _, _, crc, compressed_size, size, name_length,
+         extra_length) = struct.unpack_from('<4sHHHHHIIIHH', self._buffer)
+        header_size = 30 + name_length + extra_length
+        if len(self._buffer) < header_size:
+            return False
+        name = bytes(self._buffer[30:30 + name_length]).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = bytes(self._buffer[30 + name_length:header_size])
+        zip64 = ZIP64_MARKER in (size, compressed_size)
+        if zip64:
+            size, compressed_size = _zip64_values(extra, size, compressed_size)
+        if flags & 0x08 and method != 8:
+            # Without sizes the end of stored data is only known from the central directory
+            logging.warning(f"Zip member [{name}] has no sizes in its local header, zip verification is skipped")
+            self._state = 'skip'
+            return False
+        self._entries[self._offset] = [name, crc]
+        self._member = _ZipMember(self._offset, name, method, crc, compressed_size, size, flags, zip64,
+                                  self.verify_crc, self._extract_path(name))
+        self._advance(header_size)
+        self._state = 'data'
+        return True
+
+    def _read_data(self):
+        member = self._member
+        if member.has_descriptor:
+            used = member.feed(bytes(self._buffer))
+            self._advance(used)
+            if not member.inflater.eof:
+                return False
+            self._state = 'descriptor'
+            return True
+        count = min(member.remaining, len(self._buffer))
+        if count:
+            member.feed(bytes(self._buffer[:count]))
+            self._advance(count)
+            member.remaining -= count
+        if member.remaining:
+            return False
+        self._finish_member()
+        return True
+
+    def _read_descriptor(self):
+        member = self._member
+        signature_size = 4 if self._buffer[:4] == DATA_DESCRIPTOR else 0
+        size_format = '<IQQ' if member.zip64 else '<III'
+        descriptor_size = signature_size + struct.calcsize(size_format)
+        if len(self._buffer) < max(descriptor_size, 4):
+            return False
+        member.crc, member.compressed_size, member.size = struct.unpack_from(size_format, self._buffer,
+                                                                             signature_size)
+        self._entries[member.offset][1] = member.crc
+        self._advance(descriptor_size)
+        self._finish_member()
+        return True
+
+    def _finish_member(self):
+        self._member.finish()
+        if self._member.extract_path:
+            self._extracted.append(self._member.name)
+        self._member = None
+        self._state = 'header'
+
+    def process(self, chunk):
+        if self._state == 'skip':
+            return chunk
+        self._buffer += chunk
+        progress = True
+        while progress:
+            if self._state == 'header':
+                if len(self._buffer) < 4:
+                    break
+                if self._buffer[:4] == LOCAL_HEADER:
+                    progress = self._read_local_header()
+                else:
+                    # Central directory, or an APK signing block before it
+                    self._state = 'central'
+                    self._central_start = self._offset
+            elif self._state == 'data':
+                progress = self._read_data()
+            elif self._state == 'descriptor':
+                progress = self._read_descriptor()
+            else:
+                progress = False
+        if self._state == 'central' and len(self._buffer) > self.max_central_directory_size:
+            log_and_exit(f"Downloaded zip has more than {self.max_central_directory_size} bytes after its last "
+                         f"entry", AppdomeIntegrityError)
+        if self._state == 'skip':
+            self._buffer = bytearray()
+        return chunk
+
+    def _end_of_central_directory(self):
+        buffer = self._buffer
+        index = buffer.rfind(END_OF_CENTRAL_DIRECTORY)
+        if index < 0 or index + 22 > len(buffer):
+            log_and_exit("Downloaded zip has no end of central directory record", AppdomeIntegrityError)
+        _, _, _, _, total, size, offset, _ = struct.unpack_from('<4sHHHHIIH', buffer, index)
+        if ZIP64_MARKER in (size, offset) or total == 0xFFFF:
+            locator = index - 20
+            if locator < 0 or buffer[locator:locator + 4] != ZIP64_END_LOCATOR:
+                log_and_exit("Downloaded zip64 has no end of central directory locator", AppdomeIntegrityError)
+            record = struct.unpack_from('<4sIQI', buffer, locator)[2] - self._central_start
+            if record < 0:
+                log_and_exit("Downloaded zip64 end of central directory is out of place", AppdomeIntegrityError)
+            total, size, offset = struct.unpack_from('<4sQHHIIQQQQ', buffer, record)[7:10]
+        return total, size, offset
+
+    def _verify_central_directory(self):
+        total, size, offset = self._end_of_central_directory()
+        position = offset - self._central_start
+        if position < 0 or position + size > len(self._buffer):
+            log_and_exit("Downloaded zip central directory does not follow its entries", AppdomeIntegrityError)
+        for _ in range(total):
+            if self._buffer[position:position + 4] != CENTRAL_HEADER:
+                log_and_exit("Downloaded zip central directory is corrupt", AppdomeIntegrityError)
+            (flags, crc, compressed_size, size, name_length, extra_length, comment_length,
+             local_offset) = struct.unpack_from('<8xHxxxxxxIIIHHH8xI', self._buffer, position)
+            name_start = position + 46
+            name = bytes(self._buffer[name_start:name_start + name_length]).decode(
+                'utf-8' if flags & 0x800 else 'cp437')
+            extra = bytes(self._buffer[name_start + name_length:name_start + name_length + extra_length])
+            local_offset = _zip64_values(extra, size, compressed_size, local_offset)[2]
+            entry = self._entries.get(local_offset)
+            if not entry or entry[0] != name or entry[1] != crc:
+                log_and_exit(f"Zip central directory entry [{name}] does not match the local entries",
+                             AppdomeIntegrityError)
+            position = name_start + name_length + extra_length + comment_length
+        if total != len(self._entries):
+            log_and_exit(f"Zip central directory lists {total} entries, the stream has {len(self._entries)}",
+                         AppdomeIntegrityError)
+        self._verified_entries = total
+
+    def finish(self):
+        if self._state == 'skip':
+            return b''
+        if self._state != 'central':
+            log_and_exit(f"Downloaded zip is truncated ({self._state})", AppdomeIntegrityError)
+        try:
+            self._verify_central_directory()
+        except struct.error:
+            log_and_exit("Downloaded zip central directory is truncated", AppdomeIntegrityError)
+        self._buffer = bytearray()
+        return b''
+
+    def result(self):
+        result = {'verified': self._state != 'skip', 'entries': self._verified_entries or len(self._entries)}
+        if self.extract:
+            result['extracted'] = self._extracted
+        return result
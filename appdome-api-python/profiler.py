@@ -0,0 +1,156 @@
+import cProfile
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from utils import log_and_exit, validate_output_path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MB = 1024 * 1024
+
+
+def current_rss():
+    """
+    :return: Resident set size of the process in bytes, or None when it cannot be read
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def peak_rss():
+    """
+    :return: Peak resident set size of the process in bytes, or None when it cannot be read
+    """
+    if not resource:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class PhaseProfiler:
+    """
+    Records the tracemalloc peak, RSS, CPU and wall time of every pipeline phase, with optional cProfile dumps and a
+    memory budget per phase. Phases may run concurrently (fan-outs); they then share the process wide tracemalloc
+    peak, and only the first of the concurrent phases is profiled with cProfile.
+    """
+    def __init__(self, enabled=False, report_path=None, cprofile_dir=None, memory_budget_mb=None):
+        """
+        :param enabled: When False phase() records nothing
+        :param report_path: Json report output file (optional)
+        :param cprofile_dir: Directory for a cProfile dump of every phase (optional)
+        :param memory_budget_mb: Maximum Python heap growth (tracemalloc peak) of a phase, in MB (optional)
+        """
+        self.enabled = enabled
+        self.report_path = report_path
+        self.cprofile_dir = cprofile_dir
+        self.memory_budget_mb = memory_budget_mb
+        self.phases = []
+        self._lock = threading.Lock()
+        self._cprofile_lock = threading.Lock()
+        self._active = 0
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if cprofile_dir:
+            os.makedirs(cprofile_dir, exist_ok=True)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Profiles the enclosed block as a phase.
+
+        :param name: Phase name, e.g. 'upload' or 'download output'
+        """
+        if not self.enabled:
+            yield
+            return
+        with self._lock:
+            if not self._active:
+                tracemalloc.reset_peak()
+            self._active += 1
+            concurrent = self._active > 1
+        heap_start = tracemalloc.get_traced_memory()[0]
+        rss_start = current_rss()
+        cpu_start = time.thread_time()
+        wall_start = time.monotonic()
+        profile = cProfile.Profile() if self.cprofile_dir and self._cprofile_lock.acquire(blocking=False) else None
+        if profile:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                self._cprofile_lock.release()
+            wall_sec = time.monotonic() - wall_start
+            cpu_sec = time.thread_time() - cpu_start
+            heap_peak = tracemalloc.get_traced_memory()[1]
+            rss_end = current_rss()
+            with self._lock:
+                self._active -= 1
+                entry = {'phase': name, 'thread': threading.current_thread().name, 'concurrent': concurrent,
+                         'wall_sec': round(wall_sec, 3), 'cpu_sec': round(cpu_sec, 3),
+                         'heap_peak_mb': round(max(heap_peak - heap_start, 0) / MB, 3),
+                         'rss_mb': round(rss_end / MB, 1) if rss_end else None,
+                         'rss_growth_mb': round((rss_end - rss_start) / MB, 1) if rss_end and rss_start else None,
+                         'peak_rss_mb': round(peak_rss() / MB, 1) if resource else None}
+                if profile:
+                    entry['cprofile'] = self._dump(profile, name, len(self.phases))
+                self.phases.append(entry)
+            logging.debug(f"Profile of {name}: {entry}")
+        if self.memory_budget_mb is not None and entry['heap_peak_mb'] > self.memory_budget_mb:
+            log_and_exit(f"Phase {name} used {entry['heap_peak_mb']} MB, over the memory budget of "
+                         f"{self.memory_budget_mb} MB")
+
+    def _dump(self, profile, name, index):
+        path = os.path.join(self.cprofile_dir, f"{index:02d}-{re.sub(r'[^A-Za-z0-9_.-]+', '_', name)}.prof")
+        profile.dump_stats(path)
+        return path
+
+    def report(self):
+        """
+        Logs a summary of the phases and writes the json report when a report path was given.
+        """
+        if not self.enabled:
+            return
+        for entry in self.phases:
+            logging.info(f"{entry['phase']:<32} wall {entry['wall_sec']:>8.2f}s  cpu {entry['cpu_sec']:>7.2f}s  "
+                         f"heap peak {entry['heap_peak_mb']:>8.2f} MB  rss {entry['rss_mb']} MB")
+        if self.report_path:
+            with open(self.report_path, 'w') as f:
+                json.dump({'peak_rss_mb': round(peak_rss() / MB, 1) if resource else None,
+                           'memory_budget_mb': self.memory_budget_mb, 'phases': self.phases}, f, indent=2)
+            logging.info(f"Profile report written to {self.report_path}")
+
+
+def add_profile_args(parser):
+    parser.add_argument('--profile', action='store_true',
+                        help='Record memory peak, RSS and CPU time of every phase (upload, build, context, sign, '
+                             'each download and mapping upload)')
+    parser.add_argument('--profile_report', metavar='profile_json_file', help='Output file for the profile report')
+    parser.add_argument('--profile_cprofile_dir', metavar='cprofile_dir',
+                        help='Directory for a cProfile dump of every phase')
+    parser.add_argument('--profile_memory_budget_mb', type=float, metavar='megabytes',
+                        help='Fail when a phase grows the Python heap by more than this many MB')
+
+
+def init_profiler(args):
+    """
+    :return: PhaseProfiler for the command line arguments. Any of the profile arguments enables profiling
+    """
+    enabled = bool(args.profile or args.profile_report or args.profile_cprofile_dir
+                   or args.profile_memory_budget_mb is not None)
+    validate_output_path(args.profile_report)
+    return PhaseProfiler(enabled, args.profile_report, args.profile_cprofile_dir, args.profile_memory_budget_mb)
@@ -1,33 +1,177 @@
 import argparse
+import csv
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from os.path import splitext
+from time import monotonic
+
 import requests
 
-from utils import (SERVER_API_V1_URL, request_headers, validate_response, add_common_args, init_common_args, build_url)
+from utils import (http_post, SERVER_API_V1_URL, request_headers, validate_response, add_common_args, init_common_args, build_url,
+                   log_and_exit, pooled_session, validate_output_path, deadline_sleep, request_not_sent)
+from models import response_json
+
+RETRY_STATUS_CODES = (429, 503)
+RESULT_FIELDS = ['fusion_set_id', 'team_id', 'new_fusion_set_id', 'status_code', 'attempts', 'error', 'duration_sec']
 
 
-def release_fusion_set(api_key, fusion_set_id, team_id):
+def release_fusion_set(api_key, fusion_set_id, team_id, session=None):
     headers = request_headers(api_key)
     url = build_url(SERVER_API_V1_URL, 'release_fs', fusion_set_id)
     params = { 'team_id': team_id }
-   
-    return requests.post(url, headers=headers, params=params)
+
+    return http_post(url, session, headers=headers, params=params)
+
+
+def _retry_delay(response, attempt):
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    try:
+        return min(float(retry_after), 60) if retry_after else 2 ** attempt
+    except ValueError:
+        return 2 ** attempt
+
+
+def release_with_retries(api_key, fusion_set_id, team_id, session=None, retries=3):
+    """
+    Releases a fusion set, retrying 429/503 responses and connections that could not be opened, where the release
+    did not happen. A release is not idempotent, so a connection lost after the request was sent is not retried: the
+    release may have happened, and its outcome is reported as unknown.
+
+    :return: Result dict (see RESULT_FIELDS)
+    """
+    start_time = monotonic()
+    result = {'fusion_set_id': fusion_set_id, 'team_id': team_id, 'new_fusion_set_id': None, 'status_code': None,
+              'attempts': 0, 'error': None, 'duration_sec': None}
+    for attempt in range(retries + 1):
+        result['attempts'] = attempt + 1
+        response = None
+        try:
+            response = release_fusion_set(api_key, fusion_set_id, team_id, session)
+            result['status_code'] = response.status_code
+            if response.status_code not in RETRY_STATUS_CODES:
+                validate_response(response)
+                result['new_fusion_set_id'] = response_json(response)['new_fusion_set_id']
+                result['error'] = None
+                break
+            result['error'] = f"Status Code: {response.status_code}. Response: {response.text}"
+        except requests.exceptions.ConnectionError as e:
+            if not request_not_sent(e):
+                result['error'] = (f"Unknown outcome, the connection was lost after the release was sent. Check the "
+                                   f"fusion sets of team {team_id} before releasing again: {e}")
+                break
+            result['error'] = f"Connection error: {e}"
+        except Exception as e:
+            result['error'] = str(e)
+            break
+        if attempt < retries:
+            delay = _retry_delay(response, attempt)
+            logging.debug(f"Retrying release of {fusion_set_id} to team {team_id} in {delay} seconds")
+            deadline_sleep(delay)
+    result['duration_sec'] = round(monotonic() - start_time, 3)
+    return result
+
+
+def read_release_mapping(mapping_path):
+    """
+    Reads the fusion sets to release and their target teams.
+
+    :param mapping_path: Json file {"<fusion set id>": ["<team id>", ...]} or a list of
+        {"fusion_set_id": ..., "team_id": ...}, or a csv file with fusion_set_id and team_id columns
+    :return: List of (fusion_set_id, team_id) pairs
+    """
+    try:
+        with open(mapping_path, 'r', newline='') as f:
+            if splitext(mapping_path)[-1].lower() == '.csv':
+                pairs = [(row['fusion_set_id'].strip(), row['team_id'].strip()) for row in csv.DictReader(f)]
+            else:
+                mapping = json.load(f)
+                if isinstance(mapping, dict):
+                    pairs = [(fusion_set_id, team_id) for fusion_set_id, team_ids in mapping.items()
+                             for team_id in ([team_ids] if isinstance(team_ids, str) else team_ids)]
+                else:
+                    pairs = [(item['fusion_set_id'], item['team_id']) for item in mapping]
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        log_and_exit(f"Failed to read release mapping {mapping_path}: {e}")
+    if not pairs or not all(fusion_set_id and team_id for fusion_set_id, team_id in pairs):
+        log_and_exit(f"Release mapping {mapping_path} must list fusion set and team id pairs")
+    return list(dict.fromkeys(pairs))
+
+
+def release_fusion_sets(api_key, pairs, max_workers=8, retries=3):
+    """
+    Releases many fusion sets concurrently over pooled connections.
+
+    :param pairs: List of (fusion_set_id, team_id)
+    :return: List of result dicts in the order of pairs
+    """
+    session = pooled_session(max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(release_with_retries, api_key, fusion_set_id, team_id, session, retries)
+                       for fusion_set_id, team_id in pairs]
+            results = []
+            for future in futures:
+                result = future.result()
+                if result['error']:
+                    logging.error(f"Release of fusion-set {result['fusion_set_id']} to team {result['team_id']} "
+                                  f"failed: {result['error']}")
+                else:
+                    logging.info(f"Fusion-set {result['fusion_set_id']} released to team {result['team_id']}. "
+                                 f"New Fusion-set id: {result['new_fusion_set_id']}")
+                results.append(result)
+            return results
+    finally:
+        session.close()
+
+
+def write_release_results(results, results_path):
+    if splitext(results_path)[-1].lower() == '.csv':
+        with open(results_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(results_path, 'w') as f:
+            json.dump({'results': results, 'failed': sum(1 for result in results if result['error'])}, f, indent=2)
+    logging.info(f"Release results written to {results_path}")
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Releases a fusion set from one team to another')
     add_common_args(parser, add_task_id=False, add_team_id=False)
-    parser.add_argument('-fs', '--fusion_set_id', required=True, metavar='fusion_set_id', help='Fusion set id to release')
-    parser.add_argument('-ti', '--team_id', metavar='team_id', required=True, help='The team id that will received the released fusion set')
+    parser.add_argument('-fs', '--fusion_set_id', metavar='fusion_set_id', help='Fusion set id to release')
+    parser.add_argument('-ti', '--team_id', metavar='team_id', help='The team id that will received the released fusion set')
+    parser.add_argument('--mapping', metavar='mapping_file', help='Json or csv file of fusion set ids and the team ids to release them to, for a bulk release')
+    parser.add_argument('--max_workers', type=int, default=8, help='Maximum number of concurrent releases. Default is 8')
+    parser.add_argument('--retries', type=int, default=3, help='Retries of a release on connection errors before the request was sent and 429/503 responses. Default is 3')
+    parser.add_argument('--results', metavar='results_file', help='Output csv or json file of the released fusion set ids')
     return parser.parse_args()
 
 
 def main():
     args = parse_arguments()
     init_common_args(args)
+    if args.mapping:
+        if args.fusion_set_id or args.team_id:
+            log_and_exit("fusion_set_id and team_id cannot be used with mapping")
+        validate_output_path(args.results)
+        pairs = read_release_mapping(args.mapping)
+        logging.info(f"Releasing {len(pairs)} fusion sets")
+        results = release_fusion_sets(args.api_key, pairs, args.max_workers, args.retries)
+        if args.results:
+            write_release_results(results, args.results)
+        failed = [result for result in results if result['error']]
+        if failed:
+            log_and_exit(f"{len(failed)} of {len(results)} releases failed")
+        return
+
+    if not args.fusion_set_id or not args.team_id:
+        log_and_exit("fusion_set_id and team_id must be specified, or a mapping file for a bulk release")
     r = release_fusion_set(args.api_key, args.fusion_set_id, args.team_id)
     validate_response(r)
     logging.info(f"Fusion-set {args.fusion_set_id} was successfully released to team: {args.team_id}")
-    logging.info(f"New Fusion-set id: {r.json()['new_fusion_set_id']}")
+    logging.info(f"New Fusion-set id: {response_json(r)['new_fusion_set_id']}")
 
 
 if __name__ == '__main__':
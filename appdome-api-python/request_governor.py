@@ -0,0 +1,224 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from deadline import active_deadline
+from file_lock import file_lock
+
+GOVERNOR_ENV = 'APPDOME_GOVERNOR'
+GOVERNOR_STATE_ENV = 'APPDOME_GOVERNOR_STATE'
+MAX_RATE_ENV = 'APPDOME_MAX_REQUEST_RATE'
+MAX_CONCURRENCY_ENV = 'APPDOME_MAX_CONCURRENCY'
+RETRIES_ENV = 'APPDOME_GOVERNOR_RETRIES'
+
+DECREASE_FACTOR = 0.5
+DECREASE_COOLDOWN_SEC = 1.0
+MAX_RETRY_AFTER_SEC = 300
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+DEFAULT_RETRIES = 3
+
+
+def _retry_after_sec(response):
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return 0
+    try:
+        return min(max(float(value), 0), MAX_RETRY_AFTER_SEC)
+    except ValueError:
+        return 0
+
+
+class SharedTokenBucket:
+    """
+    Token bucket whose state lives in a lock file, so every process on the host that uses the same state path
+    draws from the same bucket. The refill rate itself is adjusted with additive-increase/multiplicative-decrease
+    and a server requested pause (Retry-After) applies to all of them.
+    """
+    def __init__(self, state_path, initial_rate=5.0, min_rate=0.2, max_rate=50.0, burst=10):
+        self.state_path = state_path
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+
+    def _read_state(self, f, now):
+        f.seek(0)
+        try:
+            state = json.loads(f.read() or '{}')
+        except ValueError:
+            state = {}
+        state.setdefault('rate', self.initial_rate)
+        state.setdefault('tokens', float(self.burst))
+        state.setdefault('updated', now)
+        state.setdefault('paused_until', 0)
+        state.setdefault('last_decrease', 0)
+        state['rate'] = min(max(state['rate'], self.min_rate), self.max_rate)
+        state['tokens'] = min(self.burst, state['tokens'] + max(0, now - state['updated']) * state['rate'])
+        state['updated'] = now
+        return state
+
+    @staticmethod
+    def _write_state(f, state):
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(state))
+        f.flush()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            with file_lock(self.state_path) as f:
+                now = time.time()
+                state = self._read_state(f, now)
+                if now >= state['paused_until'] and state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    self._write_state(f, state)
+                    return
+                self._write_state(f, state)
+                wait_sec = max(state['paused_until'] - now, (1 - state['tokens']) / state['rate'])
+            time.sleep(min(max(wait_sec, 0.01), MAX_RETRY_AFTER_SEC))
+
+    def adjust(self, congested, retry_after_sec=0):
+        """
+        :param congested: Whether the request hit congestion (429/5xx, connection error or high latency)
+        :param retry_after_sec: Pause requested by the server
+        """
+        with file_lock(self.state_path) as f:
+            now = time.time()
+            state = self._read_state(f, now)
+            if congested:
+                if now - state['last_decrease'] >= DECREASE_COOLDOWN_SEC:
+                    state['rate'] = max(self.min_rate, state['rate'] * DECREASE_FACTOR)
+                    state['last_decrease'] = now
+                    logging.debug(f"Request rate decreased to {state['rate']:.2f} requests/sec")
+                if retry_after_sec:
+                    state['paused_until'] = max(state['paused_until'], now + retry_after_sec)
+            else:
+                state['rate'] = min(self.max_rate, state['rate'] + 1 / state['rate'])
+            self._write_state(f, state)
+
+    def rate(self):
+        with file_lock(self.state_path) as f:
+            return self._read_state(f, time.time())['rate']
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of in-flight requests of this process. The limit grows by one per limit successful requests
+    and is halved on congestion.
+    """
+    def __init__(self, initial=8, minimum=1, maximum=64):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self._in_flight = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, congested):
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if congested:
+                if now - self._last_decrease >= DECREASE_COOLDOWN_SEC:
+                    self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class RequestGovernor:
+    """
+    Sits in front of the Appdome API calls: a token bucket shared by all processes on the host limits the request
+    rate, and an adaptive limiter bounds in-flight requests of this process. Both back off multiplicatively on
+    429/5xx responses, connection errors and slow responses, and recover additively on success. Idempotent requests
+    that got a 429/5xx are sent again once the server requested pause (Retry-After) is over.
+    """
+    def __init__(self, state_path, max_rate=50.0, max_concurrency=64, latency_threshold_sec=10.0,
+                 retries=DEFAULT_RETRIES):
+        """
+        :param state_path: Path of the shared bucket state (and lock) file
+        :param max_rate: Maximum requests per second for all processes sharing the state path
+        :param max_concurrency: Maximum in-flight requests of this process
+        :param latency_threshold_sec: Responses slower than this count as congestion (requests without a body only)
+        :param retries: Retries of an idempotent request on 429/5xx responses
+        """
+        self.bucket = SharedTokenBucket(state_path, initial_rate=min(5.0, max_rate), max_rate=max_rate,
+                                        min_rate=min(0.2, max_rate))
+        self.limiter = AdaptiveConcurrencyLimiter(initial=min(8, max_concurrency), maximum=max_concurrency)
+        self.latency_threshold_sec = latency_threshold_sec
+        self.retries = retries
+
+    def _is_congested(self, response, observe_latency):
+        if response.status_code == 429 or response.status_code >= 500:
+            return True
+        elapsed = getattr(response, 'elapsed', None)
+        return observe_latency and elapsed is not None and elapsed.total_seconds() > self.latency_threshold_sec
+
+    def call(self, send, observe_latency=True, idempotent=False):
+        """
+        Sends a request when the rate and concurrency limits allow it.
+
+        :param send: Callable without arguments that sends the request and returns the response
+        :param observe_latency: Whether the response latency is a congestion signal
+        :param idempotent: Whether the request may be sent again on a 429/5xx response
+        :return: The response, the last one when the retries are exhausted
+        """
+        for attempt in range(self.retries + 1 if idempotent else 1):
+            response = self._send(send, observe_latency)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.retries:
+                return response
+            # The shared bucket pauses for Retry-After, this backoff spaces out retries the server did not time
+            wait_sec = max(_retry_after_sec(response), 2 ** attempt * 0.5)
+            deadline = active_deadline()
+            if deadline and deadline.remaining()[0] <= wait_sec:
+                return response
+            logging.debug(f"Retrying request after status {response.status_code} in {wait_sec} seconds")
+            response.close()
+            time.sleep(wait_sec)
+        return response
+
+    def _send(self, send, observe_latency):
+        self.bucket.acquire()
+        self.limiter.acquire()
+        response = None
+        congested = True
+        try:
+            response = send()
+            congested = self._is_congested(response, observe_latency)
+            return response
+        finally:
+            self.limiter.release(congested)
+            self.bucket.adjust(congested, _retry_after_sec(response) if congested else 0)
+
+    def stats(self):
+        return {'rate': self.bucket.rate(), 'concurrency_limit': int(self.limiter.limit)}
+
+
+def default_state_path(server_url, team_id=None):
+    key = hashlib.sha256(f"{server_url}|{team_id or ''}".encode('utf-8')).hexdigest()[:16]
+    uid = os.getuid() if hasattr(os, 'getuid') else 0
+    return os.path.join(tempfile.gettempdir(), f"appdome-governor-{uid}-{key}.json")
+
+
+def init_request_governor(server_url, team_id=None):
+    """
+    Creates the request governor from the environment. Returns None when disabled with APPDOME_GOVERNOR=off.
+    """
+    if os.getenv(GOVERNOR_ENV, 'on').lower() in ('off', 'false', '0'):
+        return None
+    state_path = os.getenv(GOVERNOR_STATE_ENV) or default_state_path(server_url, team_id)
+    return RequestGovernor(state_path, max_rate=float(os.getenv(MAX_RATE_ENV, 50)),
+                           max_concurrency=int(os.getenv(MAX_CONCURRENCY_ENV, 64)),
+                           retries=int(os.getenv(RETRIES_ENV, DEFAULT_RETRIES)))
@@ -3,9 +3,10 @@ import logging
 
 from utils import (add_provisioning_profiles_entitlements, add_google_play_signing_fingerprint,
                    run_task_action, cleaned_fd_list, validate_response, add_common_args, init_common_args, init_overrides,
-                   add_signing_credentials_args, TASK_ID_KEY, android_keystore, android_keystore_pass, android_keystore_alias,
+                   add_signing_credentials_args, android_keystore, android_keystore_pass, android_keystore_alias,
                    android_key_pass, ios_p12, ios_p12_password, ios_provisioning_profiles,
                    add_trusted_signing_fingerprint_list, validate_trusted_fingerprint_list_args)
+from models import parse_task
 
 SIGN_ACTION = 'sign'
 
@@ -71,7 +72,7 @@ def main():
                      ios_provisioning_profiles(args), args.entitlements, overrides)
 
     validate_response(r)
-    logging.info(f"On Appdome signing for Build id: {r.json()[TASK_ID_KEY]} started")
+    logging.info(f"On Appdome signing for Build id: {parse_task(r).task_id} started")
 
 
 if __name__ == '__main__':
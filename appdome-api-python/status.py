@@ -1,12 +1,14 @@
 import argparse
 import logging
-from datetime import datetime
-from time import sleep
+import threading
+from time import monotonic, sleep
 
-import requests
-
-from utils import (TASKS_URL, request_headers, JSON_CONTENT_TYPE, validate_response,
-                   log_and_exit, add_common_args, init_common_args, build_url, team_params)
+from completion_receiver import active_completion_receiver, register_task_callback
+from log_follower import WorkflowLogFollower
+from models import TaskStatus, parse_status
+from utils import (http_get, TASKS_URL, request_headers, JSON_CONTENT_TYPE, validate_response,
+                   log_and_exit, add_common_args, init_common_args, build_url, team_params, AppdomeError,
+                   AppdomeTaskError, AppdomeTimeoutError, add_metric, deadline_sleep, deadline_remaining)
 
 
 def status(api_key, team_id, task_id, url, last_date=None, messages=None):
@@ -14,94 +16,177 @@ def status(api_key, team_id, task_id, url, last_date=None, messages=None):
     params = team_params(team_id)
     headers = request_headers(api_key, JSON_CONTENT_TYPE)
     if messages:
+        params['messages'] = 'true'
         if last_date is not None and last_date != '':
-            request_url = f"{url}?messages=true&lastDate={last_date}"
-        else:
-            request_url = f"{url}?messages=true"
-    else:
-        request_url = url
-    return requests.get(request_url, headers=headers, params=params)
+            params['lastDate'] = last_date
+    add_metric('polls')
+    return http_get(url, headers=headers, params=params)
+
+
+class StatusPoller:
+    """
+    Polls the status of many tasks from a single thread, one round of status requests per interval, instead of every
+    concurrent job running its own polling loop. The thread runs while someone waits. Waiters that follow workflow
+    messages keep polling on their own, see wait_for_status_complete.
+    """
+    def __init__(self, api_key, team_id, url=TASKS_URL, interval_sec=10, num_of_retries=3):
+        self.api_key = api_key
+        self.team_id = team_id
+        self.url = url
+        self.interval_sec = interval_sec
+        self.num_of_retries = num_of_retries
+        self._waits = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            with self._lock:
+                pending = [wait for wait in self._waits.values() if not wait['done'].is_set()]
+                if not pending:
+                    self._thread = None
+                    return
+            for wait in pending:
+                self._poll(wait)
+            sleep(self.interval_sec)
+
+    def _poll(self, wait):
+        try:
+            status_response = status(self.api_key, self.team_id, wait['task_id'], self.url)
+            validate_response(status_response)
+            wait['status'] = parse_status(status_response)
+        except Exception as e:
+            wait['failures'] += 1
+            if wait['failures'] >= self.num_of_retries:
+                wait['error'] = e
+                wait['done'].set()
+            return
+        wait['failures'] = 0
+        if wait['status'].status != 'progress':
+            wait['done'].set()
+
+    def wait(self, task_id, timeout_sec=3600):
+        """
+        Waits for a task to finish, like wait_for_status_complete.
+
+        :raise AppdomeTaskError: When the task did not complete successfully
+        :raise AppdomeTimeoutError: When the task did not finish within timeout_sec or the deadline
+        """
+        wait = {'task_id': task_id, 'done': threading.Event(), 'status': TaskStatus(), 'error': None, 'failures': 0}
+        key = object()
+        with self._lock:
+            self._waits[key] = wait
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='appdome-status-poller', daemon=True)
+                self._thread.start()
+        started = monotonic()
+        try:
+            while not wait['done'].is_set():
+                left_sec = timeout_sec - (monotonic() - started)
+                if left_sec <= 0:
+                    log_and_exit(f"Task {task_id} did not complete in the specified timeout of: {timeout_sec} seconds",
+                                 AppdomeTimeoutError)
+                remaining = deadline_remaining()
+                wait['done'].wait(min(left_sec, remaining) if remaining is not None else left_sec)
+        finally:
+            with self._lock:
+                del self._waits[key]
+
+        if wait['error']:
+            raise AppdomeError(f"Wait for status Error. Error: {wait['error']}") from wait['error']
+        task_status = wait['status']
+        if task_status.status != 'completed':
+            log_and_exit(f"Task not completed successfully. Response: {task_status.message}",
+                         AppdomeTaskError, task_id=task_id, status=task_status.status)
 
 
 def wait_for_status_complete(api_key, team_id, task_id, url=TASKS_URL, interval_sec=10, timeout_sec=3600,
-                             num_of_retries=3, operation=None, workflow_output_logs_path=None):
+                             num_of_retries=3, operation=None, workflow_output_logs_path=None, log_follower=None,
+                             completion_receiver=None, poller=None):
+    if poller and log_follower is None and workflow_output_logs_path is None:
+        return poller.wait(task_id, timeout_sec)
+
     accumulated_sleep = 0
-    status_value = 'not initialized'
-    file_handle = open(workflow_output_logs_path, 'a') if workflow_output_logs_path else None
-    status_response_json = ''
-    last_date = ''
-
-    # Determine whether to use detailed logging based on the URL
-    detailed_logging = operation != "upload" and file_handle is not None
-
-    if file_handle:
-        file_handle.write(operation + ":\n")
-
-    while accumulated_sleep <= timeout_sec:
-        status_response = None
-        for i in range(num_of_retries):
-            try:
-                if detailed_logging:
-                    last_date = last_date
-                    messages = True
-                else:
-                    last_date = None
-                    messages = False
-                status_response = status(api_key, team_id, task_id, url, last_date, messages)
+    task_status = TaskStatus('not initialized')
+    owns_follower = log_follower is None and workflow_output_logs_path is not None
+    if owns_follower:
+        log_follower = WorkflowLogFollower(workflow_output_logs_path, task_id=task_id)
 
-                # Validate HTTP status code is 200 or 204
-                if status_response.status_code in [200, 204]:
-                    break  # Exit retry loop on success
-                else:
-                    # Continue retrying if status code is not valid
-                    sleep(interval_sec)
-            except Exception as e:
-                if i == num_of_retries - 1:
-                    raise Exception(f'Wait for status Error. Error: {e}')
-                sleep(interval_sec)
-
-        validate_response(status_response)
-        status_response_json = status_response.json()
-        status_value = status_response_json.get('status', '')
-
-        if status_value == 'progress':
-            if detailed_logging:
-                messages = status_response_json.get('messages', [])
-                for message in messages:
-                    message_text = message.get('message', {}).get('text', '')
-                    message_type = message.get('message_type', '')
+    # Workflow messages are only requested when someone follows them
+    detailed_logging = operation != "upload" and log_follower is not None
 
-                    if message_text:
-                        print(f" - {message_text}")
-                        if message_text:
-                            if file_handle:
-                                file_handle.write(message_text + '\n')
+    if detailed_logging:
+        log_follower.begin(operation)
 
-                if messages:
-                    last_date = messages[-1].get('creation_time')
+    # With a completion receiver the server calls back on status changes, and polling is only a safety net
+    receiver = completion_receiver or active_completion_receiver()
+    if receiver and (url != TASKS_URL or
+                     not register_task_callback(api_key, team_id, task_id, receiver.callback_url(task_id))):
+        receiver = None
 
-            else:
-                print('.', end='', flush=True)
+    try:
+        while accumulated_sleep <= timeout_sec:
+            status_response = None
+            for i in range(num_of_retries):
+                try:
+                    last_date = log_follower.cursor if detailed_logging else None
+                    status_response = status(api_key, team_id, task_id, url, last_date, detailed_logging)
+
+                    # Validate HTTP status code is 200 or 204
+                    if status_response.status_code in [200, 204]:
+                        break  # Exit retry loop on success
+                    else:
+                        # Continue retrying if status code is not valid
+                        deadline_sleep(interval_sec)
+                except AppdomeTimeoutError:
+                    raise
+                except Exception as e:
+                    if i == num_of_retries - 1:
+                        raise AppdomeError(f'Wait for status Error. Error: {e}') from e
+                    deadline_sleep(interval_sec)
+
+            validate_response(status_response)
+            task_status = parse_status(status_response)
 
-            sleep(interval_sec)
-            accumulated_sleep += interval_sec
+            if detailed_logging:
+                # Messages of the final response are written too, the cursor drops what was already seen
+                log_follower.feed(task_status.messages)
+
+            if task_status.status == 'progress':
+                if not detailed_logging:
+                    print('.', end='', flush=True)
+
+                if receiver:
+                    wait_start = monotonic()
+                    remaining = deadline_remaining()
+                    receiver.wait(task_id, receiver.fallback_interval_sec if remaining is None
+                                  else min(receiver.fallback_interval_sec, remaining))
+                    accumulated_sleep += monotonic() - wait_start
+                else:
+                    deadline_sleep(interval_sec)
+                    accumulated_sleep += interval_sec
 
-        else:
-            print('', flush=True)
-            break
+            else:
+                print('', flush=True)
+                break
+    finally:
+        if receiver:
+            receiver.forget(task_id)
+        if owns_follower:
+            log_follower.close()
 
     if accumulated_sleep > timeout_sec:
-        log_and_exit(f"\nTask did not complete in the specified timeout of: {timeout_sec} seconds")
+        log_and_exit(f"\nTask did not complete in the specified timeout of: {timeout_sec} seconds", AppdomeTimeoutError)
 
-    if status_value != 'completed':
-        log_and_exit(f"Task not completed successfully. Response: {status_response_json.get('message')}")
+    if task_status.status != 'completed':
+        log_and_exit(f"Task not completed successfully. Response: {task_status.message}",
+                     AppdomeTaskError, task_id=task_id, status=task_status.status)
 
 
 def _get_obfuscation_map_status(api_key, team_id, task_id):
     try:
         status_response = status(api_key, team_id, task_id, TASKS_URL)
-        status_response_json = status_response.json()
-        return status_response_json.get('obfuscationMapExists', False)
+        return parse_status(status_response).obfuscation_map_exists
     except Exception as e:
         print(f"Couldn't get status of obfuscation map. Error: {e}")
 
@@ -0,0 +1,285 @@
+import argparse
+import hashlib
+import logging
+import os
+import stat
+import sys
+from contextlib import ExitStack
+from os.path import basename, exists, join
+from time import monotonic
+from uuid import uuid4
+
+import requests
+
+from direct_upload import direct_upload
+from models import parse_upload, response_json
+from status import wait_for_status_complete
+from upload import get_upload_link, upload_using_link
+from utils import (http_put, http_post, build_url, team_params, request_headers, validate_response, debug_log_request,
+                   log_and_exit, erased_temp_dir, deadline_sleep, add_metric, add_common_args, init_common_args,
+                   SERVER_API_V1_URL, UPLOAD_URL)
+
+STDIN_SOURCE = '-'
+PART_SIZE = 8 * 1024 * 1024
+DEFAULT_IDLE_SEC = 30
+POLL_SEC = 0.2
+ZIP_EOCD_SIGNATURE = b'PK\x05\x06'
+ZIP_EOCD_SIZE = 22
+ZIP_MAX_COMMENT_SIZE = 0xFFFF
+# Storage and servers that refuse request bodies without a Content-Length answer with these
+NO_CHUNKED_STATUS_CODES = (411, 501)
+
+
+def zip_complete(path):
+    """
+    Apps (apk, aab and ipa) are zip files, whose writers finish with the end of central directory record.
+
+    :return: True when the file ends with a zip end of central directory record
+    """
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        tail_size = min(size, ZIP_EOCD_SIZE + ZIP_MAX_COMMENT_SIZE)
+        f.seek(size - tail_size)
+        tail = f.read(tail_size)
+    index = tail.rfind(ZIP_EOCD_SIGNATURE)
+    if index < 0 or len(tail) - index < ZIP_EOCD_SIZE:
+        return False
+    comment_size = int.from_bytes(tail[index + 20:index + 22], 'little')
+    return len(tail) - index - ZIP_EOCD_SIZE == comment_size
+
+
+def iter_growing_file(path, part_size=PART_SIZE, idle_sec=DEFAULT_IDLE_SEC, poll_sec=POLL_SEC):
+    """
+    Reads a file while another process is still writing it. The file is done once it is a complete zip and did not
+    grow for one more poll, or when it did not grow for idle_sec.
+
+    :param path: App file, which may not exist yet
+    :param idle_sec: Seconds without new bytes after which the file is considered done
+    :yield: Bytes of the file, at most part_size at a time
+    """
+    idle_since = monotonic()
+    while not exists(path):
+        if monotonic() - idle_since >= idle_sec:
+            log_and_exit(f"{path} was not created within {idle_sec} seconds")
+        deadline_sleep(poll_sec)
+    with open(path, 'rb') as f:
+        idle_since = monotonic()
+        complete = False
+        while True:
+            chunk = f.read(part_size)
+            if chunk:
+                idle_since = monotonic()
+                complete = False
+                yield chunk
+                continue
+            if complete or monotonic() - idle_since >= idle_sec:
+                return
+            complete = zip_complete(path)
+            deadline_sleep(poll_sec)
+
+
+def iter_pipe(f, part_size=PART_SIZE):
+    """
+    :param f: Binary file object of a pipe or stdin
+    :yield: Bytes of the pipe until it is closed, part_size at a time
+    """
+    return iter(lambda: f.read(part_size), b'')
+
+
+class UploadStream:
+    """
+    Bytes of an app that is still being produced, hashed as they are sent. Bytes that cannot be read again (from a
+    pipe or stdin) are spooled to replay_path, so the upload can be sent again with a Content-Length when the
+    destination does not accept chunked bodies.
+    """
+    def __init__(self, chunks, replay_path, spool=False):
+        """
+        :param chunks: Iterable of the app bytes
+        :param replay_path: File holding all the app bytes once the chunks are consumed
+        :param spool: Write the chunks to replay_path on the way
+        """
+        self._chunks = iter(chunks)
+        self.replay_path = replay_path
+        self._spool = open(replay_path, 'wb') if spool else None
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            self._sha256.update(chunk)
+            self.size += len(chunk)
+            if self._spool:
+                self._spool.write(chunk)
+            yield chunk
+        if self._spool:
+            self._spool.close()
+
+    def drain(self):
+        """
+        Consumes the chunks an interrupted upload did not send, so that replay_path holds the whole app.
+        """
+        for _ in self:
+            pass
+
+    def digest(self):
+        return {'size': self.size, 'sha256': self._sha256.hexdigest()}
+
+
+def multipart_chunks(chunks, field_name, file_name, boundary):
+    """
+    Frames a stream of file bytes as a multipart/form-data body with a single file field.
+    """
+    yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{field_name}"; filename="{file_name}"\r\n'
+           f'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8')
+    yield from chunks
+    yield f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+
+def _send_stream(send, replay):
+    """
+    Sends a streamed body, and sends it again from the replay file when the destination refused the chunked body.
+
+    :param send: Callable sending the chunked body
+    :param replay: Callable sending the body again from UploadStream.replay_path
+    """
+    try:
+        response = send()
+    except requests.exceptions.ConnectionError as e:
+        logging.info(f"Streamed upload interrupted ({e}), sending it again with its length")
+        return replay()
+    if response.status_code not in NO_CHUNKED_STATUS_CODES:
+        return response
+    logging.info(f"Upload destination does not accept chunked uploads (status {response.status_code}), "
+                 f"sending it again with its length")
+    return replay()
+
+
+def _put_stream(aws_url, stream):
+    """
+    PUTs the stream to a pre-signed url. S3 pre-signed urls refuse chunked bodies, so against S3 the app is sent
+    again with its length once it is complete, and only --direct_upload overlaps the upload with the app build.
+    """
+    def replay():
+        stream.drain()
+        with open(stream.replay_path, 'rb') as f:
+            debug_log_request(aws_url, request_type='put')
+            return http_put(aws_url, data=f)
+
+    debug_log_request(aws_url, request_type='put')
+    return _send_stream(lambda: http_put(aws_url, data=iter(stream)), replay)
+
+
+def _post_stream(api_key, team_id, stream, file_name):
+    url = build_url(SERVER_API_V1_URL, 'upload')
+    params = team_params(team_id)
+    boundary = uuid4().hex
+    headers = request_headers(api_key, f'multipart/form-data; boundary={boundary}')
+
+    def replay():
+        stream.drain()
+        return direct_upload(api_key, team_id, stream.replay_path, file_name)
+
+    debug_log_request(url, headers=headers, params=params)
+    return _send_stream(lambda: http_post(url, headers=headers, params=params,
+                                          data=multipart_chunks(stream, 'file', file_name, boundary)), replay)
+
+
+def stream_upload(api_key, team_id, source, file_name=None, direct=False, idle_sec=DEFAULT_IDLE_SEC,
+                  part_size=PART_SIZE):
+    """
+    Uploads an app while it is being produced, see stream_upload_with_digest.
+
+    :return: Upload response, like upload.upload
+    """
+    return stream_upload_with_digest(api_key, team_id, source, file_name, direct, idle_sec, part_size)[0]
+
+
+def stream_upload_with_digest(api_key, team_id, source, file_name=None, direct=False, idle_sec=DEFAULT_IDLE_SEC,
+                              part_size=PART_SIZE):
+    """
+    Uploads an app while it is being produced, so the upload overlaps the end of the app build and the app is not
+    read from disk again once it is written. The bytes are sent with a chunked body, part_size at a time, and hashed
+    on the way.
+
+    :param source: '-' for stdin, a named pipe, or an app file that may still be written
+    :param file_name: App file name on Appdome, default is the source file name. Required for stdin
+    :param direct: Upload directly to Appdome instead of through a pre-signed url. Only a direct upload overlaps the
+        app build, see _put_stream
+    :param idle_sec: Seconds without new bytes after which an app file that is not a complete zip is considered done
+    :return: (upload response like upload.upload, dict with the size and sha256 of the streamed app)
+    """
+    file_name = file_name or (basename(source) if source != STDIN_SOURCE else None)
+    if not file_name:
+        log_and_exit("An app file name is required to upload from stdin")
+    logging.info(f"Preparing to stream upload [{file_name}] from {'stdin' if source == STDIN_SOURCE else source}")
+    with erased_temp_dir() as spool_dir, ExitStack() as stack:
+        if source == STDIN_SOURCE:
+            chunks, replay_path = iter_pipe(sys.stdin.buffer, part_size), None
+        elif exists(source) and stat.S_ISFIFO(os.stat(source).st_mode):
+            chunks, replay_path = iter_pipe(stack.enter_context(open(source, 'rb')), part_size), None
+        else:
+            chunks, replay_path = iter_growing_file(source, part_size, idle_sec), source
+        stream = UploadStream(chunks, replay_path or join(spool_dir, file_name), spool=not replay_path)
+        if direct:
+            app = _post_stream(api_key, team_id, stream, file_name)
+        else:
+            app = _upload_stream_using_link(api_key, team_id, stream, file_name)
+    validate_response(app)
+    digest = stream.digest()
+    add_metric('bytes', digest['size'])
+    logging.info(f"Streamed {digest['size']} bytes of {file_name}, sha256 {digest['sha256']}")
+    if not direct:
+        wait_for_status_complete(api_key, team_id, parse_upload(app).id, url=UPLOAD_URL, operation="upload")
+    return app, digest
+
+
+def _upload_stream_using_link(api_key, team_id, stream, file_name):
+    upload_link_response = get_upload_link(api_key, team_id)
+    validate_response(upload_link_response)
+    upload_link_json = response_json(upload_link_response)
+    aws_url = upload_link_json.get('url')
+    file_id = upload_link_json.get('file_id')
+    if not aws_url or not file_id:
+        log_and_exit('Error in upload link response: ' + upload_link_response.text)
+
+    logging.info(f"Streaming file id {file_id}")
+    validate_response(_put_stream(aws_url, stream))
+    app = upload_using_link(api_key, team_id, file_id, file_name)
+    logging.info(f"Upload status: analyzing and saving file info on our servers")
+    return app
+
+
+def add_stream_upload_args(parser, add_stream_flag=True):
+    if add_stream_flag:
+        parser.add_argument('--stream_upload', action='store_true',
+                            help="Upload the app while it is being written: '-' for stdin, a named pipe, or an app "
+                                 "file still being written. The upload only overlaps the writing with --direct_upload, "
+                                 "as the pre-signed S3 url refuses chunked bodies and gets the app once it is complete")
+    parser.add_argument('--app_name', metavar='app_file_name',
+                        help='App file name on Appdome when streaming, required for stdin. Default is the app file name')
+    parser.add_argument('--stream_idle_sec', type=float, default=DEFAULT_IDLE_SEC,
+                        help='Seconds without new bytes after which a streamed app file that is not yet a complete '
+                             f'zip is considered done. Default is {DEFAULT_IDLE_SEC}')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Upload app to Appdome while it is being written')
+    add_common_args(parser)
+    parser.add_argument('-a', '--app', required=True, metavar='application_source',
+                        help="App input: '-' for stdin, a named pipe, or an app file still being written")
+    add_stream_upload_args(parser, add_stream_flag=False)
+    parser.add_argument('--direct_upload', action='store_true',
+                        help="Upload app directly to Appdome, and not through aws pre-signed url. Required for the "
+                             "upload to overlap the writing of the app")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    init_common_args(args)
+    r = stream_upload(args.api_key, args.team_id, args.app, args.app_name, args.direct_upload, args.stream_idle_sec)
+    logging.info(f"Upload success: App id: {parse_upload(r).id}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+from os.path import abspath, dirname, join
+
+CLIENT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, CLIENT_DIR)
+
+from load_generator import start_mock_server
+
+MOCK_DURATIONS = {'fuse': 0, 'context': 0, 'sign': 0, 'seal': 0, 'sign_script': 0}
+
+
+def write_app(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'PK')
+        for _ in range(size // (1024 * 1024)):
+            f.write(os.urandom(1024 * 1024))
+        f.write(os.urandom(size % (1024 * 1024)))
+
+
+def run_script(server_url, work_dir, script, *args, stdin=None):
+    """
+    Runs a client script against the mock server in its own process, as the client modules read the server url when
+    they are imported.
+
+    :param script: Script file name, e.g. 'appdome_api.py'
+    :param stdin: File the command reads as its stdin (optional)
+    """
+    env = dict(os.environ, APPDOME_SERVER_BASE_URL=server_url,
+               APPDOME_GOVERNOR_STATE=join(work_dir, 'governor.json'))
+    return subprocess.run([sys.executable, join(CLIENT_DIR, script), '-key', 'test-key', *args],
+                          env=env, cwd=work_dir, stdin=stdin, capture_output=True, text=True, timeout=120)
+
+
+def run_appdome_api(server_url, work_dir, *args, stdin=None):
+    """
+    Runs the whole process command against the mock server.
+    """
+    return run_script(server_url, work_dir, 'appdome_api.py', *args, stdin=stdin)
@@ -0,0 +1,44 @@
+import sys
+import unittest
+from concurrent.futures import Future
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from appdome_client import AppdomeClient
+from utils import AppdomeTaskError
+
+
+class StepChainingTest(unittest.TestCase):
+    def test_waiting_steps_do_not_hold_workers(self):
+        upload = Future()
+        with AppdomeClient('api-key', max_workers=1) as client:
+            builds = [client._submit(lambda app_id, index=index: f"{app_id}-build{index}", upload)
+                      for index in range(4)]
+            signs = [client._submit(lambda task_id: f"{task_id}-signed", build) for build in builds]
+            # All the pipelines wait for the upload, yet the only worker is free for other steps
+            self.assertEqual(client._submit(lambda: 'status').result(timeout=10), 'status')
+            upload.set_result('app1')
+            self.assertEqual([sign.result(timeout=10) for sign in signs],
+                             [f"app1-build{index}-signed" for index in range(4)])
+
+    def test_failed_input_fails_the_step_without_running_it(self):
+        calls = []
+        with AppdomeClient('api-key', max_workers=2) as client:
+            build = client._submit(lambda: (_ for _ in ()).throw(AppdomeTaskError('build failed', task_id='t1')))
+            sign = client._submit(calls.append, build)
+            with self.assertRaises(AppdomeTaskError):
+                sign.result(timeout=10)
+        self.assertEqual(calls, [])
+
+    def test_close_waits_for_chained_steps(self):
+        upload = Future()
+        client = AppdomeClient('api-key', max_workers=1)
+        build = client._submit(lambda app_id: f"{app_id}-build", upload)
+        client._submit(lambda: upload.set_result('app1'))
+        client.close()
+        self.assertEqual(build.result(timeout=0), 'app1-build')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from os.path import abspath, dirname, join
+from unittest import mock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import artifact_cache
+from artifact_cache import ArtifactCache
+
+
+class CrossFilesystemCacheTest(unittest.TestCase):
+    """
+    The cache on another filesystem than the outputs: nothing can be hardlinked or reflinked, and the artifacts are
+    copied without holding the cache lock.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache = ArtifactCache(join(self.work_dir, 'cache'))
+        self.copies = []
+        patches = [mock.patch.object(artifact_cache.os, 'link', side_effect=OSError(errno.EXDEV, 'cross-device')),
+                   mock.patch.object(artifact_cache, '_reflink', return_value=False),
+                   mock.patch.object(artifact_cache.shutil, 'copyfile', side_effect=self._copy(shutil.copyfile)),
+                   mock.patch.object(artifact_cache.shutil, 'copyfileobj',
+                                     side_effect=self._copy(shutil.copyfileobj))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _copy(self, copy):
+        def locked_copy(*args, **kwargs):
+            with open(self.cache.lock_path, 'a+') as f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                    self.copies.append('unlocked')
+                except BlockingIOError:
+                    self.copies.append('locked')
+            return copy(*args, **kwargs)
+        return locked_copy
+
+    def test_copies_outside_of_the_lock(self):
+        data = os.urandom(256 * 1024)
+        output = join(self.work_dir, 'app.apk')
+        with open(output, 'wb') as f:
+            f.write(data)
+        digest = {'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+        self.cache.store('key', output, digest, '"etag"', None)
+        cached_output = join(self.work_dir, 'cached.apk')
+        entry = self.cache.link_cached('key', cached_output)
+        self.assertEqual(entry['method'], 'copy')
+        with open(cached_output, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self.copies, ['unlocked', 'unlocked'])
+        self.assertEqual(sorted(os.listdir(self.cache.blobs_dir)), [digest['sha256']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import unittest
+from os.path import abspath, dirname, exists, join
+from unittest import mock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import artifact_stream
+import artifact_tee
+import download
+from artifact_stream import ArtifactManifest, stream_to_file
+from artifact_tee import S3_MIN_PART_SIZE, S3Sink, Sink, TeeDestinations, check_tee
+from post_processors import Digester
+from utils import AppdomeIntegrityError, AppdomePublishError
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+
+class Response:
+    status_code = 200
+
+    def __init__(self, data, headers=None):
+        self.data = data
+        self.headers = dict({'Content-Length': str(len(data))}, **(headers or {}))
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+def _fail_to_replace(output_path):
+    replace = os.replace
+
+    def fail(src, dst):
+        if dst == output_path:
+            raise OSError('disk full')
+        replace(src, dst)
+
+    return mock.patch.object(artifact_stream.os, 'replace', side_effect=fail)
+
+
+class TeeTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.mirror = join(self.work_dir, 'mirror')
+        os.makedirs(self.mirror)
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+
+    def test_download_action_tees_after_the_processors(self):
+        output = join(self.work_dir, 'app.apk')
+        manifest = ArtifactManifest(join(self.work_dir, 'manifest.json'))
+        with mock.patch.object(download, 'download', return_value=Response(self.data)):
+            download.download_action('api-key', None, 'task1', output, None, manifest, processors=[Digester()],
+                                     tee=TeeDestinations([self.mirror]))
+        with open(join(self.mirror, 'app.apk'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        entry = manifest.get(output)
+        self.assertIn('digests', entry)
+        self.assertEqual(entry['tee'], [{'kind': 'directory', 'destination': join(self.mirror, 'app.apk'),
+                                         'status': 'written', 'size': len(self.data),
+                                         'sha256': hashlib.sha256(self.data).hexdigest()}])
+
+    def test_failed_download_discards_the_copies(self):
+        response = Response(self.data, {'X-Checksum-Sha256': '0' * 64})
+        tee = TeeDestinations([self.mirror]).processor(join(self.work_dir, 'app.apk'))
+        with self.assertRaises(AppdomeIntegrityError):
+            stream_to_file(response, join(self.work_dir, 'app.apk'), processors=[tee])
+        self.assertEqual(os.listdir(self.mirror), [])
+        self.assertEqual(tee.result()[0]['status'], 'aborted')
+
+    def test_failed_copy_keeps_the_local_file(self):
+        output = join(self.work_dir, 'app.apk')
+        missing = join(self.work_dir, 'missing')
+        tee = TeeDestinations([self.mirror]).processor(output)
+        tee.sinks[0].path = tee.sinks[0]._temp_path = join(missing, 'app.apk')
+        digest = stream_to_file(Response(self.data), output, processors=[tee])
+        self.assertTrue(exists(output))
+        self.assertEqual(digest['tee'][0]['status'], 'failed')
+        with self.assertRaises(AppdomePublishError):
+            check_tee(digest, output)
+        json.dumps(digest)
+
+    def test_failed_move_deletes_the_committed_copy(self):
+        output = join(self.work_dir, 'app.apk')
+        tee = TeeDestinations([self.mirror]).processor(output)
+        with _fail_to_replace(output):
+            with self.assertRaises(OSError):
+                stream_to_file(Response(self.data), output, processors=[tee])
+        self.assertEqual(os.listdir(self.mirror), [])
+        self.assertEqual(tee.result()[0]['status'], 'discarded')
+
+    def test_failed_commit_is_reported(self):
+        output = join(self.work_dir, 'app.apk')
+        tee = TeeDestinations([self.mirror]).processor(output)
+        with mock.patch.object(tee.sinks[0], 'commit', side_effect=OSError('share unmounted')):
+            digest = stream_to_file(Response(self.data), output, processors=[tee])
+        self.assertEqual((digest['tee'][0]['status'], digest['tee'][0]['error']), ('failed', 'share unmounted'))
+
+    def test_sink_must_implement_write_and_commit(self):
+        class PartialSink(Sink):
+            def _write(self, chunk):
+                pass
+
+        with self.assertRaises(TypeError):
+            PartialSink('destination')
+
+
+@unittest.skipIf(artifact_tee.boto3 is None or mock_aws is None, 'requires boto3 and moto')
+class S3SinkTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.output = join(self.work_dir, 'app.apk')
+        environment = mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing',
+                                                   'AWS_DEFAULT_REGION': 'us-east-1'})
+        environment.start()
+        self.addCleanup(environment.stop)
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        self.tee = TeeDestinations(['s3://bucket/builds'], part_size=S3_MIN_PART_SIZE)
+        self.client = self.tee._buckets[0][0]
+        self.client.create_bucket(Bucket='bucket')
+
+    def _object(self, key='builds/app.apk'):
+        return self.client.get_object(Bucket='bucket', Key=key)
+
+    def test_multipart_upload(self):
+        data = os.urandom(2 * S3_MIN_PART_SIZE + 1024)
+        digest = stream_to_file(Response(data), self.output, processors=[self.tee.processor(self.output)])
+        result = digest['tee'][0]
+        self.assertEqual((result['status'], result['parts'], result['size']), ('written', 3, len(data)))
+        self.assertEqual(result['destination'], 's3://bucket/builds/app.apk')
+        self.assertEqual(result['sha256'], hashlib.sha256(data).hexdigest())
+        stored = self._object()
+        self.assertEqual(stored['Body'].read(), data)
+        self.assertEqual(stored['ETag'].strip('"'), result['etag'])
+        self.assertTrue(result['etag_verified'])
+        self.assertNotIn('Uploads', self.client.list_multipart_uploads(Bucket='bucket'))
+
+    def test_small_download_is_put(self):
+        data = os.urandom(1024)
+        digest = stream_to_file(Response(data), self.output, processors=[self.tee.processor(self.output)])
+        result = digest['tee'][0]
+        self.assertEqual((result['parts'], result['etag']), (1, hashlib.md5(data).hexdigest()))
+        self.assertTrue(result['etag_verified'])
+        self.assertEqual(self._object()['Body'].read(), data)
+
+    def test_unexpected_etag_is_reported(self):
+        sink = S3Sink(self.client, 'bucket', 'app.apk', 's3://bucket/app.apk', S3_MIN_PART_SIZE)
+        sink.write(os.urandom(S3_MIN_PART_SIZE + 1))
+        complete = self.client.complete_multipart_upload
+        with mock.patch.object(self.client, 'complete_multipart_upload',
+                               side_effect=lambda **kwargs: dict(complete(**kwargs), ETag='"kms-etag"')):
+            details = sink.commit()
+        self.assertEqual(details, {'etag': 'kms-etag', 'etag_verified': False, 'parts': 2})
+
+    def test_failed_download_aborts_the_multipart_upload(self):
+        data = os.urandom(2 * S3_MIN_PART_SIZE)
+        tee = self.tee.processor(self.output)
+        with self.assertRaises(AppdomeIntegrityError):
+            stream_to_file(Response(data, {'X-Checksum-Sha256': '0' * 64}), self.output, processors=[tee])
+        self.assertEqual(tee.result()[0]['status'], 'aborted')
+        self.assertNotIn('Uploads', self.client.list_multipart_uploads(Bucket='bucket'))
+        self.assertNotIn('Contents', self.client.list_objects_v2(Bucket='bucket'))
+
+    def test_failed_move_deletes_the_committed_object(self):
+        tee = self.tee.processor(self.output)
+        with _fail_to_replace(self.output):
+            with self.assertRaises(OSError):
+                stream_to_file(Response(os.urandom(1024)), self.output, processors=[tee])
+        self.assertEqual(tee.result()[0]['status'], 'discarded')
+        self.assertNotIn('Contents', self.client.list_objects_v2(Bucket='bucket'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+from os.path import abspath, dirname, exists, join
+from unittest import mock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import certified_secure_export
+from certified_secure_export import CertificateExporter, CertificateIndex
+from utils import AppdomeError
+
+
+class Response:
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+        self.headers = {'Content-Length': str(len(data))}
+
+    def iter_content(self, chunk_size):
+        yield self.data
+
+    def close(self):
+        pass
+
+
+def _pdf(api_key, team_id, task_id, stream=False, session=None):
+    return Response(f"%PDF {task_id}".encode('utf-8'))
+
+
+def _json(api_key, team_id, task_id, stream=False, session=None):
+    return Response(json.dumps({'task_id': task_id, 'protections': [{'name': 'anti-debug'}]}).encode('utf-8'))
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.archive = join(self.work_dir, 'export.zip')
+        self.index = CertificateIndex(self.archive + '.index.sqlite')
+        self.addCleanup(self.index.close)
+        patches = [mock.patch.object(certified_secure_export, 'download_certified_secure', side_effect=_pdf),
+                   mock.patch.object(certified_secure_export, 'download_certified_secure_json', side_effect=_json)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _exporter(self):
+        spool_dir = tempfile.mkdtemp(dir=self.work_dir)
+        return CertificateExporter('api-key', 'team', self.archive, self.index, spool_dir, max_workers=2)
+
+    def _export(self, task_ids):
+        exporter = self._exporter()
+        try:
+            errors = exporter.export(task_ids)
+            exporter.commit()
+        finally:
+            exporter.close()
+        return errors
+
+    def _members(self):
+        with zipfile.ZipFile(self.archive) as archive:
+            self.assertIsNone(archive.testzip())
+            return sorted(archive.namelist())
+
+    def test_export_appends_to_the_archive(self):
+        self.assertEqual(self._export(['t1']), {})
+        self.assertEqual(self._export(['t1', 't2']), {})
+        self.assertEqual(self._members(), ['t1/certified_secure.json', 't1/certified_secure.pdf',
+                                           't2/certified_secure.json', 't2/certified_secure.pdf'])
+        self.assertEqual(self.index.exported_task_ids(), {'t1', 't2'})
+        self.assertEqual(self.index.search('anti-debug'), [('t1', 'protections[0].name', 'anti-debug'),
+                                                           ('t2', 'protections[0].name', 'anti-debug')])
+        self.assertFalse(exists(self.archive + '.part'))
+
+    def test_killed_export_keeps_the_previous_runs(self):
+        self._export(['t1'])
+        # A run killed after appending to the archive, before it was committed
+        killed = self._exporter()
+        self.addCleanup(killed.close)
+        self.assertEqual(killed.export(['t2', 't3']), {})
+        killed._archive.fp.flush()
+        self.assertEqual(self._members(), ['t1/certified_secure.json', 't1/certified_secure.pdf'])
+        self.assertEqual(self.index.exported_task_ids(), {'t1'})
+
+        with mock.patch.object(certified_secure_export, 'download_certified_secure', side_effect=_pdf) as pdf:
+            self.assertEqual(self._export(['t1', 't2', 't3']), {})
+        self.assertEqual(sorted(call.args[2] for call in pdf.call_args_list), ['t2', 't3'])
+        self.assertEqual(len(self._members()), 6)
+        self.assertEqual(self.index.exported_task_ids(), {'t1', 't2', 't3'})
+
+    def test_failed_tasks_are_not_indexed(self):
+        def pdf(api_key, team_id, task_id, stream=False, session=None):
+            if task_id == 't2':
+                raise ConnectionError('reset')
+            return _pdf(api_key, team_id, task_id)
+
+        with mock.patch.object(certified_secure_export, 'download_certified_secure', side_effect=pdf):
+            self.assertEqual(list(self._export(['t1', 't2'])), ['t2'])
+        self.assertEqual(self.index.exported_task_ids(), {'t1'})
+        self.assertEqual(self._members(), ['t1/certified_secure.json', 't1/certified_secure.pdf'])
+
+    def test_unreadable_archive_fails_clearly(self):
+        with open(self.archive, 'wb') as f:
+            f.write(os.urandom(1024))
+        with self.assertRaises(AppdomeError) as raised:
+            self._exporter()
+        self.assertIn('not a readable zip archive', str(raised.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
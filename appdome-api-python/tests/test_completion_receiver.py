@@ -0,0 +1,126 @@
+import json
+import sys
+import threading
+import time
+import unittest
+from os.path import abspath, dirname
+from unittest import mock
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import completion_receiver
+import status
+from completion_receiver import CompletionReceiver, register_task_callback
+from pipeline_harness import start_mock_server
+from status import wait_for_status_complete
+
+TASK_SEC = 0.5
+
+
+class Response:
+    def __init__(self, payload, status_code=200):
+        self.status_code = status_code
+        self.content = json.dumps(payload).encode('utf-8')
+
+
+def _post(url, data=b''):
+    with urlopen(Request(url, data=data, method='POST'), timeout=10) as response:
+        return response.status, response.read()
+
+
+class ReceiverTest(unittest.TestCase):
+    def setUp(self):
+        self.receiver = CompletionReceiver(host='127.0.0.1', fallback_interval_sec=30)
+        self.addCleanup(self.receiver.close)
+
+    def test_callback_wakes_the_waiter(self):
+        url = self.receiver.callback_url('task1')
+        threading.Timer(0.2, _post, (url, json.dumps({'status': 'completed'}).encode('utf-8'))).start()
+        start = time.monotonic()
+        self.assertEqual(self.receiver.wait('task1', 10), {'status': 'completed'})
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_wrong_secret_is_refused(self):
+        with self.assertRaises(HTTPError) as raised:
+            _post(f"{self.receiver.base_url}/appdome/wrong-secret/tasks/task1", b'{"status": "completed"}')
+        self.assertEqual(raised.exception.code, 403)
+        self.assertIsNone(self.receiver.wait('task1', 0.2))
+
+    def test_unknown_path(self):
+        with self.assertRaises(HTTPError) as raised:
+            _post(f"{self.receiver.base_url}/appdome/{self.receiver.secret}/task1")
+        self.assertEqual(raised.exception.code, 404)
+
+    def test_payload_that_is_not_json_still_wakes(self):
+        self.assertEqual(_post(self.receiver.callback_url('task1'), b'done')[0], 204)
+        self.assertEqual(self.receiver.wait('task1', 1), {})
+
+
+class MockServerCallbackTest(unittest.TestCase):
+    """
+    The mock server posts the callback of a registered task once the task completed.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.mock, cls.server_url = start_mock_server({'fuse': TASK_SEC}, jitter=0)
+        cls.tasks_url = f"{cls.server_url}api/v1/tasks"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mock.terminate()
+
+    def setUp(self):
+        self.receiver = CompletionReceiver(host='127.0.0.1', fallback_interval_sec=30)
+        self.addCleanup(self.receiver.close)
+        patch = mock.patch.object(completion_receiver, 'TASKS_URL', self.tasks_url)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_callback_of_the_completed_task(self):
+        task_id = json.loads(_post(self.tasks_url, urlencode({'action': 'fuse'}).encode('utf-8'))[1])['task_id']
+        start = time.monotonic()
+        self.assertTrue(register_task_callback('api-key', None, task_id, self.receiver.callback_url(task_id)))
+        self.assertEqual(self.receiver.wait(task_id, 10), {'task_id': task_id, 'status': 'completed'})
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_registration_of_an_unknown_task_fails(self):
+        self.assertFalse(register_task_callback('api-key', None, 'unknown', self.receiver.callback_url('unknown')))
+
+
+class WaitForStatusTest(unittest.TestCase):
+    def setUp(self):
+        self.receiver = mock.Mock(fallback_interval_sec=120)
+        self.receiver.callback_url.return_value = 'http://127.0.0.1/appdome/secret/tasks/task1'
+        patches = [mock.patch.object(status, 'status', side_effect=[Response({'status': 'progress'}),
+                                                                    Response({'status': 'completed'})]),
+                   mock.patch.object(status, 'deadline_sleep')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_registered_task_waits_for_the_callback(self):
+        with mock.patch.object(status, 'register_task_callback', return_value=True):
+            wait_for_status_complete('api-key', None, 'task1', interval_sec=1, completion_receiver=self.receiver)
+        self.receiver.wait.assert_called_once_with('task1', 120)
+        status.deadline_sleep.assert_not_called()
+        self.receiver.forget.assert_called_once_with('task1')
+
+    def test_failed_registration_falls_back_to_polling(self):
+        with mock.patch.object(status, 'register_task_callback', return_value=False):
+            wait_for_status_complete('api-key', None, 'task1', interval_sec=1, completion_receiver=self.receiver)
+        self.receiver.wait.assert_not_called()
+        status.deadline_sleep.assert_called_once_with(1)
+        self.assertEqual(status.status.call_count, 2)
+
+    def test_unreachable_server_falls_back_to_polling(self):
+        with mock.patch.object(completion_receiver, 'http_post', side_effect=ConnectionError('refused')):
+            wait_for_status_complete('api-key', None, 'task1', interval_sec=1, completion_receiver=self.receiver)
+        self.receiver.wait.assert_not_called()
+        status.deadline_sleep.assert_called_once_with(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
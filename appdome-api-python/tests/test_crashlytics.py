@@ -0,0 +1,155 @@
+import gzip
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import abspath, dirname, join
+from unittest import mock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import crashlytics
+from crashlytics import (Crashlytics, FIREBASE_ACCESS_TOKEN_ENV, FIREBASE_API_KEY_ENV, MAPPING_FILE_ID_NAME,
+                         MAPPING_FILE_ID_XML, UPLOAD_CHUNK_SIZE)
+from upload_mapping_file import upload_mapping_files
+from utils import AppdomeApiError, AppdomeError
+
+UPLOAD_SEC = 0.2
+
+
+class _UploadHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        data = bytearray()
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if not size:
+                self.rfile.readline()
+                return bytes(data)
+            data += self.rfile.read(size)
+            self.rfile.readline()
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            body = self._read_body()
+            time.sleep(server.delay)
+            with server.lock:
+                server.uploads.append((self.path, dict(self.headers), body))
+                code = server.statuses.pop(0) if server.statuses else 200
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+        self.send_response(code)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+
+class CrashlyticsUploadTest(unittest.TestCase):
+    """
+    Uploads to a local stand-in of the Crashlytics symbols server, through the CRASHLYTICS_UPLOAD_URL hook.
+    """
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _UploadHandler)
+        self.server.lock = threading.Lock()
+        self.server.uploads, self.server.statuses = [], []
+        self.server.in_flight = self.server.max_in_flight = 0
+        self.server.delay = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        url = f"http://127.0.0.1:{self.server.server_port}/app/{{app_id}}/upload/java/{{mapping_file_id}}"
+        patches = [mock.patch.object(crashlytics, 'CRASHLYTICS_UPLOAD_URL', url),
+                   mock.patch.dict(os.environ, {FIREBASE_ACCESS_TOKEN_ENV: '', FIREBASE_API_KEY_ENV: ''})]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.mapping = os.urandom(3 * UPLOAD_CHUNK_SIZE // 2).hex().encode('ascii')
+        self.mapping_path = join(self.work_dir, 'mapping.txt')
+        with open(self.mapping_path, 'wb') as f:
+            f.write(self.mapping)
+
+    def _crashlytics(self, **kwargs):
+        return Crashlytics(join(self.work_dir, 'deobfuscation.zip'), '1:123:android:abc', **kwargs)
+
+    def test_gzip_streamed_body(self):
+        self.assertTrue(self._crashlytics(access_token='token').api_call_upload_mapping_file('map-id',
+                                                                                             self.mapping_path))
+        path, headers, body = self.server.uploads[0]
+        self.assertEqual(path, '/app/1:123:android:abc/upload/java/map-id')
+        self.assertEqual(headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual((headers['Content-Encoding'], headers['Authorization']), ('gzip', 'Bearer token'))
+        self.assertEqual(gzip.decompress(body), self.mapping)
+
+    def test_429_and_5xx_are_retried_with_the_whole_file(self):
+        self.server.statuses = [429, 503]
+        self.assertTrue(self._crashlytics(api_key='key', retries=2).api_call_upload_mapping_file('map-id',
+                                                                                                 self.mapping_path))
+        self.assertEqual(len(self.server.uploads), 3)
+        for _, headers, body in self.server.uploads:
+            self.assertEqual(headers['X-Goog-Api-Key'], 'key')
+            self.assertEqual(gzip.decompress(body), self.mapping)
+
+    def test_client_error_is_not_retried(self):
+        self.server.statuses = [400]
+        with self.assertRaises(AppdomeApiError) as raised:
+            self._crashlytics(api_key='key').api_call_upload_mapping_file('map-id', self.mapping_path)
+        self.assertEqual(raised.exception.status_code, 400)
+        self.assertEqual(len(self.server.uploads), 1)
+
+    def test_retries_are_bounded(self):
+        self.server.statuses = [503] * 5
+        with self.assertRaises(AppdomeApiError):
+            self._crashlytics(api_key='key', retries=1).api_call_upload_mapping_file('map-id', self.mapping_path)
+        self.assertEqual(len(self.server.uploads), 2)
+
+    def test_upload_without_credentials_fails_before_sending(self):
+        with self.assertRaises(AppdomeError) as raised:
+            self._crashlytics().api_call_upload_mapping_file('map-id', self.mapping_path)
+        self.assertIn(FIREBASE_ACCESS_TOKEN_ENV, str(raised.exception))
+        self.assertEqual(self.server.uploads, [])
+
+    def _deobfuscation_zip(self, index, api_key=True):
+        path = join(self.work_dir, f"deobfuscation{index}.zip")
+        resources = f'<string name="{MAPPING_FILE_ID_NAME}">map-{index}</string>'
+        if api_key:
+            resources += '<string name="google_api_key">zip-key</string>'
+        with zipfile.ZipFile(path, 'w') as f:
+            f.writestr('mapping.txt', f"mapping {index}\n" * 1000)
+            f.writestr(MAPPING_FILE_ID_XML, f"<resources>{resources}</resources>")
+        return path
+
+    def test_concurrent_uploads(self):
+        self.server.delay = UPLOAD_SEC
+        uploads = [(self._deobfuscation_zip(index), f"1:123:android:app{index}", None) for index in range(4)]
+        start = time.monotonic()
+        self.assertEqual(upload_mapping_files(uploads, max_workers=4), [])
+        self.assertLess(time.monotonic() - start, len(uploads) * UPLOAD_SEC)
+        self.assertGreater(self.server.max_in_flight, 1)
+        uploaded = {path: gzip.decompress(body) for path, _, body in self.server.uploads}
+        for index in range(4):
+            self.assertEqual(uploaded[f"/app/1:123:android:app{index}/upload/java/map-{index}"],
+                             f"mapping {index}\n".encode('ascii') * 1000)
+        self.assertEqual({headers['X-Goog-Api-Key'] for _, headers, _ in self.server.uploads}, {'zip-key'})
+
+    def test_mapping_without_credentials_is_a_failed_upload(self):
+        mapping_zip = self._deobfuscation_zip(0, api_key=False)
+        self.assertEqual(upload_mapping_files([(mapping_zip, '1:123:android:app0', None)]), [mapping_zip])
+        self.assertEqual(self.server.uploads, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
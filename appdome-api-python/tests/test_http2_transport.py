@@ -0,0 +1,134 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, dirname, join
+from unittest import mock
+
+import requests
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import http2_transport
+from http2_transport import HTTP2_ENV, Http2Transport, init_http2_transport
+from pipeline_harness import CLIENT_DIR, MOCK_DURATIONS, start_mock_server
+from utils import request_not_sent
+
+OUTPUT_SIZE = 300 * 1024
+
+
+@unittest.skipIf(http2_transport.httpx is None, 'requires httpx[http2]')
+class Http2TransportTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mock, cls.server_url = start_mock_server(MOCK_DURATIONS, jitter=0, output_size=OUTPUT_SIZE, http2=True)
+        cls.transport = Http2Transport(prior_knowledge=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.transport.close()
+        cls.mock.terminate()
+
+    def test_response(self):
+        response = self.transport.request('post', f"{self.server_url}api/v1/tasks", data={'action': 'fuse'},
+                                          headers={'Authorization': 'key'}, timeout=(5, 10))
+        self.assertEqual(response.http_version, 'HTTP/2')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.ok)
+        self.assertTrue(response.json()['task_id'].startswith('task'))
+        self.assertEqual(json.loads(response.text), response.json())
+        self.assertEqual(response.url, f"{self.server_url}api/v1/tasks")
+        self.assertEqual(response.request.body, b'action=fuse')
+        self.assertEqual(response.request.headers['authorization'], 'key')
+
+    def test_error_status(self):
+        response = self.transport.request('get', f"{self.server_url}api/v1/unknown")
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.ok)
+
+    def test_streamed_download(self):
+        response = self.transport.request('get', f"{self.server_url}api/v1/tasks/task1/output", stream=True)
+        try:
+            self.assertEqual(response.http_version, 'HTTP/2')
+            self.assertIsNone(response.elapsed)
+            size = sum(len(chunk) for chunk in response.iter_content(16 * 1024))
+        finally:
+            response.close()
+        # Larger than the initial flow control window, so the server waited for window updates
+        self.assertEqual(size, OUTPUT_SIZE + 2)
+
+    def test_streamed_upload(self):
+        response = self.transport.request('put', f"{self.server_url}s3/object",
+                                          data=iter([b'PK', os.urandom(200 * 1024)]))
+        self.assertEqual((response.http_version, response.status_code), ('HTTP/2', 200))
+
+    def test_concurrent_requests_share_one_connection(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(
+                lambda index: self.transport.request('get', f"{self.server_url}api/v1/tasks/task{index}/status"),
+                range(16)))
+        self.assertEqual({response.status_code for response in responses}, {200})
+        self.assertEqual({response.http_version for response in responses}, {'HTTP/2'})
+
+    def test_reset_stream_is_a_connection_error(self):
+        with self.assertRaises(requests.exceptions.ConnectionError) as raised:
+            self.transport.request('post', f"{self.server_url}api/v1/release_fs/drop-fs", params={'team_id': 't'})
+        self.assertFalse(request_not_sent(raised.exception))
+
+    def test_refused_connection_was_not_sent(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        with self.assertRaises(requests.exceptions.ConnectionError) as raised:
+            self.transport.request('get', f"http://127.0.0.1:{port}/")
+        self.assertTrue(request_not_sent(raised.exception))
+
+
+@unittest.skipIf(http2_transport.httpx is None, 'requires httpx[http2]')
+class FallbackTest(unittest.TestCase):
+    def test_http1_server(self):
+        process, server_url = start_mock_server(MOCK_DURATIONS, jitter=0, output_size=1024)
+        transport = Http2Transport()
+        try:
+            response = transport.request('get', f"{server_url}api/v1/tasks/task1/status")
+            self.assertEqual((response.http_version, response.status_code), ('HTTP/1.1', 200))
+        finally:
+            transport.close()
+            process.terminate()
+
+    def test_without_httpx(self):
+        with mock.patch.object(http2_transport, 'httpx', None):
+            self.assertIsNone(init_http2_transport(True))
+
+    def test_environment(self):
+        with mock.patch.dict(os.environ, {HTTP2_ENV: 'off'}):
+            self.assertIsNone(init_http2_transport())
+        with mock.patch.dict(os.environ, {HTTP2_ENV: 'h2c'}):
+            transport = init_http2_transport()
+            self.assertIsInstance(transport, Http2Transport)
+            transport.close()
+
+
+@unittest.skipIf(http2_transport.httpx is None, 'requires httpx[http2]')
+class LoadGeneratorTest(unittest.TestCase):
+    def test_http2_round(self):
+        report = join(tempfile.mkdtemp(), 'report.json')
+        env = {key: value for key, value in os.environ.items() if key != HTTP2_ENV}
+        process = subprocess.run([sys.executable, join(CLIENT_DIR, 'load_generator.py'), '--pipelines', '2',
+                                  '--build_sec', '0.2', '--context_sec', '0.1', '--sign_sec', '0.1',
+                                  '--status_interval_sec', '0.1', '--http2', '--report', report],
+                                 env=env, capture_output=True, text=True, timeout=60)
+        self.assertEqual(process.returncode, 0, process.stderr)
+        with open(report) as f:
+            result = json.load(f)['results'][0]
+        self.assertEqual(result['failures'], 0)
+        # One multiplexed connection for all the concurrent requests
+        self.assertEqual(result['max_sockets'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from os.path import abspath, dirname, join
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import job_queue
+from appdome_api import _phase
+from job_queue import LEASE_EXPIRED_ERROR, RedisJobQueue, SQLiteJobQueue, run_worker
+from profiler import PhaseProfiler
+from utils import AppdomeLeaseError
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+LEASE_SEC = 0.3
+JOB_SEC = 5
+SHORT_LEASE_SEC = 0.1
+
+
+class TakenOverQueue(SQLiteJobQueue):
+    def heartbeat(self, job_id, worker_id, lease_sec):
+        return False
+
+
+class UnreachableQueue(SQLiteJobQueue):
+    def heartbeat(self, job_id, worker_id, lease_sec):
+        raise ConnectionError('queue is unreachable')
+
+
+class LeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.phases = []
+
+    def _run(self, queue_class):
+        queue = queue_class(join(self.work_dir, 'jobs.db'))
+        self.addCleanup(queue.close)
+        queue.enqueue('job1', ['--app', 'app.apk'])
+
+        def run_job(lease):
+            # A pipeline of short phases, running for JOB_SEC unless it is stopped
+            args = SimpleNamespace(job=lease, profiler=PhaseProfiler(), build_run=None)
+            end = time.monotonic() + JOB_SEC
+            while time.monotonic() < end:
+                with _phase(args, f"sign [{len(self.phases)}]"):
+                    self.phases.append(time.monotonic())
+                    time.sleep(0.05)
+
+        start = time.monotonic()
+        counts = run_worker(queue, 'worker1', run_job, lease_sec=LEASE_SEC, max_jobs=1)
+        return counts, time.monotonic() - start, queue
+
+    def test_refused_heartbeat_stops_the_pipeline(self):
+        counts, duration, queue = self._run(TakenOverQueue)
+        self.assertEqual(counts, {'succeeded': 0, 'failed': 0, 'lost': 1})
+        self.assertLess(duration, JOB_SEC / 2)
+        # Lost jobs are left to the worker that took them over
+        self.assertEqual(queue.jobs()[0]['state'], 'leased')
+
+    def test_unreachable_queue_stops_the_pipeline_once_the_lease_expired(self):
+        counts, duration, queue = self._run(UnreachableQueue)
+        self.assertEqual(counts, {'succeeded': 0, 'failed': 0, 'lost': 1})
+        self.assertGreaterEqual(duration, LEASE_SEC)
+        self.assertLess(duration, JOB_SEC / 2)
+
+    def test_renewed_lease_keeps_the_pipeline_running(self):
+        counts, duration, queue = self._run(SQLiteJobQueue)
+        self.assertEqual(counts, {'succeeded': 1, 'failed': 0, 'lost': 0})
+        self.assertGreaterEqual(duration, JOB_SEC)
+        self.assertEqual(queue.jobs()[0]['state'], 'succeeded')
+
+
+class QueueTests:
+    """
+    Queue semantics shared by the backends. Subclasses open the queue.
+    """
+    def _open(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.queue = self._open()
+        self.addCleanup(self.queue.close)
+
+    def _expire(self):
+        time.sleep(SHORT_LEASE_SEC * 1.5)
+
+    def test_enqueue_once(self):
+        self.assertTrue(self.queue.enqueue('job1', ['--app', 'app.apk']))
+        self.assertFalse(self.queue.enqueue('job1', ['--app', 'other.apk']))
+        job = self.queue.lease('worker1', SHORT_LEASE_SEC)
+        self.assertEqual((job.job_id, job.argv, job.attempts, job.tasks), ('job1', ['--app', 'app.apk'], 1, {}))
+
+    def test_expired_lease_is_leased_again(self):
+        self.queue.enqueue('job1', ['--app', 'app.apk'])
+        self.assertEqual(self.queue.lease('worker1', SHORT_LEASE_SEC).attempts, 1)
+        self.assertIsNone(self.queue.lease('worker2', SHORT_LEASE_SEC))
+        # worker1 died without heartbeats
+        self._expire()
+        job = self.queue.lease('worker2', SHORT_LEASE_SEC)
+        self.assertEqual((job.job_id, job.attempts), ('job1', 2))
+        self.assertFalse(self.queue.heartbeat('job1', 'worker1', SHORT_LEASE_SEC))
+        self.assertFalse(self.queue.finish('job1', 'worker1', 'succeeded'))
+        with self.assertRaises(AppdomeLeaseError):
+            self.queue.record_task('job1', 'worker1', 'build', 'task-late')
+        self.assertEqual(self.queue.jobs()[0]['worker_id'], 'worker2')
+
+    def test_heartbeat_keeps_the_lease(self):
+        self.queue.enqueue('job1', ['--app', 'app.apk'])
+        self.queue.lease('worker1', SHORT_LEASE_SEC)
+        for _ in range(3):
+            time.sleep(SHORT_LEASE_SEC / 2)
+            self.assertTrue(self.queue.heartbeat('job1', 'worker1', SHORT_LEASE_SEC))
+        self.assertIsNone(self.queue.lease('worker2', SHORT_LEASE_SEC))
+
+    def test_tasks_are_reattached_after_takeover(self):
+        self.queue.enqueue('job1', ['--app', 'app.apk'])
+        self.queue.lease('worker1', SHORT_LEASE_SEC)
+        self.queue.record_task('job1', 'worker1', 'upload', 'app1')
+        self.queue.record_task('job1', 'worker1', 'build', 'task1')
+        self._expire()
+        job = self.queue.lease('worker2', SHORT_LEASE_SEC)
+        self.assertEqual(job.tasks, {'upload': 'app1', 'build': 'task1'})
+
+    def test_task_is_recorded_once(self):
+        self.queue.enqueue('job1', ['--app', 'app.apk'])
+        self.queue.lease('worker1', SHORT_LEASE_SEC)
+        self.assertEqual(self.queue.record_task('job1', 'worker1', 'build', 'task1'), 'task1')
+        self.assertEqual(self.queue.record_task('job1', 'worker1', 'build', 'task2'), 'task1')
+        self._expire()
+        self.queue.lease('worker2', SHORT_LEASE_SEC)
+        self.assertEqual(self.queue.record_task('job1', 'worker2', 'build', 'task3'), 'task1')
+        self.assertEqual(self.queue.record_task('job1', 'worker2', 'sign [release]', 'task4'), 'task4')
+        self.assertEqual(self.queue.jobs()[0]['tasks'], {'build': 'task1', 'sign [release]': 'task4'})
+
+    def test_job_fails_after_max_attempts(self):
+        self.queue.enqueue('job1', ['--app', 'app.apk'], max_attempts=2)
+        for attempt in (1, 2):
+            job = self.queue.lease('worker1', SHORT_LEASE_SEC)
+            self.assertEqual((job.job_id, job.attempts), ('job1', attempt))
+            self._expire()
+        self.assertIsNone(self.queue.lease('worker1', SHORT_LEASE_SEC))
+        job = self.queue.jobs()[0]
+        self.assertEqual((job['state'], job['attempts'], job['error']), ('failed', 2, LEASE_EXPIRED_ERROR))
+
+    def test_finished_job_is_not_leased_again(self):
+        self.queue.enqueue('job1', ['--app', 'app.apk'])
+        self.queue.lease('worker1', SHORT_LEASE_SEC)
+        self.assertTrue(self.queue.finish('job1', 'worker1', 'succeeded'))
+        self._expire()
+        self.assertIsNone(self.queue.lease('worker2', SHORT_LEASE_SEC))
+        self.assertEqual(self.queue.jobs()[0]['state'], 'succeeded')
+
+    def test_worker_reattaches_the_tasks_of_a_dead_worker(self):
+        self.queue.enqueue('job1', ['--app', 'app.apk'])
+        self.queue.lease('dead-worker', SHORT_LEASE_SEC)
+        self.queue.record_task('job1', 'dead-worker', 'upload', 'app1')
+        self._expire()
+        attached = []
+
+        def run_job(lease):
+            attached.append(lease.task('upload'))
+            lease.record_task('build', 'task1')
+
+        counts = run_worker(self.queue, 'worker2', run_job, lease_sec=SHORT_LEASE_SEC, exit_when_empty=True)
+        self.assertEqual(counts, {'succeeded': 1, 'failed': 0, 'lost': 0})
+        self.assertEqual(attached, ['app1'])
+        job = self.queue.jobs()[0]
+        self.assertEqual((job['state'], job['attempts'], job['tasks']),
+                         ('succeeded', 2, {'upload': 'app1', 'build': 'task1'}))
+
+
+class SQLiteJobQueueTest(QueueTests, unittest.TestCase):
+    def _open(self):
+        return SQLiteJobQueue(join(self.work_dir, 'jobs.db'))
+
+
+@unittest.skipIf(job_queue.redis is None or fakeredis is None, 'requires redis and fakeredis[lua]')
+class RedisJobQueueTest(QueueTests, unittest.TestCase):
+    def _open(self):
+        # The Lua scripts run in fakeredis' embedded Lua interpreter
+        client = fakeredis.FakeRedis(decode_responses=True)
+        with mock.patch.object(job_queue.redis.Redis, 'from_url', return_value=client):
+            return RedisJobQueue('redis://localhost:6379/0')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from os.path import abspath, dirname, exists, join
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from log_follower import JSONL_FORMAT, RotatingBufferedWriter, WorkflowLogFollower
+
+
+def _message(creation_time, text, message_id=None, message_type='info'):
+    message = {'creation_time': creation_time, 'message_type': message_type, 'message': {'text': text}}
+    if message_id:
+        message['id'] = message_id
+    return message
+
+
+def _texts(messages):
+    return [message.text for message in messages]
+
+
+class CursorTest(unittest.TestCase):
+    def setUp(self):
+        self.follower = WorkflowLogFollower(echo=False)
+
+    def test_messages_of_the_same_creation_time(self):
+        self.assertEqual(_texts(self.follower.feed([_message(10, 'a'), _message(10, 'b')])), ['a', 'b'])
+        self.assertEqual(self.follower.cursor, 10)
+        # The next page is requested with lastDate 10 and returns the messages at the cursor again
+        self.assertEqual(_texts(self.follower.feed([_message(10, 'a'), _message(10, 'b'), _message(10, 'c')])), ['c'])
+        self.assertEqual(self.follower.cursor, 10)
+
+    def test_repeated_pages_are_dropped(self):
+        page = [_message(12, 'b'), _message(11, 'a')]
+        self.assertEqual(_texts(self.follower.feed(page)), ['a', 'b'])
+        self.assertEqual(self.follower.feed(page), [])
+        self.assertEqual(self.follower.feed(page + [_message(13, 'c')])[0].text, 'c')
+        self.assertEqual(self.follower.cursor, 13)
+
+    def test_messages_older_than_the_cursor_are_dropped(self):
+        self.follower.feed([_message(20, 'new')])
+        self.assertEqual(self.follower.feed([_message(19, 'late')]), [])
+
+    def test_messages_with_ids(self):
+        self.follower.feed([_message(10, 'progress', message_id='m1')])
+        # The same message, updated in place, is not written again
+        self.assertEqual(self.follower.feed([_message(10, 'progress 50%', message_id='m1')]), [])
+        self.assertEqual(_texts(self.follower.feed([_message(10, 'progress', message_id='m2')])), ['progress'])
+
+    def test_numeric_creation_times_are_compared_as_numbers(self):
+        self.follower.feed([_message('9', 'a')])
+        self.assertEqual(_texts(self.follower.feed([_message('10', 'b')])), ['b'])
+        self.assertEqual(self.follower.cursor, '10')
+
+
+class OutputTest(unittest.TestCase):
+    def setUp(self):
+        self.path = join(tempfile.mkdtemp(), 'workflow.log')
+
+    def test_text_output(self):
+        with WorkflowLogFollower(self.path) as follower:
+            follower.begin('build')
+            follower.feed([_message(1, 'one'), _message(2, 'two')])
+            follower.feed([_message(2, 'two')])
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'build:\none\ntwo\n')
+
+    def test_jsonl_output(self):
+        with WorkflowLogFollower(self.path, JSONL_FORMAT, task_id='task1') as follower:
+            follower.begin('sign')
+            follower.feed([_message(1, 'signing', message_type='warning'), _message(1, '')])
+        with open(self.path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 2)
+        for record in records:
+            self.assertIn('timestamp', record)
+            self.assertEqual(record.pop('task_id'), 'task1')
+            record.pop('timestamp')
+        self.assertEqual(records, [{'event': 'operation', 'operation': 'sign'},
+                                   {'event': 'message', 'operation': 'sign', 'creation_time': 1,
+                                    'message_type': 'warning', 'text': 'signing'}])
+
+    def test_echo_is_off_with_an_output_file(self):
+        stdout = io.StringIO()
+        with redirect_stdout(stdout), WorkflowLogFollower(self.path, task_id='task1') as follower:
+            follower.feed([_message(1, 'one')])
+        self.assertEqual(stdout.getvalue(), '')
+
+        with redirect_stdout(stdout):
+            WorkflowLogFollower(task_id='task1').feed([_message(1, 'one')])
+        self.assertEqual(stdout.getvalue(), ' - [task1] one\n')
+
+    def test_rotation(self):
+        writer = RotatingBufferedWriter(self.path, max_bytes=10, backup_count=2)
+        for index in range(5):
+            writer.write(f"line {index}\n")
+        writer.close()
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'line 4\n')
+        with open(f"{self.path}.1") as f:
+            self.assertEqual(f.read(), 'line 3\n')
+        with open(f"{self.path}.2") as f:
+            self.assertEqual(f.read(), 'line 2\n')
+        self.assertFalse(exists(f"{self.path}.3"))
+
+    def test_rotation_appends_to_an_existing_file(self):
+        with open(self.path, 'w') as f:
+            f.write('previous run\n')
+        writer = RotatingBufferedWriter(self.path, max_bytes=20, backup_count=1)
+        writer.write('this run\n')
+        writer.close()
+        self.assertEqual(sorted(os.listdir(dirname(self.path))), ['workflow.log', 'workflow.log.1'])
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'this run\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import json
+import tempfile
+import unittest
+from os.path import join
+
+from pipeline_harness import MOCK_DURATIONS, run_appdome_api, start_mock_server, write_app
+
+MB = 1024 * 1024
+SMALL_SIZE = 1 * MB
+LARGE_SIZE = 48 * MB
+# Python heap a phase may grow by, whatever the app size: the transfers stream in chunks of a few MB at most
+PHASE_BUDGET_MB = 16
+# Heap growth of a phase between the small and the large app, i.e. memory that grows with the app size
+SIZE_GROWTH_TOLERANCE_MB = 4
+
+
+class MemoryBudgetTest(unittest.TestCase):
+    """
+    Runs the whole process against the mock server with a small and a large app and output, and fails when a phase
+    goes over its memory budget or its memory grows with the app size.
+    """
+
+    def _profile(self, size):
+        mock, server_url = start_mock_server(MOCK_DURATIONS, jitter=0, output_size=size)
+        try:
+            work_dir = tempfile.mkdtemp()
+            app = join(work_dir, 'app.apk')
+            write_app(app, size)
+            keystore = join(work_dir, 'release.keystore')
+            with open(keystore, 'w') as f:
+                f.write('keystore')
+            report = join(work_dir, 'profile.json')
+            result = run_appdome_api(server_url, work_dir, '-a', app, '-fs', 'fusion-set', '-s',
+                                     '--keystore', keystore, '--keystore_pass', 'pass', '--keystore_alias', 'alias',
+                                     '--key_pass', 'pass', '-o', join(work_dir, 'out.apk'),
+                                     '--certificate_json', join(work_dir, 'certificate.json'),
+                                     '--profile_report', report, '--profile_memory_budget_mb', str(PHASE_BUDGET_MB))
+            self.assertEqual(result.returncode, 0, result.stderr)
+            with open(report) as f:
+                return {entry['phase']: entry['heap_peak_mb'] for entry in json.load(f)['phases']}
+        finally:
+            mock.terminate()
+
+    def test_phase_memory_does_not_grow_with_app_size(self):
+        small = self._profile(SMALL_SIZE)
+        large = self._profile(LARGE_SIZE)
+        self.assertEqual(set(small), set(large))
+        self.assertTrue({'upload', 'download output'} <= set(large), large)
+        for phase, heap_peak_mb in large.items():
+            with self.subTest(phase=phase):
+                self.assertLessEqual(heap_peak_mb, PHASE_BUDGET_MB)
+                self.assertLessEqual(heap_peak_mb - small[phase], SIZE_GROWTH_TOLERANCE_MB,
+                                     f"{phase} heap peak grows with the app size: {small[phase]} MB for "
+                                     f"{SMALL_SIZE // MB} MB, {heap_peak_mb} MB for {LARGE_SIZE // MB} MB")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+import zipfile
+from os.path import abspath, dirname, exists, join
+from unittest import mock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import appdome_api
+from appdome_api import _fan_out_task_id
+from pipeline_harness import MOCK_DURATIONS, run_appdome_api, start_mock_server, write_app
+from utils import AppdomeError
+
+
+class SignConfigsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mock, cls.server_url = start_mock_server(MOCK_DURATIONS, jitter=0, output_size=64 * 1024)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mock.terminate()
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.app = join(self.work_dir, 'app.apk')
+        write_app(self.app, 1024)
+        keystore = join(self.work_dir, 'release.keystore')
+        with open(keystore, 'w') as f:
+            f.write('keystore')
+        self.sign_configs = join(self.work_dir, 'sign_configs.json')
+        with open(self.sign_configs, 'w') as f:
+            json.dump([{'name': 'release', 'method': 'sign_on_appdome', 'keystore': keystore,
+                        'keystore_pass': 'pass', 'keystore_alias': 'alias', 'key_pass': 'pass'},
+                       {'name': 'play', 'method': 'private_signing', 'signing_fingerprint': 'AA:BB'}], f)
+
+    def test_two_sign_configs(self):
+        output = join(self.work_dir, 'out', 'app.apk')
+        manifest = join(self.work_dir, 'manifest.json')
+        result = run_appdome_api(self.server_url, self.work_dir, '-a', self.app, '-fs', 'fusion-set',
+                                 '--sign_configs', self.sign_configs, '-o', output, '--manifest', manifest,
+                                 '--profile')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        for name in ('release', 'play'):
+            self.assertTrue(exists(join(self.work_dir, 'out', f"app_{name}.apk")), name)
+        with open(manifest) as f:
+            paths = {artifact['path'] for artifact in json.load(f)['artifacts']}
+        self.assertEqual(paths, {join(self.work_dir, 'out', 'app_release.apk'),
+                                 join(self.work_dir, 'out', 'app_play.apk')})
+
+    def test_two_sign_configs_with_build_history(self):
+        output = join(self.work_dir, 'out', 'app.apk')
+        history = join(self.work_dir, 'history.sqlite')
+        result = run_appdome_api(self.server_url, self.work_dir, '-a', self.app, '-fs', 'fusion-set',
+                                 '--sign_configs', self.sign_configs, '-o', output, '--build_history', history)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        with sqlite3.connect(history) as db:
+            self.assertEqual(db.execute('SELECT status FROM runs').fetchall(), [('succeeded',)])
+            phases = {phase for phase, in db.execute('SELECT phase FROM phases')}
+        self.assertTrue({'sign [release]', 'sign [play]', 'download output'} <= phases, phases)
+
+    def test_two_sign_configs_with_context_variants(self):
+        variants = join(self.work_dir, 'variants.json')
+        with open(variants, 'w') as f:
+            json.dump([{'name': 'blue', 'new_bundle_id': 'com.test.blue'}], f)
+        output = join(self.work_dir, 'out', 'app.apk')
+        result = run_appdome_api(self.server_url, self.work_dir, '-a', self.app, '-fs', 'fusion-set',
+                                 '--sign_configs', self.sign_configs, '--context_variants', variants, '-o', output)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(sorted(os.listdir(join(self.work_dir, 'out'))), ['app_blue_play.apk', 'app_blue_release.apk'])
+
+    def test_every_variant_and_sign_config_gets_its_own_task(self):
+        variants = join(self.work_dir, 'variants.json')
+        with open(variants, 'w') as f:
+            json.dump([{'name': 'blue', 'new_bundle_id': 'com.test.blue'},
+                       {'name': 'green', 'new_bundle_id': 'com.test.green'}], f)
+        history = join(self.work_dir, 'history.sqlite')
+        result = run_appdome_api(self.server_url, self.work_dir, '-a', self.app, '-fs', 'fusion-set',
+                                 '--sign_configs', self.sign_configs, '--context_variants', variants,
+                                 '-o', join(self.work_dir, 'out', 'app.apk'), '--build_history', history)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        with sqlite3.connect(history) as db:
+            task_ids = {task['kind']: task['task_id']
+                        for task in json.loads(db.execute('SELECT task_ids FROM runs').fetchone()[0])}
+        self.assertEqual(set(task_ids), {'upload', 'build', 'context [blue]', 'context [green]',
+                                         'sign [blue/release]', 'sign [blue/play]', 'sign [green/release]',
+                                         'sign [green/play]'})
+        tasks = [task_id for kind, task_id in task_ids.items() if kind != 'upload']
+        self.assertEqual(len(set(tasks)), len(tasks), task_ids)
+
+    def test_two_sign_configs_with_build_to_test_vendors(self):
+        output = join(self.work_dir, 'out', 'app.apk')
+        result = run_appdome_api(self.server_url, self.work_dir, '-a', self.app, '-fs', 'fusion-set',
+                                 '--sign_configs', self.sign_configs, '--build_to_test_vendors', 'browserstack',
+                                 'saucelabs', '-o', output)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(sorted(os.listdir(join(self.work_dir, 'out'))),
+                         ['app_browserstack_play.apk', 'app_browserstack_release.apk', 'app_saucelabs_play.apk',
+                          'app_saucelabs_release.apk'])
+
+    def test_build_to_test_vendors_with_cert_pinning(self):
+        cert_pinning_zip = join(self.work_dir, 'pinning.zip')
+        with zipfile.ZipFile(cert_pinning_zip, 'w') as zf:
+            zf.writestr('mapping.json', json.dumps({str(index): f"cert{index}.pem" for index in range(8)}))
+            for index in range(8):
+                zf.writestr(f"cert{index}.pem", os.urandom(64 * 1024))
+        output = join(self.work_dir, 'out', 'app.apk')
+        result = run_appdome_api(self.server_url, self.work_dir, '-a', self.app, '-fs', 'fusion-set',
+                                 '--sign_configs', self.sign_configs, '--cert_pinning_zip', cert_pinning_zip,
+                                 '--build_to_test_vendors', 'browserstack', 'saucelabs', 'bitbar', 'lambdatest',
+                                 '-o', output)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(len(os.listdir(join(self.work_dir, 'out'))), 8)
+        self.assertFalse(exists(join(self.work_dir, 'pinning_unzipped')))
+
+
+
+class FanOutTaskIdTest(unittest.TestCase):
+    class Response:
+        status_code = 200
+
+        def __init__(self, payload):
+            self.content = json.dumps(payload).encode('utf-8')
+
+    def test_task_id_of_the_response(self):
+        self.assertEqual(_fan_out_task_id(self.Response({'task_id': 'task2'}), 'task1', 'Context variant', 'blue'),
+                         'task2')
+
+    def test_parent_task_id_is_not_reused(self):
+        for payload in ({}, {'task_id': None}, {'task_id': 'task1'}):
+            with self.assertRaises(AppdomeError) as raised:
+                _fan_out_task_id(self.Response(payload), 'task1', 'Context variant', 'blue')
+            self.assertIn('Context variant [blue] did not get its own task id', str(raised.exception))
+
+    def test_sign_config_without_a_task_id_fails(self):
+        sign_args = mock.Mock(sign_config={'name': 'release'}, sign_overrides=None, build_run=None, job=None)
+        with mock.patch.object(appdome_api, '_start_sign', return_value=self.Response({})), \
+                mock.patch.object(appdome_api, 'wait_for_status_complete') as wait:
+            with self.assertRaises(AppdomeError):
+                appdome_api._run_sign_config(sign_args, None, 'task1', {}, parent_name='blue')
+        wait.assert_not_called()
+
+
+class StreamUploadTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mock, cls.server_url = start_mock_server(MOCK_DURATIONS, jitter=0, output_size=64 * 1024)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mock.terminate()
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.app = join(self.work_dir, 'app.apk')
+        write_app(self.app, 3 * 1024 * 1024 + 5)
+        with open(self.app, 'rb') as f:
+            self.app_sha256 = hashlib.sha256(f.read()).hexdigest()
+
+    def _run_with_build_history(self, *args, stdin=None):
+        history = join(self.work_dir, 'history.sqlite')
+        result = run_appdome_api(self.server_url, self.work_dir, '-fs', 'fusion-set', '-ps', '-cf', 'AA:BB', '-o',
+                                 join(self.work_dir, 'out', 'app.apk'), '--build_history', history, *args,
+                                 stdin=stdin)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        with sqlite3.connect(history) as db:
+            return db.execute('SELECT status, app_sha256 FROM runs').fetchall()
+
+    def test_stdin_with_build_history(self):
+        with open(self.app, 'rb') as stdin:
+            runs = self._run_with_build_history('--stream_upload', '-a', '-', '--app_name', 'app.apk', stdin=stdin)
+        self.assertEqual(runs, [('succeeded', self.app_sha256)])
+
+    def test_stream_upload_file_with_build_history(self):
+        runs = self._run_with_build_history('--stream_upload', '-a', self.app, '--stream_idle_sec', '0.5')
+        self.assertEqual(runs, [('succeeded', self.app_sha256)])
+
+    def test_upload_with_build_history(self):
+        runs = self._run_with_build_history('-a', self.app)
+        self.assertEqual(runs, [('succeeded', self.app_sha256)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from certified_secure_json import format_json_file
+from post_processors import JsonFormatter, JsonValidator, json_processors
+from utils import AppdomeIntegrityError
+
+DOCUMENT = {'task_id': 'task1', 'protections': [{'name': 'é "quoted"\n', 'enabled': True, 'level': -1.5e3},
+                                                 {}, [], None, False, 0]}
+INVALID_DOCUMENTS = [b'', b'hello', b'{"a":}', b'[1,,2]', b'{]', b'[1 2]', b'{"a" 1}', b'{"a":1,}', b'[1,]', b'01',
+                     b'1.', b'"a\x01"', b'"\\x"', b'"\\u12g4"', b'[] []', b'{1:2}', b'"\xff"', b'tru', b'nulll',
+                     b'{"a":1', b'"abc', b'[1]]', b',', b':', b'-', b'[1]x']
+
+
+def run(processor, data, chunk_size):
+    out = b''.join(processor.process(data[i:i + chunk_size]) for i in range(0, len(data), chunk_size))
+    return out + processor.finish()
+
+
+class JsonProcessorsTest(unittest.TestCase):
+    def test_formats(self):
+        data = json.dumps(DOCUMENT, ensure_ascii=False).encode('utf-8')
+        for chunk_size in (1, 3, 1024):
+            self.assertEqual(run(JsonFormatter(), data, chunk_size),
+                             json.dumps(DOCUMENT, ensure_ascii=False, indent=2).encode('utf-8'))
+            self.assertEqual(run(JsonFormatter(indent=None), data, chunk_size),
+                             json.dumps(DOCUMENT, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+            self.assertEqual(run(JsonValidator(), data, chunk_size), data)
+
+    def test_invalid_documents(self):
+        for data in INVALID_DOCUMENTS:
+            for processors in (json_processors('pretty'), json_processors('compact'), json_processors('raw')):
+                for chunk_size in (1, 1024):
+                    with self.subTest(data=data, processor=processors[0].variant(), chunk_size=chunk_size):
+                        with self.assertRaises(AppdomeIntegrityError):
+                            run(processors[0], data, chunk_size)
+
+    def test_format_json_file(self):
+        path = join(tempfile.mkdtemp(), 'certificate.json')
+        with open(path, 'w') as f:
+            json.dump(DOCUMENT, f)
+        digest = format_json_file(path)
+        with open(path, 'rb') as f:
+            formatted = f.read()
+        self.assertEqual(formatted, json.dumps(DOCUMENT, indent=2).encode('utf-8'))
+        self.assertEqual(digest['size'], len(formatted))
+
+    def test_format_invalid_json_file(self):
+        path = join(tempfile.mkdtemp(), 'certificate.json')
+        with open(path, 'wb') as f:
+            f.write(b'{"a": [1, 2,, 3]}')
+        with self.assertRaises(AppdomeIntegrityError):
+            format_json_file(path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'{"a": [1, 2,, 3]}')
+        self.assertEqual(os.listdir(dirname(path)), ['certificate.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import json
+import socket
+import sys
+import tempfile
+import unittest
+from os.path import abspath, dirname, join
+from unittest import mock
+from urllib.request import urlopen
+
+import requests
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import release_fusion_set
+from pipeline_harness import MOCK_DURATIONS, run_script, start_mock_server
+from release_fusion_set import release_with_retries
+from utils import request_not_sent
+
+
+class Response:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self.headers = {'Retry-After': '0'}
+        self.content = json.dumps(payload).encode('utf-8')
+        self.text = self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def _closed_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class RequestNotSentTest(unittest.TestCase):
+    def test_refused_connection_was_not_sent(self):
+        with self.assertRaises(requests.exceptions.ConnectionError) as raised:
+            requests.post(f"http://127.0.0.1:{_closed_port()}/api/v1/release_fs/fs", timeout=5)
+        self.assertTrue(request_not_sent(raised.exception))
+
+    def test_connection_lost_after_sending_is_unknown(self):
+        error = requests.exceptions.ConnectionError(
+            requests.packages.urllib3.exceptions.ProtocolError('Connection aborted.', ConnectionResetError()))
+        self.assertFalse(request_not_sent(error))
+
+
+class ReleaseWithRetriesTest(unittest.TestCase):
+    def _release(self, responses):
+        with mock.patch.object(release_fusion_set, 'release_fusion_set', side_effect=responses) as release, \
+                mock.patch.object(release_fusion_set, 'deadline_sleep'):
+            result = release_with_retries('api-key', 'fs', 'team', retries=3)
+        return result, release.call_count
+
+    def test_connect_timeout_is_retried(self):
+        result, calls = self._release([requests.exceptions.ConnectTimeout('connect timeout'),
+                                       Response(200, {'new_fusion_set_id': 'fs2'})])
+        self.assertEqual((result['new_fusion_set_id'], result['error'], calls), ('fs2', None, 2))
+
+    def test_connection_lost_after_sending_is_not_retried(self):
+        result, calls = self._release([requests.exceptions.ConnectionError('Connection aborted.'),
+                                       Response(200, {'new_fusion_set_id': 'fs2'})])
+        self.assertEqual(calls, 1)
+        self.assertIsNone(result['new_fusion_set_id'])
+        self.assertIn('Unknown outcome', result['error'])
+
+    def test_503_is_retried(self):
+        result, calls = self._release([Response(503, {}), Response(200, {'new_fusion_set_id': 'fs2'})])
+        self.assertEqual((result['new_fusion_set_id'], result['attempts'], calls), ('fs2', 2, 2))
+
+
+class ReleaseMockServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mock, cls.server_url = start_mock_server(MOCK_DURATIONS, jitter=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mock.terminate()
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def _release(self, mapping):
+        mapping_path = join(self.work_dir, 'mapping.json')
+        results_path = join(self.work_dir, 'results.json')
+        with open(mapping_path, 'w') as f:
+            json.dump(mapping, f)
+        process = run_script(self.server_url, self.work_dir, 'release_fusion_set.py', '--mapping', mapping_path,
+                             '--results', results_path)
+        with open(results_path) as f:
+            results = {(result['fusion_set_id'], result['team_id']): result for result in json.load(f)['results']}
+        return process, results
+
+    def _released(self):
+        with urlopen(f"{self.server_url}mock/releases", timeout=10) as response:
+            return json.load(response)
+
+    def test_release_and_retry_429(self):
+        process, results = self._release({'ok-fs': ['team1'], 'busy-fs': ['team1']})
+        self.assertEqual(process.returncode, 0, process.stderr)
+        self.assertEqual(results[('ok-fs', 'team1')]['attempts'], 1)
+        self.assertEqual(results[('busy-fs', 'team1')]['attempts'], 2)
+        released = [release for release in self._released() if release.startswith(('ok-fs-', 'busy-fs-'))]
+        self.assertEqual(sorted(released), sorted(result['new_fusion_set_id'] for result in results.values()))
+
+    def test_connection_lost_after_sending_is_not_released_again(self):
+        process, results = self._release({'drop-fs': ['team2']})
+        self.assertNotEqual(process.returncode, 0)
+        result = results[('drop-fs', 'team2')]
+        self.assertEqual(result['attempts'], 1)
+        self.assertIn('Unknown outcome', result['error'])
+        self.assertEqual(len([release for release in self._released() if release.startswith('drop-fs-team2-')]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
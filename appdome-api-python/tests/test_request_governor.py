@@ -0,0 +1,165 @@
+import json
+import multiprocessing
+import sys
+import tempfile
+import time
+import unittest
+from os.path import abspath, dirname, join
+from unittest import mock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import request_governor
+from deadline import start_deadline
+from request_governor import AdaptiveConcurrencyLimiter, RequestGovernor, SharedTokenBucket
+
+
+class Response:
+    def __init__(self, status_code, retry_after=None):
+        self.status_code = status_code
+        self.headers = {'Retry-After': str(retry_after)} if retry_after is not None else {}
+        self.elapsed = None
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def _acquire_tokens(state_path, rate, burst, count, times):
+    bucket = SharedTokenBucket(state_path, initial_rate=rate, min_rate=rate, max_rate=rate, burst=burst)
+    for _ in range(count):
+        bucket.acquire()
+        times.put(time.monotonic())
+
+
+class SharedTokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.state_path = join(tempfile.mkdtemp(), 'governor.json')
+
+    def _state(self):
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def test_burst_then_rate(self):
+        bucket = SharedTokenBucket(self.state_path, initial_rate=20, min_rate=20, max_rate=20, burst=3)
+        start = time.monotonic()
+        for _ in range(3):
+            bucket.acquire()
+        self.assertLess(time.monotonic() - start, 0.1)
+        for _ in range(4):
+            bucket.acquire()
+        # 4 more tokens at 20 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+    def test_multiplicative_decrease_with_cooldown(self):
+        bucket = SharedTokenBucket(self.state_path, initial_rate=8, min_rate=1, max_rate=50)
+        bucket.adjust(True)
+        self.assertEqual(bucket.rate(), 4)
+        bucket.adjust(True)
+        # Congestion reported by concurrent requests of the same burst decreases the rate once
+        self.assertEqual(bucket.rate(), 4)
+        with mock.patch.object(request_governor.time, 'time', return_value=time.time() + 2):
+            bucket.adjust(True)
+            self.assertEqual(bucket.rate(), 2)
+
+    def test_additive_increase_up_to_max(self):
+        bucket = SharedTokenBucket(self.state_path, initial_rate=4, min_rate=1, max_rate=5)
+        bucket.adjust(False)
+        self.assertEqual(bucket.rate(), 4.25)
+        for _ in range(20):
+            bucket.adjust(False)
+        self.assertEqual(bucket.rate(), 5)
+
+    def test_min_rate(self):
+        bucket = SharedTokenBucket(self.state_path, initial_rate=1, min_rate=0.5, max_rate=5)
+        for offset in range(5):
+            with mock.patch.object(request_governor.time, 'time', return_value=time.time() + offset * 2):
+                bucket.adjust(True)
+        self.assertEqual(bucket.rate(), 0.5)
+
+    def test_retry_after_pauses_the_bucket(self):
+        bucket = SharedTokenBucket(self.state_path, initial_rate=50, burst=10)
+        bucket.adjust(True, retry_after_sec=0.3)
+        start = time.monotonic()
+        bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+
+    def test_processes_share_the_bucket(self):
+        rate, burst, processes, count = 20, 2, 3, 4
+        times = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_acquire_tokens, args=(self.state_path, rate, burst, count, times))
+                   for _ in range(processes)]
+        start = time.monotonic()
+        for worker in workers:
+            worker.start()
+        acquired = sorted(times.get(timeout=30) for _ in range(processes * count))
+        for worker in workers:
+            worker.join(timeout=30)
+        # One bucket for all the processes: the tokens past the burst come at the shared rate, not per process
+        self.assertGreaterEqual(acquired[-1] - start, (processes * count - burst) / rate * 0.9)
+        self.assertLess(self._state()['tokens'], 1)
+
+
+class AdaptiveConcurrencyLimiterTest(unittest.TestCase):
+    def test_increase_and_decrease(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=4, minimum=1, maximum=5)
+        limiter.acquire()
+        limiter.release(False)
+        self.assertEqual(limiter.limit, 4.25)
+        limiter.acquire()
+        limiter.release(True)
+        self.assertEqual(limiter.limit, 2.125)
+        limiter.acquire()
+        limiter.release(True)
+        self.assertEqual(limiter.limit, 2.125)
+
+
+class RequestGovernorTest(unittest.TestCase):
+    def setUp(self):
+        self.governor = RequestGovernor(join(tempfile.mkdtemp(), 'governor.json'), retries=2)
+        self.addCleanup(start_deadline, None)
+
+    def test_idempotent_request_is_retried_after_retry_after(self):
+        responses = [Response(429, retry_after=0.2), Response(200)]
+        send = mock.Mock(side_effect=responses)
+        start = time.monotonic()
+        response = self.governor.call(send, idempotent=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(send.call_count, 2)
+        self.assertTrue(responses[0].closed)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_retries_are_bounded(self):
+        send = mock.Mock(side_effect=[Response(503, retry_after=0) for _ in range(5)])
+        with mock.patch.object(request_governor.time, 'sleep'):
+            response = self.governor.call(send, idempotent=True)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(send.call_count, 3)
+        self.assertFalse(response.closed)
+
+    def test_request_that_is_not_idempotent_is_not_retried(self):
+        send = mock.Mock(side_effect=[Response(429, retry_after=0), Response(200)])
+        self.assertEqual(self.governor.call(send).status_code, 429)
+        self.assertEqual(send.call_count, 1)
+
+    def test_client_errors_are_not_retried(self):
+        send = mock.Mock(side_effect=[Response(404), Response(200)])
+        self.assertEqual(self.governor.call(send, idempotent=True).status_code, 404)
+        self.assertEqual(send.call_count, 1)
+
+    def test_retry_stops_at_the_deadline(self):
+        start_deadline(1)
+        send = mock.Mock(side_effect=[Response(429, retry_after=30), Response(200)])
+        self.assertEqual(self.governor.call(send, idempotent=True).status_code, 429)
+        self.assertEqual(send.call_count, 1)
+
+    def test_congestion_lowers_the_shared_rate(self):
+        rate = self.governor.bucket.rate()
+        send = mock.Mock(side_effect=[Response(503, retry_after=0)])
+        self.governor.call(send)
+        self.assertEqual(self.governor.bucket.rate(), rate / 2)
+        self.assertLess(self.governor.limiter.limit, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+from os.path import abspath, dirname, exists, join
+from unittest import mock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import upload_ledger
+from crashlytics import Crashlytics, MAPPING_FILE_ID_NAME, MAPPING_FILE_ID_XML
+from upload_ledger import (DEFAULT_MAX_AGE_DAYS, DEFAULT_MAX_ENTRIES, UPLOAD_LEDGER_ENV, UploadLedger,
+                           init_upload_ledger)
+from upload_mapping_file import upload_mapping_files
+
+DAY_SEC = 24 * 3600
+
+
+def _record_entries(path, worker, count):
+    ledger = UploadLedger(path)
+    for index in range(count):
+        ledger.record('crashlytics:app', f"sha-{worker}-{index}", 'map-id')
+
+
+class UploadOnceTest(unittest.TestCase):
+    """
+    Re-runs of the mapping file upload skip what the ledger has as uploaded.
+    """
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.ledger = UploadLedger(join(self.work_dir, 'ledger.json'))
+        self.mapping_zip = self._deobfuscation_zip('mapping\n')
+        patch = mock.patch.object(Crashlytics, 'api_call_upload_mapping_file', return_value=True)
+        self.upload = patch.start()
+        self.addCleanup(patch.stop)
+
+    def _deobfuscation_zip(self, mapping):
+        path = join(self.work_dir, 'deobfuscation.zip')
+        with zipfile.ZipFile(path, 'w') as f:
+            f.writestr('mapping.txt', mapping)
+            f.writestr(MAPPING_FILE_ID_XML, f'<resources><string name="{MAPPING_FILE_ID_NAME}">map-id</string>'
+                                            f'<string name="google_api_key">key</string></resources>')
+        return path
+
+    def _upload(self, **kwargs):
+        return upload_mapping_files([(self.mapping_zip, '1:123:android:abc', None)], ledger=self.ledger, **kwargs)
+
+    def test_rerun_skips_the_upload(self):
+        self.assertEqual(self._upload(), [])
+        self.assertEqual(self._upload(), [])
+        self.assertEqual(self.upload.call_count, 1)
+
+    def test_force_uploads_again(self):
+        self._upload()
+        self.assertEqual(self._upload(force=True), [])
+        self.assertEqual(self.upload.call_count, 2)
+
+    def test_changed_mapping_is_uploaded(self):
+        self._upload()
+        self._deobfuscation_zip('changed mapping\n')
+        self._upload()
+        self.assertEqual(self.upload.call_count, 2)
+
+    def test_failed_upload_is_not_recorded(self):
+        self.upload.return_value = False
+        self.assertEqual(self._upload(), [self.mapping_zip])
+        self.assertEqual(self._upload(), [self.mapping_zip])
+        self.assertEqual(self.upload.call_count, 2)
+
+
+class EvictionTest(unittest.TestCase):
+    def setUp(self):
+        self.path = join(tempfile.mkdtemp(), 'ledger.json')
+
+    def _entries(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def test_entries_expire(self):
+        ledger = UploadLedger(self.path)
+        with mock.patch.object(upload_ledger.time, 'time', return_value=1000.0):
+            ledger.record('crashlytics:app', 'old', 'map-id')
+        now = 1000.0 + (DEFAULT_MAX_AGE_DAYS + 1) * DAY_SEC
+        with mock.patch.object(upload_ledger.time, 'time', return_value=now):
+            self.assertFalse(ledger.contains('crashlytics:app', 'old', 'map-id'))
+            ledger.record('crashlytics:app', 'new', 'map-id')
+            self.assertTrue(ledger.contains('crashlytics:app', 'new', 'map-id'))
+        self.assertEqual([entry['sha256'] for entry in self._entries().values()], ['new'])
+
+    def test_oldest_entries_are_evicted_beyond_max_entries(self):
+        ledger = UploadLedger(self.path, max_entries=3)
+        for index in range(5):
+            with mock.patch.object(upload_ledger.time, 'time', return_value=1000.0 + index):
+                ledger.record('crashlytics:app', f"sha-{index}", 'map-id')
+        self.assertEqual(sorted(entry['sha256'] for entry in self._entries().values()), ['sha-2', 'sha-3', 'sha-4'])
+
+    def test_default_max_entries(self):
+        ledger = UploadLedger(self.path)
+        with open(self.path, 'w') as f:
+            json.dump({f"key-{index}": {'sha256': f"sha-{index}", 'uploaded': 1000.0 + index}
+                       for index in range(DEFAULT_MAX_ENTRIES)}, f)
+        with mock.patch.object(upload_ledger.time, 'time', return_value=1000.0 + DEFAULT_MAX_ENTRIES):
+            ledger.record('crashlytics:app', 'new', 'map-id')
+        entries = self._entries()
+        self.assertEqual(len(entries), DEFAULT_MAX_ENTRIES)
+        self.assertNotIn('key-0', entries)
+        self.assertIn('key-1', entries)
+
+    def test_invalid_ledger_is_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        ledger = UploadLedger(self.path)
+        self.assertFalse(ledger.contains('crashlytics:app', 'sha', 'map-id'))
+        ledger.record('crashlytics:app', 'sha', 'map-id')
+        self.assertTrue(ledger.contains('crashlytics:app', 'sha', 'map-id'))
+
+    def test_concurrent_processes_keep_every_entry(self):
+        workers = [multiprocessing.Process(target=_record_entries, args=(self.path, worker, 25)) for worker in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(60)
+            self.assertEqual(worker.exitcode, 0)
+        self.assertEqual(len(self._entries()), 100)
+
+
+class InitUploadLedgerTest(unittest.TestCase):
+    def test_ledger_is_on_by_default_in_the_home_directory(self):
+        home = tempfile.mkdtemp()
+        with mock.patch.dict(os.environ, {'HOME': home, 'USERPROFILE': home}):
+            os.environ.pop(UPLOAD_LEDGER_ENV, None)
+            ledger = init_upload_ledger()
+            ledger.record('crashlytics:app', 'sha', 'map-id')
+        self.assertEqual(ledger.path, join(home, '.appdome', 'mapping-upload-ledger.json'))
+        self.assertTrue(exists(ledger.path))
+
+    def test_environment_variable(self):
+        path = join(tempfile.mkdtemp(), 'ledger.json')
+        with mock.patch.dict(os.environ, {UPLOAD_LEDGER_ENV: path}):
+            self.assertEqual(init_upload_ledger().path, path)
+        with mock.patch.dict(os.environ, {UPLOAD_LEDGER_ENV: 'off'}):
+            self.assertIsNone(init_upload_ledger())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import json
+import sys
+import tempfile
+import unittest
+from os.path import abspath, dirname, join
+
+import requests
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from utils import AppdomeApiError, AppdomeError, read_named_configs, redact, validate_response, value_to_print
+
+KEYSTORE = b'\x30\x82keystore-line-1\nkeystore-line-2\r\nkeystore-line-3'
+
+
+def _multipart_sign_request():
+    return requests.Request('POST', 'https://fusion.appdome.com/api/v1/tasks',
+                            headers={'Authorization': 'api-key'},
+                            data={'action': 'seal', 'keystore_pass': 'store-pass', 'key_pass': 'key-pass'},
+                            files={'keystore': ('k.p12', KEYSTORE),
+                                   'provisioning_profile': ('app.mobileprovision', b'profile-secret')}).prepare()
+
+
+class RedactTest(unittest.TestCase):
+    def test_multipart_keystore_part_is_masked(self):
+        text = value_to_print(_multipart_sign_request().body, max_len=10000)
+        for secret in ('keystore-line', 'store-pass', 'key-pass', 'profile-secret'):
+            self.assertNotIn(secret, text)
+        self.assertIn('filename="k.p12"', text)
+        self.assertIn('seal', text)
+
+    def test_truncated_multipart_keystore_part_is_masked(self):
+        body = _multipart_sign_request().body
+        cut = body.index(b'keystore-line-2')
+        self.assertNotIn('keystore-line', value_to_print(body, max_len=cut + 5))
+
+    def test_form_and_json_secrets_are_masked(self):
+        self.assertEqual(value_to_print('team=1&keystore=abc&p12_file=def'), 'team=1&keystore=***&p12_file=***')
+        self.assertEqual(value_to_print('{"mobileprovision": "abc", "team": "1"}'),
+                         '{"mobileprovision": ***, "team": "1"}')
+
+    def test_secret_keys_are_masked(self):
+        self.assertEqual(redact({'keystore': 'abc', 'provisioning_profiles': ['a'], 'team_id': '1'}),
+                         {'keystore': '***', 'provisioning_profiles': '***', 'team_id': '1'})
+
+    def test_failed_sign_request_error_has_no_keystore(self):
+        response = requests.Response()
+        response.status_code = 400
+        response._content = b'{"error": "bad keystore"}'
+        response.request = _multipart_sign_request()
+        with self.assertRaises(AppdomeApiError) as raised:
+            validate_response(response)
+        self.assertEqual(raised.exception.status_code, 400)
+        for secret in ('keystore-line', 'store-pass', 'api-key'):
+            self.assertNotIn(secret, str(raised.exception))
+
+
+class ReadNamedConfigsTest(unittest.TestCase):
+    def _read(self, configs):
+        path = join(tempfile.mkdtemp(), 'configs.json')
+        with open(path, 'w') as f:
+            f.write(configs if isinstance(configs, str) else json.dumps(configs))
+        return read_named_configs(path, 'Context variant', ('name', 'new_version'))
+
+    def _error(self, configs):
+        with self.assertRaises(AppdomeError) as raised:
+            self._read(configs)
+        return str(raised.exception)
+
+    def test_configs(self):
+        configs = [{'name': 'blue', 'new_version': '2'}, {'name': 'green.v-2_x'}]
+        self.assertEqual(self._read(configs), configs)
+
+    def test_invalid_files(self):
+        self.assertIn('Context variants file', self._error('[{'))
+        self.assertIn('non empty JSON array', self._error([]))
+        self.assertIn('non empty JSON array', self._error({'name': 'blue'}))
+        self.assertIn('must be a JSON object', self._error(['blue']))
+
+    def test_invalid_configs(self):
+        self.assertIn('Unknown context variant keys: app_name', self._error([{'name': 'blue', 'app_name': 'x'}]))
+        for name in (None, '', 'blue/green', '../blue', 3):
+            self.assertIn('must be non empty', self._error([{'name': name}]))
+        self.assertIn('[blue] is not unique', self._error([{'name': 'blue'}, {'name': 'blue'}]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import json
+import sys
+import threading
+import time
+import unittest
+from os.path import abspath, dirname
+from unittest import mock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import validate
+from validate import ValidationPoller, validate_apps
+
+
+class StatusResponse:
+    status_code = 200
+
+    def __init__(self, payload):
+        self.content = json.dumps(payload).encode('utf-8')
+
+
+class ValidationPollerTest(unittest.TestCase):
+    def _poll_until_done(self, poller):
+        # A clock a minute ahead on every call, so every validation is due on every poll
+        clock = (time.monotonic() + minute * 60 for minute in range(1000))
+        with mock.patch.object(validate, 'monotonic', side_effect=clock):
+            while True:
+                finished = poller.poll_due()
+                if finished:
+                    return finished
+
+    def test_transient_status_errors_are_retried(self):
+        responses = [ConnectionError('reset'), ConnectionError('reset'), StatusResponse({'validation_state': 'valid'})]
+        with mock.patch.object(validate, 'validation_status', side_effect=responses) as status:
+            poller = ValidationPoller('api-key', num_of_retries=3)
+            poller.add('validation1', 'app.apk')
+            finished = self._poll_until_done(poller)
+        self.assertEqual(finished, [('validation1', 'app.apk', {'validation_state': 'valid'}, None)])
+        self.assertEqual(status.call_count, 3)
+
+    def test_validation_fails_after_retries(self):
+        with mock.patch.object(validate, 'validation_status', side_effect=ConnectionError('reset')) as status:
+            poller = ValidationPoller('api-key', num_of_retries=3)
+            poller.add('validation1', 'app.apk')
+            finished = self._poll_until_done(poller)
+        self.assertEqual(finished, [('validation1', 'app.apk', None, 'reset')])
+        self.assertEqual(status.call_count, 3)
+
+
+class ValidateAppsTest(unittest.TestCase):
+    def test_session_outlives_uploads_after_the_deadline(self):
+        events = []
+        release = threading.Event()
+
+        def slow_upload(api_key, file_path, session):
+            release.wait(5)
+            events.append(f"uploaded {file_path}")
+            return 'validation1'
+
+        session = mock.Mock()
+        session.close.side_effect = lambda: events.append('session closed')
+        threading.Timer(1, release.set).start()
+        with mock.patch.object(validate, 'pooled_session', return_value=session), \
+                mock.patch.object(validate, 'start_validation', side_effect=slow_upload):
+            results = validate_apps('api-key', ['a.apk', 'b.apk', 'c.apk'], max_workers=1, timeout_sec=0.2)
+        self.assertEqual(events, ['uploaded a.apk', 'session closed'])
+        self.assertTrue(all('timeout' in result['error'] for result in results))
+
+
+if __name__ == '__main__':
+    unittest.main()
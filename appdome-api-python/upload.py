@@ -2,10 +2,9 @@ import argparse
 import logging
 from os.path import basename
 
-import requests
-
-from utils import (SERVER_API_V1_URL, UPLOAD_URL, request_headers, empty_files, validate_response, debug_log_request, 
+from utils import (http_get, http_put, http_post, SERVER_API_V1_URL, UPLOAD_URL, request_headers, empty_files, validate_response, debug_log_request, 
  									  add_common_args, log_and_exit, init_common_args, build_url, team_params)
+from models import parse_upload, response_json
 from status import wait_for_status_complete
 
 
@@ -14,13 +13,13 @@ def get_upload_link(api_key, team_id):
     params = team_params(team_id)
     headers = request_headers(api_key)
     debug_log_request(url, headers, params=params, request_type='get')
-    return requests.get(url, headers=headers, params=params)
+    return http_get(url, headers=headers, params=params)
 
 
 def put_file_in_aws(file_path, aws_url):
     with open(file_path, 'rb') as f:
         debug_log_request(aws_url, request_type='put')
-        return requests.put(aws_url, data=f)
+        return http_put(aws_url, data=f)
 
 
 def upload_using_link(api_key, team_id, file_id, file_name):
@@ -30,14 +29,14 @@ def upload_using_link(api_key, team_id, file_id, file_name):
     headers = request_headers(api_key)
     body = {'file_app_id': file_id, 'file_name': file_name}
     debug_log_request(url, params=params, data=body)
-    return requests.post(url, headers=headers, params=params, data=body, files=empty_files())
+    return http_post(url, headers=headers, params=params, data=body, files=empty_files())
 
 
 def upload(api_key, team_id, file_path):
     logging.info(f"Preparing to upload [{file_path}]")
     upload_link_response = get_upload_link(api_key, team_id)
     validate_response(upload_link_response)
-    upload_link_json = upload_link_response.json()
+    upload_link_json = response_json(upload_link_response)
     aws_url = upload_link_json.get('url')
     file_id = upload_link_json.get('file_id')
     if not aws_url or not file_id:
@@ -50,7 +49,7 @@ def upload(api_key, team_id, file_path):
     app = upload_using_link(api_key, team_id, file_id, basename(file_path))
     logging.info(f"Upload status: analyzing and saving file info on our servers")
     validate_response(app)
-    app_id = app.json()['id']
+    app_id = parse_upload(app).id
     wait_for_status_complete(api_key, team_id, app_id, url=UPLOAD_URL, operation="upload")
     return app
 
@@ -67,7 +66,7 @@ def main():
     init_common_args(args)
     r = upload(args.api_key, args.team_id, args.app)
     validate_response(r)
-    logging.info(f"Upload success: App id: {r.json()['id']}")
+    logging.info(f"Upload success: App id: {parse_upload(r).id}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from file_lock import file_lock
+
+UPLOAD_LEDGER_ENV = 'APPDOME_UPLOAD_LEDGER'
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_AGE_DAYS = 90
+
+
+def default_ledger_path():
+    return os.path.join(os.path.expanduser('~'), '.appdome', 'mapping-upload-ledger.json')
+
+
+class UploadLedger:
+    """
+    Local record of the mapping file uploads that succeeded, keyed on the destination, the mapping content hash and
+    the build or mapping file id, so re-runs skip uploads that already happened. Shared by all threads and processes
+    on the host that use the same path. Entries older than max_age_days are evicted, then the oldest entries beyond
+    max_entries.
+    """
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES, max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_sec = max_age_days * 24 * 3600
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(destination, content_sha256, mapping_id):
+        return hashlib.sha256(f"{destination}|{content_sha256}|{mapping_id or ''}".encode('utf-8')).hexdigest()
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logging.warning(f"Ignoring invalid upload ledger {self.path}")
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _write(self, entries):
+        oldest = time.time() - self.max_age_sec
+        entries = {key: entry for key, entry in entries.items() if entry.get('uploaded', 0) >= oldest}
+        if len(entries) > self.max_entries:
+            newest = sorted(entries.items(), key=lambda item: item[1].get('uploaded', 0))[-self.max_entries:]
+            entries = dict(newest)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.path)
+
+    def contains(self, destination, content_sha256, mapping_id):
+        with file_lock(self.path + '.lock'):
+            entry = self._read().get(self.key(destination, content_sha256, mapping_id))
+        return entry is not None and entry.get('uploaded', 0) >= time.time() - self.max_age_sec
+
+    def record(self, destination, content_sha256, mapping_id):
+        with file_lock(self.path + '.lock'):
+            entries = self._read()
+            entries[self.key(destination, content_sha256, mapping_id)] = {
+                'destination': destination, 'sha256': content_sha256, 'mapping_id': mapping_id,
+                'uploaded': time.time()}
+            self._write(entries)
+
+
+def init_upload_ledger(path=None):
+    """
+    :param path: Ledger file, default is $APPDOME_UPLOAD_LEDGER or ~/.appdome/mapping-upload-ledger.json
+    :return: UploadLedger, or None when $APPDOME_UPLOAD_LEDGER is 'off'
+    """
+    path = path or os.getenv(UPLOAD_LEDGER_ENV)
+    if path and path.lower() in ('off', 'false', '0'):
+        return None
+    return UploadLedger(path or default_ledger_path())
@@ -1,8 +1,10 @@
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from crashlytics import Crashlytics
 from datadog import DataDog
-from utils import init_logging
+from upload_ledger import init_upload_ledger, UPLOAD_LEDGER_ENV
+from utils import init_logging, log_and_exit
 
 
 def sanitize_input(file_path):
@@ -12,32 +14,52 @@ def sanitize_input(file_path):
     return file_path.strip().strip('"').strip("'")  # Wrap the path in quotes if there are spaces
 
 
-def upload_mapping_file(deobfuscation_mapping_file, fire_base_app_id, data_dog_api_key):
+def upload_mapping_file(deobfuscation_mapping_file, fire_base_app_id, data_dog_api_key, ledger=None, force=False):
     """
     Upload deobfuscation mapping files to either Crashlytics or DataDog, depending on the provided API keys.
+    Uploads the ledger has as already succeeded are skipped.
 
     :param deobfuscation_mapping_file: Path to the deobfuscation mapping file
     :param fire_base_app_id: Firebase App ID for Crashlytics (optional)
     :param data_dog_api_key: Datadog API key (optional)
-    :return: None
+    :param ledger: UploadLedger of the uploads that already succeeded, see init_upload_ledger (optional)
+    :param force: Upload even when the ledger has the upload
+    :return: True when every requested upload succeeded
     """
     uploaded = False  # This will track whether any upload has started
+    succeeded = True
     if fire_base_app_id:
         logging.info("Uploading deobfuscation mapping file to Crashlytics...")
         crashlytics = Crashlytics(deobfuscation_script_output=deobfuscation_mapping_file,
-                                  firebase_app_id=fire_base_app_id)
-        crashlytics.upload_deobfuscation_map()
+                                  firebase_app_id=fire_base_app_id, ledger=ledger, force=force)
+        succeeded = crashlytics.upload_deobfuscation_map() and succeeded
         uploaded = True
     if data_dog_api_key:
         logging.info("Uploading deobfuscation mapping file to Data Dog...")
         datadog = DataDog(deobfuscation_script_output=deobfuscation_mapping_file,
-                          dd_api_key=data_dog_api_key)
-        datadog.upload_deobfuscation_map()
+                          dd_api_key=data_dog_api_key, ledger=ledger, force=force)
+        succeeded = datadog.upload_deobfuscation_map() and succeeded
         uploaded = True
 
     if not uploaded:
         logging.warning("Invalid arguments! You must provide the correct combination of arguments depending on "
                         "the upload: firebase_app_id or datadog_api_key are mandatory inputs.")
+    return uploaded and succeeded
+
+
+def upload_mapping_files(uploads, max_workers=4, ledger=None, force=False):
+    """
+    Uploads the mapping files of many apps concurrently. Crashlytics uploads share one pool of connections.
+
+    :param uploads: List of (deobfuscation mapping file, firebase app id, datadog api key)
+    :param max_workers: Maximum number of concurrent uploads
+    :param ledger: UploadLedger of the uploads that already succeeded, see init_upload_ledger (optional)
+    :param force: Upload even when the ledger has the upload
+    :return: List of the mapping files whose upload failed
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda upload: upload_mapping_file(*upload, ledger=ledger, force=force), uploads))
+    return [upload[0] for upload, succeeded in zip(uploads, results) if not succeeded]
 
 
 def parse_arguments():
@@ -47,11 +69,16 @@ def parse_arguments():
     :return: Parsed arguments
     """
     parser = argparse.ArgumentParser(description="Upload Deobfuscation Mapping Files to Datadog/Crashlytics")
-    parser.add_argument('--mapping_files', '-dso', required=True, metavar='mapping_files',
-                        help='deobfuscation zip file when building with "Obfuscate App Logic"')
-    parser.add_argument("-faid", '--firebase_app_id', metavar='firebase_app_id',
-                        help="Firebase App ID (for Crashlytics)")
+    parser.add_argument('--mapping_files', '-dso', required=True, nargs='+', metavar='mapping_files',
+                        help='deobfuscation zip files when building with "Obfuscate App Logic"')
+    parser.add_argument("-faid", '--firebase_app_id', nargs='+', metavar='firebase_app_id',
+                        help="Firebase App ID (for Crashlytics), one for all the mapping files or one per mapping file")
     parser.add_argument('-dd_api_key', '--datadog_api_key', metavar='datadog_api_key', help="Datadog API key")
+    parser.add_argument('--ledger', metavar='ledger_json_file',
+                        help=f'Ledger of the succeeded uploads. Default: ${UPLOAD_LEDGER_ENV} or '
+                             f'~/.appdome/mapping-upload-ledger.json, "off" disables it')
+    parser.add_argument('--force', action='store_true', help='Upload even when the ledger has the upload')
+    parser.add_argument('--max_workers', type=int, default=4, help='Maximum number of concurrent uploads. Default is 4')
     return parser.parse_args()
 
 
@@ -63,9 +90,17 @@ def main():
     """
     args = parse_arguments()
     init_logging()
-    args.mapping_files = sanitize_input(args.mapping_files)
-    upload_mapping_file(deobfuscation_mapping_file=args.mapping_files, fire_base_app_id=args.firebase_app_id,
-                        data_dog_api_key=args.datadog_api_key)
+    mapping_files = [sanitize_input(mapping_file) for mapping_file in args.mapping_files]
+    firebase_app_ids = args.firebase_app_id or [None]
+    if len(firebase_app_ids) == 1:
+        firebase_app_ids = firebase_app_ids * len(mapping_files)
+    elif len(firebase_app_ids) != len(mapping_files):
+        log_and_exit("firebase_app_id must be given once, or once per mapping file")
+    failed = upload_mapping_files([(mapping_file, firebase_app_id, args.datadog_api_key)
+                                   for mapping_file, firebase_app_id in zip(mapping_files, firebase_app_ids)],
+                                  args.max_workers, init_upload_ledger(args.ledger), args.force)
+    if failed:
+        log_and_exit(f"{len(failed)} of {len(mapping_files)} mapping file uploads failed: {', '.join(failed)}")
 
 
 if __name__ == "__main__":
@@ -1,14 +1,22 @@
 import json
 import logging
-import shutil
+import re
+import sys
 import tempfile
+import threading
 import zipfile
 from contextlib import contextmanager
 from os import getenv, makedirs, listdir
 from os.path import isdir, dirname, exists, splitext, join
 from shutil import rmtree
+from time import sleep
 from urllib.parse import urljoin
 import requests
+import urllib3
+
+from deadline import active_deadline
+from http2_transport import init_http2_transport, CONNECT_ERRORS
+from request_governor import init_request_governor
 
 SERVER_BASE_URL = getenv('APPDOME_SERVER_BASE_URL', 'https://fusion.appdome.com/')
 SERVER_API_V1_URL = urljoin(SERVER_BASE_URL, 'api/v1')
@@ -21,6 +29,64 @@ ANDROID_SIGNING_FINGERPRINT_KEY = 'signing_sha1_fingerprint'
 JSON_CONTENT_TYPE = 'application/json'
 SIGNING_FINGERPRINT_LIST_ENV = 'SIGNING_FINGERPRINT_LIST'
 APPDOME_CLIENT_HEADER = getenv('APPDOME_CLIENT_HEADER', 'Appdome-cli-python/1.0')
+CONNECT_TIMEOUT_ENV = 'APPDOME_CONNECT_TIMEOUT'
+READ_TIMEOUT_ENV = 'APPDOME_READ_TIMEOUT'
+DEFAULT_CONNECT_TIMEOUT_SEC = 10
+DEFAULT_READ_TIMEOUT_SEC = 300
+MAX_LOGGED_VALUE_LEN = 500
+MAX_LOGGED_ITEMS = 50
+MAX_LOGGED_DEPTH = 4
+REDACTED = '***'
+# Parts of the names of headers, fields and files whose values are never logged
+SECRET_NAMES = ('authorization', r'api[_-]?key', r'pass(?:word)?', 'secret', 'token', 'keystore', 'p12', 'credential',
+                'mobileprovision', 'provisioning', 'cookie')
+SECRET_KEY_PATTERN = re.compile('|'.join(SECRET_NAMES), re.IGNORECASE)
+_SECRET_NAME = rf"[\w.\[\]'-]*(?:{'|'.join(SECRET_NAMES)})[\w.\[\]'-]*"
+_SECRET_TEXT_PATTERNS = [
+    # form fields: keystore_pass=value
+    re.compile(rf'((?<![\w-]){_SECRET_NAME}=)[^&\s]*', re.IGNORECASE),
+    # json: "keystore_pass": "value"
+    re.compile(rf'("{_SECRET_NAME}"\s*:\s*)("(?:[^"\\]|\\.)*"|[^,}}\s]+)', re.IGNORECASE),
+    # multipart: name="keystore_pass" ... value, up to the next boundary since file contents span lines
+    re.compile(rf'(name="{_SECRET_NAME}"[^\r\n]*\r?\n(?:[^\r\n]+\r?\n)*\r?\n)[\s\S]*?(?=\r?\n--|\Z)',
+               re.IGNORECASE),
+]
+
+
+class AppdomeError(Exception):
+    """Base class of the errors raised by the Appdome client."""
+
+
+class AppdomeApiError(AppdomeError):
+    """An Appdome API request returned an unexpected status code."""
+    def __init__(self, message, status_code=None, response_text=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response_text = response_text
+
+
+class AppdomeTaskError(AppdomeError):
+    """An Appdome task finished without completing successfully."""
+    def __init__(self, message, task_id=None, status=None):
+        super().__init__(message)
+        self.task_id = task_id
+        self.status = status
+
+
+class AppdomeTimeoutError(AppdomeError):
+    """An Appdome task or validation did not complete in time."""
+
+
+class AppdomeIntegrityError(AppdomeError):
+    """A downloaded artifact does not match the length or checksum sent by the server."""
+
+
+class AppdomeLeaseError(AppdomeError):
+    """A queued job is no longer leased by this worker, another worker took it over."""
+
+
+class AppdomePublishError(AppdomeError):
+    """A downloaded artifact could not be written to one of its tee destinations."""
 
 
 @contextmanager
@@ -50,6 +116,153 @@ UPLOAD_URL = build_url(SERVER_API_V1_URL, 'upload')
 BUILD_TO_TEST_URL = build_url(SERVER_API_V1_URL, 'build-to-test')
 
 
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def request_governor():
+    """
+    :return: The process wide request governor of the Appdome API calls, or None when disabled
+    """
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = init_request_governor(SERVER_BASE_URL, getenv(TEAM_ID_ENV)) or False
+        return _governor or None
+
+
+_http2 = None
+_http2_lock = threading.Lock()
+
+
+def http2_transport(enabled=None):
+    """
+    :param enabled: Enables or disables HTTP/2 for the rest of the process. Default is the APPDOME_HTTP2 variable
+    :return: The process wide HTTP/2 transport of the Appdome API calls, or None when HTTP/1.1 is used
+    """
+    global _http2
+    with _http2_lock:
+        if enabled is not None and bool(_http2) != enabled:
+            if _http2:
+                _http2.close()
+            _http2 = init_http2_transport(enabled) or False
+        if _http2 is None:
+            _http2 = init_http2_transport() or False
+        return _http2 or None
+
+
+_request_timeouts = (float(getenv(CONNECT_TIMEOUT_ENV, DEFAULT_CONNECT_TIMEOUT_SEC)),
+                     float(getenv(READ_TIMEOUT_ENV, DEFAULT_READ_TIMEOUT_SEC)))
+
+
+def set_request_timeouts(connect_sec=None, read_sec=None):
+    """
+    Sets the connect and read timeouts of all the requests of the process. None keeps the current value.
+    """
+    global _request_timeouts
+    _request_timeouts = (connect_sec if connect_sec is not None else _request_timeouts[0],
+                         read_sec if read_sec is not None else _request_timeouts[1])
+
+
+def deadline_remaining():
+    """
+    :return: Seconds left until the deadline of the current phase or pipeline, or None when there is no deadline
+    :raise AppdomeTimeoutError: When the deadline has passed
+    """
+    deadline = active_deadline()
+    if not deadline:
+        return None
+    remaining, phase = deadline.remaining()
+    if remaining <= 0:
+        log_and_exit(f"Deadline of {f'phase {phase}' if phase else 'the pipeline'} exceeded "
+                     f"({deadline.total_sec} seconds for the pipeline)", AppdomeTimeoutError)
+    return remaining
+
+
+def deadline_sleep(seconds):
+    """
+    Sleeps, but not past the deadline of the current phase or pipeline.
+    """
+    remaining = deadline_remaining()
+    sleep(seconds if remaining is None else min(seconds, remaining))
+
+
+def request_timeout():
+    """
+    :return: (connect, read) timeout of a request sent now, bounded by the deadline
+    """
+    connect_sec, read_sec = _request_timeouts
+    remaining = deadline_remaining()
+    if remaining is not None:
+        connect_sec, read_sec = min(connect_sec, remaining), min(read_sec, remaining)
+    return connect_sec, read_sec
+
+
+def http_request(method, url, session=None, **kwargs):
+    """
+    Sends an HTTP request. Requests to the Appdome server pass through the request governor, and are sent over
+    the shared HTTP/2 connection when it is enabled. Requests without a timeout get the connect and read timeouts
+    of the process, bounded by the deadline.
+
+    :param method: HTTP method
+    :param url: Request url
+    :param session: requests.Session to send the request on (optional, not used over HTTP/2)
+    :param kwargs: requests arguments
+    :return: requests.Response, or a response with the same interface over HTTP/2
+    """
+    if kwargs.get('timeout') is None:
+        kwargs['timeout'] = request_timeout()
+    is_server_url = url.startswith(SERVER_BASE_URL)
+    sender = (http2_transport() if is_server_url else None) or session or requests
+
+    def send():
+        return sender.request(method, url, **kwargs)
+
+    governor = request_governor() if is_server_url else None
+    if not governor:
+        return send()
+    return governor.call(send, observe_latency=method.lower() == 'get', idempotent=method.lower() in ('get', 'head'))
+
+
+def http_get(url, session=None, **kwargs):
+    return http_request('get', url, session, **kwargs)
+
+
+def http_post(url, session=None, **kwargs):
+    return http_request('post', url, session, **kwargs)
+
+
+def http_put(url, session=None, **kwargs):
+    return http_request('put', url, session, **kwargs)
+
+
+def request_not_sent(error):
+    """
+    :param error: Exception raised by http_request
+    :return: True when the request failed while its connection was being opened, so none of it reached the server
+        and a request that is not idempotent can be sent again
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout) or isinstance(error.__cause__, CONNECT_ERRORS):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None  # urllib3 MaxRetryError
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def pooled_session(pool_size=10):
+    """
+    Creates a requests session that keeps up to pool_size connections per host alive, to be shared by
+    concurrent requests.
+
+    :param pool_size: Maximum number of pooled connections per host
+    :return: requests.Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 def team_params(team_id):
     params = {}
     if team_id:
@@ -176,6 +389,42 @@ def init_overrides(overrides_file):
             overrides = json.load(f)
     return overrides
 
+
+CONFIG_NAME_PATTERN = re.compile(r'^[\w.-]+$')
+
+
+def read_named_configs(path, description, keys):
+    """
+    Loads a json file holding a non empty list of configurations, each with a unique 'name' made of letters,
+    digits, '.', '-' or '_' (used in output file names and task kinds), and only the given keys.
+
+    :param path: Path to the configurations json file
+    :param description: Configuration description for errors, e.g. 'Context variant'
+    :param keys: Allowed configuration keys
+    :return: List of configuration dicts
+    """
+    with open(path, 'r') as f:
+        try:
+            configs = json.load(f)
+        except json.JSONDecodeError as e:
+            log_and_exit(f"{description}s file {path} contains invalid JSON: {e}")
+    if not isinstance(configs, list) or not configs:
+        log_and_exit(f"{description}s file {path} must contain a non empty JSON array")
+    names = set()
+    for config in configs:
+        if not isinstance(config, dict):
+            log_and_exit(f"{description} must be a JSON object, got {type(config).__name__}")
+        unknown_keys = set(config) - set(keys)
+        if unknown_keys:
+            log_and_exit(f"Unknown {description.lower()} keys: {', '.join(sorted(unknown_keys))}")
+        name = config.get('name')
+        if not isinstance(name, str) or not CONFIG_NAME_PATTERN.match(name):
+            log_and_exit(f"{description} name [{name}] must be non empty and contain only letters, digits, '.', '-' or '_'")
+        if name in names:
+            log_and_exit(f"{description} name [{name}] is not unique")
+        names.add(name)
+    return configs
+
 BUILD_FILE_SPECS = {
     "baseline_profile": "application/zip",
     "input_mapping": "application/txt",
@@ -192,7 +441,8 @@ def init_build_files(build_files, files):
 
 def init_certs_pinning(cert_pinning_zip):
     """
-    Extracts certificates and JSON mapping from the given zip file.
+    Extracts certificates and JSON mapping from the given zip file. Every call extracts to its own temporary
+    directory, so concurrent builds (e.g. a Build to Test vendor matrix) do not share or erase each other's files.
 
     :param cert_pinning_zip: Path to the zip file containing certs and JSON mapping.
     :return: List of files in the required format.
@@ -203,8 +453,7 @@ def init_certs_pinning(cert_pinning_zip):
         logging.warning("No zip file provided or file does not exist.")
         return []  # Return an empty list if the file is not a valid zip or does not exist
     files = []
-    with zipfile.ZipFile(cert_pinning_zip, 'r') as zip_ref:
-        extract_path = splitext(cert_pinning_zip)[0] + "_unzipped"  # Extract to a folder with the same name as the zip
+    with zipfile.ZipFile(cert_pinning_zip, 'r') as zip_ref, erased_temp_dir() as extract_path:
         zip_ref.extractall(extract_path)
 
         # Locate the JSON file and parse it
@@ -224,7 +473,6 @@ def init_certs_pinning(cert_pinning_zip):
                     f"mitm_host_server_pinned_certs_list['{index}'].value.mitm_host_server_pinned_certs_file_content",
                     (file_name, open(file_path, 'rb'), 'application/octet-stream')
                 ))
-    shutil.rmtree(extract_path)
     return files
 
 def run_task_action(api_key, team_id, action, task_id, overrides, files):
@@ -235,41 +483,134 @@ def run_task_action(api_key, team_id, action, task_id, overrides, files):
     params = team_params(team_id)
     body = {ACTION_KEY: action, 'parent_task_id': task_id, OVERRIDES_KEY: json.dumps(overrides)}
     debug_log_request(url, headers=headers, params=params, data=body, files=files)
-    return requests.post(url, headers=headers, params=params, data=body, files=files)
+    return http_post(url, headers=headers, params=params, data=body, files=files)
 
 
-def task_output_command(api_key, team_id, task_id, command, action=None):
+def task_output_command(api_key, team_id, task_id, command, action=None, stream=False, session=None,
+                        extra_headers=None):
     url = build_url(TASKS_URL, task_id, command)
     params = team_params(team_id)
     if action:
         params[ACTION_KEY] = action
     headers = request_headers(api_key, JSON_CONTENT_TYPE)
+    if extra_headers:
+        headers.update(extra_headers)
     debug_log_request(url, headers=headers, params=params, request_type='get')
-    return requests.get(url, headers=headers, params=params)
+    return http_get(url, session, headers=headers, params=params, stream=stream)
 
 
 def validate_response(response):
     accepted_response_codes = [200, 204]
     if response.status_code not in accepted_response_codes:
-        headers_to_print = {}
-        for key, value in response.request.headers.items():
-            headers_to_print[key] = value_to_print(value)
+        headers_to_print = redact(dict(response.request.headers))
         body_to_print = value_to_print(response.request.body)
+        response_text = response.text
 
         log_and_exit(
             f'Validation status for request {response.request.url} with headers {headers_to_print} and body {body_to_print} failed.'
-            f' Status Code: {response.status_code}. Response: {response.text}')
+            f' Status Code: {response.status_code}. Response: {value_to_print(response_text)}',
+            AppdomeApiError, status_code=response.status_code, response_text=response_text)
+
+
+def value_to_print(value, max_len=MAX_LOGGED_VALUE_LEN):
+    """
+    :return: Loggable form of a value, at most max_len characters and with secrets redacted. Only the first
+        max_len bytes or characters of a body are read, and streams and files are shown by type and name only.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        text = bytes(value[:max_len]).decode('utf-8', 'replace')
+        size = len(value)
+    elif isinstance(value, str):
+        text = value[:max_len]
+        size = len(value)
+    elif hasattr(value, 'read'):
+        return f"<file {getattr(value, 'name', type(value).__name__)}>"
+    else:
+        return f"<{type(value).__name__}>"
+    text = redact_text(text)
+    return text if size <= max_len else f"{text} ... ({size} {'bytes' if not isinstance(value, str) else 'chars'})"
 
 
-def value_to_print(value):
-    max_str_len = 500
-    return value if len(str(value)) < max_str_len else str(value)[:max_str_len] + " ... '"
+def redact_text(text):
+    """
+    Masks the values of secret fields in form, json and multipart encoded text.
+    """
+    for pattern in _SECRET_TEXT_PATTERNS:
+        text = pattern.sub(lambda match: match.group(1) + REDACTED, text)
+    return text
 
 
-def log_and_exit(log_line):
-    import sys
-    sys.tracebacklimit = 0
-    raise Exception(log_line)
+def redact(value, key=None, depth=0):
+    """
+    :return: Loggable copy of request headers, params, data or files, with the values of secret keys masked and
+        every value bounded (see value_to_print)
+    """
+    if key is not None and SECRET_KEY_PATTERN.search(str(key)):
+        return REDACTED
+    if depth > MAX_LOGGED_DEPTH:
+        return '...'
+    if isinstance(value, dict):
+        items = list(value.items())
+        redacted = {k: redact(v, k, depth + 1) for k, v in items[:MAX_LOGGED_ITEMS]}
+        if len(items) > MAX_LOGGED_ITEMS:
+            redacted['...'] = f"{len(items) - MAX_LOGGED_ITEMS} more"
+        return redacted
+    if isinstance(value, (list, tuple)):
+        # A files entry is (field, (file name, file object, content type)), masked whole for a secret field
+        if len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], tuple):
+            return value[0], redact(value[1], value[0], depth + 1)
+        redacted = [redact(v, None, depth + 1) for v in value[:MAX_LOGGED_ITEMS]]
+        if len(value) > MAX_LOGGED_ITEMS:
+            redacted.append(f"... {len(value) - MAX_LOGGED_ITEMS} more")
+        return redacted
+    return value_to_print(value)
+
+
+def log_and_exit(log_line, error_class=AppdomeError, **error_kwargs):
+    raise error_class(log_line, **error_kwargs)
+
+
+_phase_metrics = threading.local()
+
+
+@contextmanager
+def collect_metrics():
+    """
+    Collects the counters added with add_metric by this thread (e.g. status polls and transferred bytes) during
+    the block. Nested collections also count towards the enclosing one.
+
+    :yield: Dict of metric name to total
+    """
+    parent = getattr(_phase_metrics, 'metrics', None)
+    metrics = {}
+    _phase_metrics.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _phase_metrics.metrics = parent
+        if parent is not None:
+            for name, value in metrics.items():
+                parent[name] = parent.get(name, 0) + value
+
+
+def add_metric(name, value=1):
+    metrics = getattr(_phase_metrics, 'metrics', None)
+    if metrics is not None:
+        metrics[name] = metrics.get(name, 0) + value
+
+
+def percentile(sorted_values, percent):
+    """
+    :param sorted_values: Sorted list of numbers
+    :param percent: Percentile, 0 to 100
+    :return: Nearest-rank percentile, 0 for an empty list
+    """
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, max(0, int(round(percent / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
 
 
 def init_logging(verbose=False):
@@ -279,12 +620,21 @@ def init_logging(verbose=False):
     init_logging.func_code = (lambda: None).__code__
 
 
+class _RequestDetails:
+    """
+    Formats the redacted parts of a request only when the log record is emitted.
+    """
+    def __init__(self, params, headers, data, files):
+        self.parts = (('params', params), ('headers', headers), ('data', data), ('file', files))
+
+    def __str__(self):
+        return ''.join(f" with {name}: {redact(value)}." for name, value in self.parts if value)
+
+
 def debug_log_request(url, headers=None, data=None, params=None, files=None, request_type='post'):
-    params_line = f" with params: {params}." if params else ""
-    headers_line = f" with headers: {headers}." if headers else ""
-    data_line = f" with data: {data}." if data else ""
-    files_line = f" with file: {files}." if files else ""
-    logging.debug(f"About to {request_type} {url}{params_line}{headers_line}{data_line}{files_line}")
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    logging.debug("About to %s %s%s", request_type, url, _RequestDetails(params, headers, data, files))
 
 
 def add_common_args(parser, add_task_id=False, add_team_id=True):
@@ -294,14 +644,27 @@ def add_common_args(parser, add_task_id=False, add_team_id=True):
         parser.add_argument('-t', '--team_id', default=getenv(TEAM_ID_ENV), metavar=TEAM_ID_ENV,
                             help=f"Appdome team id. Default is environment variable '{TEAM_ID_ENV}'")
     parser.add_argument('-v', '--verbose', action='store_true', help='Show debug logs')
+    parser.add_argument('--http2', action='store_true', default=None,
+                        help='Send the Appdome API requests over HTTP/2 (requires httpx[http2])')
+    parser.add_argument('--connect_timeout', type=float, metavar='seconds',
+                        help=f"Connect timeout of every request. Default is environment variable "
+                             f"'{CONNECT_TIMEOUT_ENV}' or {DEFAULT_CONNECT_TIMEOUT_SEC}")
+    parser.add_argument('--read_timeout', type=float, metavar='seconds',
+                        help=f"Timeout waiting for response bytes of every request. Default is environment variable "
+                             f"'{READ_TIMEOUT_ENV}' or {DEFAULT_READ_TIMEOUT_SEC}")
     if add_task_id:
         parser.add_argument('--task_id', required=True, metavar='task_id_value', help='Build id on Appdome')
 
 
 def init_common_args(args):
+    # Command line runs show errors without tracebacks
+    sys.tracebacklimit = 0
     if not args.api_key:
         log_and_exit(f"api_key must be specified or set though the '{API_KEY_ENV}' environment variable")
     init_logging(args.verbose)
+    set_request_timeouts(getattr(args, 'connect_timeout', None), getattr(args, 'read_timeout', None))
+    if getattr(args, 'http2', None):
+        http2_transport(True)
     if getattr(args, 'signing_fingerprint_list', None):
         resolve_signing_fingerprint_list(args)
 
@@ -317,6 +680,20 @@ def validate_output_path(path):
         makedirs(path_dir)
 
 
+def suffixed_output_path(path, suffix):
+    """
+    Inserts a suffix before the extension of an output path, e.g. out/app.apk -> out/app_brand.apk
+
+    :param path: Output path, or None
+    :param suffix: Suffix to add
+    :return: Suffixed path, or None when path is None
+    """
+    if not path:
+        return path
+    base, ext = splitext(path)
+    return f"{base}_{suffix}{ext}"
+
+
 def add_signing_credentials_args(parser, required=False, add_platform_extra_signing_params=True):
     parser.add_argument('-k', '--keystore', metavar='keystore_file',
                         help='Path to keystore file to use on Appdome iOS and Android signing.', required=required)
@@ -1,69 +1,227 @@
 import argparse
+import json
 import logging
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
 
-import requests
-
-from utils import (SERVER_API_V1_URL, request_headers, JSON_CONTENT_TYPE, validate_response, add_common_args,
-                   debug_log_request, log_and_exit, init_common_args, build_url)
+from models import parse_upload, parse_validation_status, response_json
+from utils import (http_get, http_post, SERVER_API_V1_URL, request_headers, JSON_CONTENT_TYPE, validate_response, add_common_args,
+                   debug_log_request, log_and_exit, init_common_args, build_url, pooled_session, validate_output_path,
+                   AppdomeTimeoutError, deadline_sleep)
 
 VALIDATION = 'validation'
+PENDING_VALIDATION_STATES = ('pending', 'active')
+MIN_POLL_INTERVAL_SEC = 2
+MAX_POLL_INTERVAL_SEC = 30
+POLL_INTERVAL_BACKOFF = 1.5
 
 
-def validation_upload(api_key, file_path):
+def validation_upload(api_key, file_path, session=None):
     url = build_url(SERVER_API_V1_URL, VALIDATION, 'upload')
     headers = request_headers(api_key)
     with open(file_path, 'rb') as f:
         files = {'file': (file_path, f)}
         debug_log_request(url, headers=headers, files=files)
-        return requests.post(url, headers=headers, files=files)
+        return http_post(url, session, headers=headers, files=files)
 
 
-def validation_status(api_key, validation_id):
+def validation_status(api_key, validation_id, session=None):
     url = build_url(SERVER_API_V1_URL, VALIDATION, validation_id, 'status')
     headers = request_headers(api_key, JSON_CONTENT_TYPE)
-    return requests.get(url, headers=headers)
+    return http_get(url, session, headers=headers)
+
+
+def next_poll_interval(interval):
+    return min(interval * POLL_INTERVAL_BACKOFF, MAX_POLL_INTERVAL_SEC)
 
 
-def wait_for_validation_result(api_key, validation_id, timeout_sec=3600):
-    sleep_time = 10
+def wait_for_validation_result(api_key, validation_id, timeout_sec=3600, session=None):
+    sleep_time = MIN_POLL_INTERVAL_SEC
     accumulated_sleep = 0
     status_response = {}
     while accumulated_sleep <= timeout_sec:
-        status_response = validation_status(api_key, validation_id)
+        status_response = validation_status(api_key, validation_id, session)
         validate_response(status_response)
-        status_response_json = status_response.json()
-        validation_state = status_response_json.get('validation_state', '')
-        if validation_state == 'pending' or validation_state == 'active':
+        validation_state = parse_validation_status(status_response).validation_state
+        if validation_state in PENDING_VALIDATION_STATES:
             logging.debug(f'Validation not complete. Sleeping for {sleep_time} seconds')
             print('.', end='', flush=True)
-            sleep(sleep_time)
+            deadline_sleep(sleep_time)
+            accumulated_sleep += sleep_time
+            sleep_time = next_poll_interval(sleep_time)
         else:
             print('', flush=True)
             break
 
     if accumulated_sleep > timeout_sec:
-        log_and_exit(f"\nValidation did not complete in the specified timeout of: {timeout_sec} seconds")
+        log_and_exit(f"\nValidation did not complete in the specified timeout of: {timeout_sec} seconds",
+                     AppdomeTimeoutError)
 
     return status_response
 
 
-def validate_app(api_key, file_path):
-    upload_response = validation_upload(api_key, file_path)
-    logging.info("Upload app for validation done. Waiting for validation result")
+def start_validation(api_key, file_path, session=None):
+    upload_response = validation_upload(api_key, file_path, session)
     validate_response(upload_response)
-    upload_response_json = upload_response.json()
-    validation_id = upload_response_json.get('id')
+    validation_id = parse_upload(upload_response).id
     if not validation_id:
         log_and_exit('Error in upload validation response: ' + upload_response.text)
+    return validation_id
 
+
+def validate_app(api_key, file_path):
+    validation_id = start_validation(api_key, file_path)
+    logging.info("Upload app for validation done. Waiting for validation result")
     return wait_for_validation_result(api_key, validation_id)
 
 
+class ValidationPoller:
+    """
+    Tracks many validation ids from a single thread. Each validation is polled on its own adaptive interval,
+    starting short and backing off while the validation is still pending. A validation fails after num_of_retries
+    status requests failed in a row.
+    """
+    def __init__(self, api_key, session=None, num_of_retries=3):
+        self.api_key = api_key
+        self.session = session
+        self.num_of_retries = num_of_retries
+        self._pending = {}
+
+    def add(self, validation_id, key):
+        """
+        :param validation_id: Validation id returned by the validation upload
+        :param key: Caller key returned with the result, e.g. the app path
+        """
+        self._pending[validation_id] = {'key': key, 'next_poll': monotonic(), 'interval': MIN_POLL_INTERVAL_SEC,
+                                        'failures': 0}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def pending_keys(self):
+        return [(validation_id, state['key']) for validation_id, state in self._pending.items()]
+
+    def seconds_to_next_poll(self):
+        if not self._pending:
+            return None
+        return max(0, min(state['next_poll'] for state in self._pending.values()) - monotonic())
+
+    def poll_due(self):
+        """
+        Polls every validation that is due.
+
+        :return: List of (validation_id, key, status_json, error) for validations that are no longer pending
+        """
+        finished = []
+        for validation_id, state in list(self._pending.items()):
+            if state['next_poll'] > monotonic():
+                continue
+            try:
+                status_response = validation_status(self.api_key, validation_id, self.session)
+                validate_response(status_response)
+                validation = parse_validation_status(status_response)
+            except Exception as e:
+                state['failures'] += 1
+                if state['failures'] >= self.num_of_retries:
+                    finished.append((validation_id, state['key'], None, str(e)))
+                    del self._pending[validation_id]
+                else:
+                    logging.debug(f"Validation status of {state['key']} failed ({e}), retrying")
+                    state['next_poll'] = monotonic() + state['interval']
+                continue
+            state['failures'] = 0
+            if validation.validation_state in PENDING_VALIDATION_STATES:
+                state['interval'] = next_poll_interval(state['interval'])
+                state['next_poll'] = monotonic() + state['interval']
+            else:
+                finished.append((validation_id, state['key'], validation.raw, None))
+                del self._pending[validation_id]
+        return finished
+
+
+def validate_apps(api_key, file_paths, max_workers=4, timeout_sec=3600):
+    """
+    Validates many apps concurrently. Uploads run on a bounded pool over shared pooled connections while a single
+    poller tracks every validation id, until all validations finished or the deadline passed.
+
+    :param api_key: Appdome API key
+    :param file_paths: Paths of the apps to validate
+    :param max_workers: Maximum number of concurrent uploads
+    :param timeout_sec: Deadline for the whole batch
+    :return: List of result dicts (file, validation_id, validation_state, status, error, duration_sec)
+    """
+    start_time = monotonic()
+    deadline = start_time + timeout_sec
+    results = {file_path: {'file': file_path, 'validation_id': None, 'validation_state': None, 'status': None,
+                           'error': None, 'duration_sec': None} for file_path in file_paths}
+    session = pooled_session(max_workers + 1)
+    poller = ValidationPoller(api_key, session)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    uploads = {}
+    try:
+        uploads = {executor.submit(start_validation, api_key, file_path, session): file_path
+                   for file_path in results}
+        while True:
+            for future in [future for future in uploads if future.done()]:
+                file_path = uploads.pop(future)
+                try:
+                    results[file_path]['validation_id'] = future.result()
+                    poller.add(results[file_path]['validation_id'], file_path)
+                    logging.info(f"Uploaded {file_path} for validation. Validation id: "
+                                 f"{results[file_path]['validation_id']}")
+                except Exception as e:
+                    results[file_path]['error'] = f"Upload for validation failed: {e}"
+                    logging.error(f"Upload of {file_path} for validation failed: {e}")
+
+            for validation_id, file_path, status_json, error in poller.poll_due():
+                result = results[file_path]
+                result['duration_sec'] = round(monotonic() - start_time, 3)
+                result['error'] = error
+                if status_json is not None:
+                    result['status'] = status_json
+                    result['validation_state'] = status_json.get('validation_state')
+                logging.info(f"Validation of {file_path} done. State: {result['validation_state']}"
+                             f"{f'. Error: {error}' if error else ''}")
+
+            if not uploads and not len(poller):
+                break
+            if monotonic() > deadline:
+                for future, file_path in uploads.items():
+                    future.cancel()
+                    results[file_path]['error'] = f"Upload did not complete in the specified timeout of: {timeout_sec} seconds"
+                for validation_id, file_path in poller.pending_keys():
+                    results[file_path]['error'] = f"Validation did not complete in the specified timeout of: {timeout_sec} seconds"
+                break
+
+            wait_sec = poller.seconds_to_next_poll()
+            if uploads:
+                wait_sec = MIN_POLL_INTERVAL_SEC / 4 if wait_sec is None else min(wait_sec, MIN_POLL_INTERVAL_SEC / 4)
+            deadline_sleep(max(0, min(wait_sec, deadline - monotonic())))
+    finally:
+        # Uploads still running use the session, so they finish before it is closed
+        for future in uploads:
+            future.cancel()
+        executor.shutdown(wait=True)
+        session.close()
+    return list(results.values())
+
+
+def write_validation_report(results, report_path):
+    with open(report_path, 'w') as f:
+        json.dump({'results': results,
+                   'failed': sum(1 for result in results if result['error'])}, f, indent=2)
+    logging.info(f"Validation report written to {report_path}")
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Validate App after local signing')
     add_common_args(parser, add_team_id=False)
-    parser.add_argument('-vl', '--validate_app', required=True, help='Path of app to validate')
+    apps_group = parser.add_mutually_exclusive_group(required=True)
+    apps_group.add_argument('-vl', '--validate_app', help='Path of app to validate')
+    apps_group.add_argument('--validate_apps', nargs='+', metavar='app_file', help='Paths of apps to validate in batch')
+    parser.add_argument('--max_workers', type=int, default=4, help='Maximum number of concurrent validation uploads. Default is 4')
+    parser.add_argument('--timeout', type=int, default=3600, metavar='timeout_sec', help='Validation timeout in seconds. Default is 3600')
+    parser.add_argument('--report', metavar='report_json_file', help='Output file for the batch validation results report')
     return parser.parse_args()
 
 
@@ -71,9 +229,22 @@ def main():
     args = parse_arguments()
     init_common_args(args)
 
-    r = validate_app(args.api_key, args.validate_app)
-    validate_response(r)
-    logging.info(f"Validation done. Output: {r.json()}")
+    if args.validate_app:
+        r = validate_app(args.api_key, args.validate_app)
+        validate_response(r)
+        logging.info(f"Validation done. Output: {response_json(r)}")
+        return
+
+    if args.max_workers < 1:
+        log_and_exit("max_workers must be a positive number")
+    validate_output_path(args.report)
+    results = validate_apps(args.api_key, args.validate_apps, args.max_workers, args.timeout)
+    if args.report:
+        write_validation_report(results, args.report)
+    failed = [result['file'] for result in results if result['error']]
+    if failed:
+        log_and_exit(f"Validation failed for {len(failed)} of {len(results)} apps: {', '.join(failed)}")
+    logging.info(f"Validation of {len(results)} apps done")
 
 
 if __name__ == '__main__':